@@ -3,8 +3,9 @@ import logging
 import datajoint as dj
 from datetime import datetime
 import hashlib
-import numpy as np
-from scipy import signal
+from itertools import repeat
+
+from .smoothing import smooth
 
 log = logging.getLogger(__name__)
 
@@ -97,9 +98,21 @@ def dict_to_hash(key):
     return hashed.hexdigest()
 
 
-def smooth_psth(data, window_size=None):
+def smooth_psth(data, window_size=None, kernel='boxcar'):
+    """
+    Smooth a psth, or a (unit# x time) stack of psths, along time - see smoothing.smooth
+    window_size is set to 3% of the psth length if not specified
+    """
+    return smooth(data, window_size=window_size, kernel=kernel, axis=-1)
+
 
-    window_size = int(.03 * len(data)) if not window_size else int(window_size)
-    kernel = np.full((window_size, ), 1/window_size)
+def map_chunks(func, chunks, args, n_jobs=1):
+    """
+    Apply func(chunk, *args) to each chunk - in a process pool if n_jobs > 1
+    """
+    if n_jobs == 1:
+        return [func(chunk, *args) for chunk in chunks]
 
-    return signal.convolve(data, kernel, mode='same')
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        return list(executor.map(func, chunks, *(repeat(a) for a in args)))
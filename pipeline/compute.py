@@ -0,0 +1,467 @@
+'''
+Populate machinery shared by the computed tables
+
+BatchPopulate: tables implementing make_batch(keys) are populated a group of keys at a time (e.g. all the
+keys of a session), sharing fetched data and inserting in bulk - job reservation and error isolation
+remain per key
+
+MakeStats: wall / cpu time, peak memory increase and database traffic of every make call (of the BatchPopulate
+tables, and of the other tables populated by pipeline/ingest/populate.py), recorded to the MakeStats table or
+to a JSON-lines file - dj.config['custom']['make_stats.sink']: 'table' (default), 'none', or the path of a .jsonl
+file
+
+MakeProvenance: parameters and code version each key of the Versioned tables (the BatchPopulate tables, and the
+other parametrized computed tables) was made with, so that only the keys made with other settings than the current
+ones are recomputed (Versioned.get_stale_keys)
+'''
+
+import os
+import json
+import platform
+import socket
+import hashlib
+import logging
+import random
+import resource
+import signal
+import time
+import traceback
+from collections import OrderedDict
+from datetime import datetime
+
+import pandas as pd
+import datajoint as dj
+from datajoint import blob as dj_blob
+from datajoint.errors import LostConnectionError
+from datajoint.hash import key_hash
+
+from . import get_schema_name, dict_to_hash
+
+schema = dj.schema(get_schema_name('compute'))
+log = logging.getLogger(__name__)
+
+
+@schema
+class MakeStats(dj.Manual):
+    definition = """
+    # resources used by the make calls of the computed tables
+    table_name:             varchar(255)  # full name of the populated table
+    key_hash:               char(32)      # hash of the key(s) made in the call
+    make_time:              datetime(6)   # start of the make call
+    ---
+    subject_id=null:        int
+    session=null:           smallint
+    key_count:              int           # number of keys made in the call (> 1 for BatchPopulate.make_batch)
+    success:                bool          # False if the call raised an error
+    wall_time:              float         # (s)
+    cpu_time:               float         # (s) user + system time of the worker process
+    peak_rss_delta:         float         # (MB) increase of the peak resident set size of the worker process
+    rows_fetched:           int           # rows returned by the select queries of the call
+    blob_bytes:             bigint        # serialized bytes of the blobs read
+    rows_inserted:          int
+    host:                   varchar(64)
+    pid:                    int
+    """
+
+    @classmethod
+    def report(cls, restriction={}, by='table'):
+        """
+        Summary of the recorded make calls by 'table', 'session' or 'hour' - see summarize_make_stats
+        """
+        return summarize_make_stats(pd.DataFrame((cls & restriction).fetch(as_dict=True)), by=by)
+
+
+@schema
+class MakeProvenance(dj.Manual):
+    definition = """
+    # parameters and code version the keys of the Versioned tables were made with
+    table_name:     varchar(255)  # full name of the populated table
+    key_hash:       char(32)      # hash of the make key (key_source primary key), as in the jobs tables
+    ---
+    params_hash:    char(32)      # hash of the table's version_params - see Versioned.get_version
+    code_hash:      char(32)      # hash of the table's code_version
+    make_time=CURRENT_TIMESTAMP: timestamp
+    """
+
+
+class MakeStatsRecorder:
+    """
+    Measure a make call (context manager): wall and cpu time, peak RSS increase, rows fetched,
+    blob bytes read and rows inserted - queries are counted by wrapping the connection's query method,
+    blob bytes by wrapping the blob deserialization, for the duration of the call
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows_fetched, self.blob_bytes, self.rows_inserted = 0, 0, 0
+
+    def _query(self, query, *args, **kwargs):
+        cursor = self._connection_query(query, *args, **kwargs)
+        statement = query.lstrip()[:7].upper()
+        if statement.startswith('SELECT'):
+            self.rows_fetched += max(cursor.rowcount, 0)
+        elif statement.startswith(('INSERT', 'REPLACE')):
+            self.rows_inserted += max(cursor.rowcount, 0)
+        return cursor
+
+    def _unpack(self, blob, *args, **kwargs):
+        self.blob_bytes += len(blob)
+        return self._blob_unpack(blob, *args, **kwargs)
+
+    def __enter__(self):
+        self.make_time = datetime.now()
+        self._connection_query, self.connection.query = self.connection.query, self._query
+        self._blob_unpack, dj_blob.unpack = dj_blob.unpack, self._unpack
+        self._start = time.perf_counter(), time.process_time(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return self
+
+    def __exit__(self, etype, evalue, etraceback):
+        del self.connection.query
+        dj_blob.unpack = self._blob_unpack
+        wall_start, cpu_start, rss_start = self._start
+        self.wall_time = time.perf_counter() - wall_start
+        self.cpu_time = time.process_time() - cpu_start
+        self.peak_rss_delta = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start) / 1024  # KB -> MB
+
+    def save(self, table, keys, success=True):
+        """
+        Record the measured call of table.make / table.make_batch(keys) to the configured sink
+        """
+        sink = dj.config['custom'].get('make_stats.sink', 'table')
+        if sink == 'none':
+            return
+
+        entry = {'table_name': table.full_table_name,
+                 'key_hash': dict_to_hash(keys[0]) if len(keys) == 1 else hashlib.md5(
+                     ''.join(dict_to_hash(k) for k in keys).encode()).hexdigest(),
+                 'make_time': self.make_time,
+                 'subject_id': keys[0].get('subject_id'), 'session': keys[0].get('session'),
+                 'key_count': len(keys), 'success': success,
+                 'wall_time': self.wall_time, 'cpu_time': self.cpu_time, 'peak_rss_delta': self.peak_rss_delta,
+                 'rows_fetched': self.rows_fetched, 'blob_bytes': self.blob_bytes,
+                 'rows_inserted': self.rows_inserted,
+                 'host': socket.gethostname()[:64], 'pid': os.getpid()}
+        try:
+            if sink == 'table':
+                MakeStats.insert1(entry)
+            else:
+                with open(sink, 'a') as f:
+                    f.write(json.dumps({**entry, 'make_time': self.make_time.isoformat()}, default=int) + '\n')
+        except Exception as e:  # statistics never fail a populate
+            log.warning('make statistics not recorded: {}'.format(e))
+
+
+def load_make_stats(path):
+    """
+    Make statistics recorded to a JSON-lines file, as a data frame with the MakeStats attributes
+    """
+    return pd.read_json(path, lines=True, convert_dates=['make_time'])
+
+
+def summarize_make_stats(stats, by='table'):
+    """
+    Summary of make statistics (data frame of MakeStats entries)
+    :param by: 'table' - per table, slowest first
+               'session' - per table and session, slowest first (e.g. to find pathological sessions)
+               'hour' - per hour and table (e.g. throughput of a worker pool)
+    """
+    groups = {'table': ['table_name'], 'session': ['table_name', 'subject_id', 'session'],
+              'hour': ['hour', 'table_name']}[by]
+    stats = stats.assign(hour=pd.to_datetime(stats.make_time).dt.floor('H'),
+                         failed=~stats.success.astype(bool),
+                         blob_mb=stats.blob_bytes / 1024 ** 2)
+
+    summary = stats.groupby(groups).agg(
+        calls=('key_count', 'count'), keys=('key_count', 'sum'), errors=('failed', 'sum'),
+        wall_time=('wall_time', 'sum'), max_wall_time=('wall_time', 'max'), cpu_time=('cpu_time', 'sum'),
+        max_peak_rss_delta=('peak_rss_delta', 'max'), rows_fetched=('rows_fetched', 'sum'),
+        blob_mb=('blob_mb', 'sum'), rows_inserted=('rows_inserted', 'sum'))
+    summary['wall_time_per_key'] = summary.wall_time / summary['keys']
+    summary['cpu_usage'] = summary.cpu_time / summary.wall_time
+
+    return summary.sort_index() if by == 'hour' else summary.sort_values('wall_time', ascending=False)
+
+
+class Versioned:
+    """
+    Mixin for dj.Computed / dj.Imported tables recording in MakeProvenance, for each key made, the parameters
+    ("version_params" class attributes) and the "code_version" it was made with - so that get_stale_keys returns the
+    keys made with other settings than the current ones (see ingest/populate.py --recompute-stale)
+
+    Bump "code_version" with the changes of make that change its results (other edits - comments, refactoring -
+    leave the rows current)
+    """
+
+    version_params = ()  # names of the class attributes parametrizing make (e.g. 'psth_params') - see get_version
+    code_version = 1
+
+    @classmethod
+    def get_version(cls):
+        """
+        (parameters hash, code hash) of the current settings: the "version_params" class attributes and the
+        "code_version", combined with the versions of the Versioned tables in "fetched_tables" (read by make without
+        a foreign key - e.g. PeriodSelectivity for UnitSelectivity)
+        """
+        params = [repr([(name, getattr(cls, name)) for name in cls.version_params])]
+        code = [repr(cls.code_version)]
+        for upstream in getattr(cls, 'fetched_tables', ()):
+            if isinstance(upstream, type) and issubclass(upstream, Versioned):
+                upstream_params, upstream_code = upstream.get_version()
+                params.append(upstream_params)
+                code.append(upstream_code)
+        return tuple(hashlib.md5('\n'.join(v).encode()).hexdigest() for v in (params, code))
+
+    def get_stale_keys(self, include_unversioned=False):
+        """
+        Populated keys (of key_source) made with other parameters or code than the current ones
+        :param include_unversioned: also return the keys made before their provenance was recorded
+        """
+        version = self.get_version()
+        key_hashes, params_hashes, code_hashes = (
+            MakeProvenance & {'table_name': self.target.full_table_name}).fetch('key_hash', 'params_hash', 'code_hash')
+        made = {k: (p, c) for k, p, c in zip(key_hashes, params_hashes, code_hashes)}
+
+        stale_keys = []
+        for key in (self._jobs_to_do(()) & self.target).fetch('KEY'):
+            made_version = made.get(key_hash(key))
+            if made_version != version and (made_version is not None or include_unversioned):
+                stale_keys.append(key)
+        return stale_keys
+
+    def _save_provenance(self, keys):
+        params_hash, code_hash = getattr(self, '_version', None) or self.get_version()
+        MakeProvenance.insert(({'table_name': self.target.full_table_name, 'key_hash': key_hash(key),
+                                'params_hash': params_hash, 'code_hash': code_hash} for key in keys), replace=True)
+
+    def populate(self, *restrictions, **kwargs):
+        """
+        Same as dj.AutoPopulate.populate, recording the MakeProvenance of each key in the transaction of its make
+        """
+        self._version = self.get_version()
+        instance_make = self.__dict__.get('make')  # e.g. wrapped by ingest/populate.py
+        make = self.make
+
+        def versioned_make(key):
+            make(key)
+            self._save_provenance([key])
+
+        self.make = versioned_make
+        try:
+            return super().populate(*restrictions, **kwargs)
+        finally:
+            if instance_make is None:
+                del self.make
+            else:
+                self.make = instance_make
+
+
+class BatchPopulate(Versioned):
+    """
+    Mixin for dj.Computed / dj.Imported tables implementing make_batch(keys)
+
+    populate() reserves the keys to populate per key (reserve_jobs=True), groups them by "batch_group"
+    and makes each group in one transaction with make_batch(keys). If a batch fails, its keys are made
+    one at a time, so that only the failing keys are marked as errors.
+
+    make_batch(keys) receives keys sharing the same "batch_group" values (make(key) is make_batch([key]))
+    """
+
+    batch_group = ('subject_id', 'session')  # keys with the same values of these attributes are made together
+    batch_size = None  # maximum number of keys per make_batch call (None: the whole group)
+    key_cost = None  # query with a "cost" attribute estimating the cost of keys (order='cost') - see _order_by_cost
+
+    def make(self, key):
+        self.make_batch([key])
+
+    def make_batch(self, keys):
+        raise NotImplementedError
+
+    def _group_keys(self, keys):
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(tuple(key.get(k) for k in self.batch_group), []).append(key)
+
+        for group in groups.values():
+            size = self.batch_size or len(group)
+            for i in range(0, len(group), size):
+                yield group[i:i + size]
+
+    def _order_by_cost(self, batches, todo):
+        """
+        Sort batches longest job first, by estimated cost:
+        + sum of the "key_cost" of their keys (matched on the key_cost primary key), plus one per key
+        + without key_cost: number of keys x past make duration per key of their session (MakeStats of this table)
+        """
+        if self.key_cost is not None:
+            cost_query = self.key_cost() if isinstance(self.key_cost, type) else self.key_cost
+            cost_attrs = cost_query.primary_key
+            costs = {tuple(c[a] for a in cost_attrs): c['cost']
+                     for c in (cost_query & todo).fetch(*cost_attrs, 'cost', as_dict=True)}
+
+            def batch_cost(batch):
+                return sum(float(costs.get(tuple(k[a] for a in cost_attrs)) or 0) + 1 for k in batch)
+        else:
+            subject_ids, sessions, costs = (dj.U('subject_id', 'session').aggr(
+                MakeStats & {'table_name': self.target.full_table_name} & 'success' & 'subject_id is not null',
+                cost='sum(wall_time) / sum(key_count)')).fetch('subject_id', 'session', 'cost')
+            default_cost = float(pd.Series(costs, dtype=float).median()) if len(costs) else 1
+            costs = dict(zip(zip(subject_ids, sessions), costs))
+
+            def batch_cost(batch):
+                return len(batch) * float(costs.get((batch[0].get('subject_id'), batch[0].get('session')),
+                                                    default_cost))
+
+        return sorted(batches, key=batch_cost, reverse=True)
+
+    def _make_keys(self, keys, jobs):
+        """
+        make_batch(keys) in one transaction, recording its MakeStats - raise on failure
+        """
+        stats = MakeStatsRecorder(self.connection)
+        self.connection.start_transaction()
+        self.__class__._allow_insert = True
+        try:
+            with stats:
+                self.make_batch([dict(k) for k in keys])
+            self._save_provenance(keys)
+        except BaseException as error:
+            try:
+                self.connection.cancel_transaction()
+            except LostConnectionError:
+                pass
+            if isinstance(error, Exception):
+                stats.save(self.target, keys, success=False)
+            raise
+        else:
+            self.connection.commit_transaction()
+            if jobs is not None:
+                self._complete_jobs(jobs, keys)
+            stats.save(self.target, keys)
+        finally:
+            self.__class__._allow_insert = False
+
+    def _reserve_jobs(self, jobs, keys):
+        """
+        Reserve the keys not reserved by another worker - the keys reserved by this connection, in order. One insert
+        (duplicates skipped) and one query for all the keys, instead of a jobs.reserve round trip per key
+        """
+        job_keys = OrderedDict((key_hash(self._job_key(k)), k) for k in keys)
+        job = {'table_name': self.target.table_name, 'status': 'reserved', 'host': platform.node(),
+               'pid': os.getpid(), 'connection_id': jobs.connection.connection_id,
+               'user': jobs.connection.get_user()}
+        with dj.config(enable_python_native_blobs=True):
+            jobs.insert(({**job, 'key_hash': h, 'key': self._job_key(k)} for h, k in job_keys.items()),
+                        skip_duplicates=True)
+        reserved = set((jobs & {k: job[k] for k in ('table_name', 'status', 'connection_id')}
+                        & [{'key_hash': h} for h in job_keys]).fetch('key_hash'))
+        return [k for h, k in job_keys.items() if h in reserved]
+
+    def _complete_jobs(self, jobs, keys):
+        (jobs & {'table_name': self.target.table_name}
+         & [{'key_hash': key_hash(self._job_key(k))} for k in keys]).delete_quick()
+
+    def _split_populated(self, keys):
+        """
+        (keys already populated - e.g. by another worker, keys left to make) - one query for all the keys, matched on
+        the key attributes (the target rows of a key may be finer than the key)
+        """
+        key_attrs = list(keys[0])
+        populated = {tuple(k[a] for a in key_attrs)
+                     for k in (dj.U(*key_attrs) & (self.target & keys)).fetch('KEY')}
+        is_populated = [tuple(k[a] for a in key_attrs) in populated for k in keys]
+        return ([k for k, p in zip(keys, is_populated) if p],
+                [k for k, p in zip(keys, is_populated) if not p])
+
+    def _set_error(self, key, error, jobs, suppress_errors, error_list, return_exception_objects):
+        error_message = '{exception}{msg}'.format(
+            exception=error.__class__.__name__, msg=': ' + str(error) if str(error) else '')
+        if jobs is not None:
+            jobs.error(self.target.table_name, self._job_key(key),
+                       error_message=error_message, error_stack=traceback.format_exc())
+        if not suppress_errors or isinstance(error, SystemExit):
+            raise error
+        log.error(error)
+        error_list.append((key, error if return_exception_objects else error_message))
+
+    def populate(self, *restrictions, suppress_errors=False, return_exception_objects=False,
+                 reserve_jobs=False, order='original', limit=None, max_calls=None, display_progress=False):
+        """
+        Same as dj.AutoPopulate.populate, calling make_batch for groups of keys (see BatchPopulate)
+        :param order: "original"|"reverse"|"random"|"cost" - "cost": the most costly batches first (longest job
+                      first - shortens the tail of a backfill run by many workers), see _order_by_cost
+        :param max_calls: maximum number of make_batch calls (each making up to a batch of keys)
+        """
+        if self.connection.in_transaction:
+            raise dj.DataJointError('Populate cannot be called during a transaction.')
+        if order not in ('original', 'reverse', 'random', 'cost'):
+            raise dj.DataJointError('The order argument must be one of original, reverse, random, cost')
+
+        error_list = [] if suppress_errors else None
+        jobs = self.connection.schemas[self.target.database].jobs if reserve_jobs else None
+        self._version = self.get_version()
+
+        if reserve_jobs:
+            def handler(signum, frame):
+                log.info('Populate terminated by SIGTERM')
+                raise SystemExit('SIGTERM received')
+            old_handler = signal.signal(signal.SIGTERM, handler)
+
+        try:
+            todo = self._jobs_to_do(restrictions) - self.target
+            keys = todo.fetch('KEY', limit=limit)
+            if order == 'reverse':
+                keys.reverse()
+            elif order == 'random':
+                random.shuffle(keys)
+
+            log.info('Found {} keys to populate'.format(len(keys)))
+
+            call_count, key_count = 0, 0
+            batches = self._group_keys(keys)
+            if order == 'cost':
+                batches = self._order_by_cost(list(batches), todo)
+
+            for batch in batches:
+                if max_calls is not None and call_count >= max_calls:
+                    break
+
+                if reserve_jobs:
+                    batch = self._reserve_jobs(jobs, batch)
+                if not batch:
+                    continue
+                done, batch = self._split_populated(batch)
+                if done and reserve_jobs:
+                    self._complete_jobs(jobs, done)
+                if not batch:
+                    continue
+
+                call_count += 1
+                key_count += len(batch)
+                if display_progress:
+                    print('{}: populating {} keys - {}/{}'.format(
+                        self.__class__.__name__, len(batch), key_count, len(keys)), flush=True)
+
+                try:
+                    self._make_keys(batch, jobs)
+                except (KeyboardInterrupt, SystemExit) as error:
+                    if reserve_jobs:
+                        for key in batch:
+                            jobs.error(self.target.table_name, self._job_key(key),
+                                       error_message=error.__class__.__name__, error_stack=traceback.format_exc())
+                    raise
+                except Exception as error:
+                    if len(batch) == 1:
+                        self._set_error(batch[0], error, jobs, suppress_errors, error_list, return_exception_objects)
+                        continue
+                    # error isolation - retry the keys one at a time
+                    log.warning('{}.make_batch() of {} keys failed ({}) - making them one at a time'.format(
+                        self.__class__.__name__, len(batch), error))
+                    for key in batch:
+                        try:
+                            self._make_keys([key], jobs)
+                        except (KeyboardInterrupt, SystemExit, Exception) as key_error:
+                            self._set_error(key, key_error, jobs, suppress_errors, error_list,
+                                            return_exception_objects)
+        finally:
+            if reserve_jobs:
+                signal.signal(signal.SIGTERM, old_handler)
+        return error_list
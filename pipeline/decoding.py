@@ -0,0 +1,219 @@
+'''
+Time-resolved decoding of trial variables (e.g. trial instruction) from the simultaneously recorded units of a session
+'''
+
+import logging
+
+import numpy as np
+import datajoint as dj
+from scipy.special import expit
+
+from . import experiment
+from . import ephys
+from . import psth
+[experiment, ephys, psth]  # NOQA
+
+from . import get_schema_name, map_chunks
+
+schema = dj.schema(get_schema_name('decoding'))
+log = logging.getLogger(__name__)
+
+
+@schema
+class DecoderParam(dj.Lookup):
+    definition = """
+    decoder_name: varchar(32)
+    ---
+    decoder_type: enum('lda', 'logistic')
+    decoded_variable: enum('trial_instruction', 'outcome')  # 'left' instruction / 'hit' outcome as the positive class
+    -> psth.TrialCondition   # trials to decode from
+    regularization: float    # shrinkage toward the scaled identity (lda, 0-1) - L2 penalty (logistic)
+    fold_count: tinyint      # number of stratified cross-validation folds
+    fold_seed=0: int         # random seed of the cross-validation folds
+    """
+
+    contents = [('lda_instruction', 'lda', 'trial_instruction', 'all_noearlylick_nostim', 0.1, 5, 0),
+                ('logistic_instruction', 'logistic', 'trial_instruction', 'all_noearlylick_nostim', 1, 5, 0),
+                ('lda_outcome', 'lda', 'outcome', 'all_noearlylick_nostim', 0.1, 5, 0)]
+
+
+@schema
+class SessionDecoding(dj.Computed):
+    """
+    Cross-validated decoding accuracy at every psth time bin, from the trial-psths of all the units of a session
+    """
+
+    definition = """
+    -> experiment.Session
+    -> DecoderParam
+    ---
+    unit_count:              int
+    trial_count:             int
+    positive_trial_count:    int       # number of trials of the positive class
+    time_stamps=null:        longblob  # (s) psth time-stamps, relative to go cue
+    accuracy=null:           longblob  # (time,) cross-validated decoding accuracy - mean over folds
+    accuracy_sem=null:       longblob  # (time,) s.e.m. of the decoding accuracy over folds
+    intercept=null:          longblob  # (time,) decoder intercept, fit on all trials
+    """
+
+    class Unit(dj.Part):
+        definition = """
+        -> master
+        -> ephys.Unit
+        ---
+        decoder_weight: longblob  # (time,) decoder weight of this unit's (z-scored) firing rate, fit on all trials
+        """
+
+    n_jobs = 1  # number of processes to spread the time bins over
+
+    key_source = DecoderParam * (experiment.Session & (ephys.Unit & 'unit_quality != "all"') & ephys.TrialSpikes)
+
+    fetched_tables = (ephys.TrialSpikes,)  # read by make besides the parent tables (populate plan)
+
+    def make(self, key):
+        log.debug('SessionDecoding.make(): key: {}'.format(key))
+
+        decoder_type, decoded_variable, cond_name, regularization, fold_count, fold_seed = (DecoderParam & key).fetch1(
+            'decoder_type', 'decoded_variable', 'trial_condition_name', 'regularization', 'fold_count', 'fold_seed')
+
+        unit_keys = (ephys.Unit & key & 'unit_quality != "all"').fetch('KEY', order_by='unit')
+        trial_keys, trial_values = (experiment.BehaviorTrial & psth.TrialCondition.get_trials(cond_name)
+                                    & key & ephys.TrialSpikes).fetch('KEY', decoded_variable, order_by='trial')
+        labels = trial_values == ('left' if decoded_variable == 'trial_instruction' else 'hit')
+
+        entry = {**key, 'unit_count': len(unit_keys), 'trial_count': len(trial_keys),
+                 'positive_trial_count': int(labels.sum())}
+
+        if min(labels.sum(), (~labels).sum()) < fold_count or not len(unit_keys):
+            log.warning('not enough trials of each class ({}) - no decoding'.format(fold_count))
+            self.insert1(entry)
+            return
+
+        trial_psths, time_stamps = psth.compute_unit_trial_psths(unit_keys, trial_keys)
+        trial_psths = trial_psths.transpose(2, 1, 0)  # time x trial x unit
+
+        accuracy, accuracy_sem, weights, intercept = decode_time_resolved(
+            trial_psths, labels, decoder_type=decoder_type, regularization=regularization,
+            fold_count=fold_count, seed=fold_seed, n_jobs=self.n_jobs)
+
+        self.insert1({**entry, 'time_stamps': time_stamps, 'accuracy': accuracy,
+                      'accuracy_sem': accuracy_sem, 'intercept': intercept})
+        self.Unit.insert({**key, **u, 'decoder_weight': w} for u, w in zip(unit_keys, weights.T))
+
+
+# ---- batched decoders - all time bins fit at once, data as (time, trial, feature) ----
+
+def stratified_folds(labels, fold_count, seed=None):
+    """
+    Assign each trial to one of "fold_count" folds, balancing the classes of "labels" across folds
+    """
+    rng = np.random.RandomState(seed)
+    folds = np.empty(len(labels), dtype=int)
+    for label in np.unique(labels):
+        label_idx = rng.permutation(np.where(labels == label)[0])
+        folds[label_idx] = np.arange(len(label_idx)) % fold_count
+    return folds
+
+
+def _standardize(train, test):
+    """
+    z-score features within each time bin with the training-trial statistics
+    """
+    mean = train.mean(axis=1, keepdims=True)
+    std = train.std(axis=1, keepdims=True)
+    std[std == 0] = 1
+    return (train - mean) / std, (test - mean) / std
+
+
+def fit_lda(data, labels, shrinkage=0.1):
+    """
+    Binary LDA with a shrinkage-regularized pooled covariance, one batched linear solve for all time bins
+    :param data: (time, trial, feature)
+    :param labels: (trial,) boolean
+    :return: weights (time, feature), intercepts (time,)
+    """
+    pos_mean = data[:, labels].mean(axis=1)
+    neg_mean = data[:, ~labels].mean(axis=1)
+
+    centered = data - np.where(labels[None, :, None], pos_mean[:, None], neg_mean[:, None])
+    cov = np.matmul(centered.transpose(0, 2, 1), centered) / max(len(labels) - 2, 1)
+
+    feature_count = data.shape[-1]
+    scale = np.trace(cov, axis1=1, axis2=2) / feature_count
+    scale[scale == 0] = 1
+    cov = (1 - shrinkage) * cov + shrinkage * scale[:, None, None] * np.eye(feature_count)
+
+    weights = np.linalg.solve(cov, (pos_mean - neg_mean)[..., None])[..., 0]
+    intercepts = (-np.einsum('tf,tf->t', weights, (pos_mean + neg_mean) / 2)
+                  + np.log(labels.sum() / (~labels).sum()))
+    return weights, intercepts
+
+
+def fit_logistic(data, labels, l2=1., max_iter=50, tol=1e-6):
+    """
+    Binary L2-regularized logistic regression by iteratively reweighted least squares (Newton steps),
+    with one batched linear solve per iteration for all time bins (the intercept is not penalized)
+    :param data: (time, trial, feature)
+    :param labels: (trial,) boolean
+    :return: weights (time, feature), intercepts (time,)
+    """
+    bin_count, trial_count, feature_count = data.shape
+    design = np.concatenate([data, np.ones((bin_count, trial_count, 1))], axis=2)
+    penalty = np.diag(np.append(np.full(feature_count, float(l2)), 1e-8))
+
+    coefs = np.zeros((bin_count, feature_count + 1))
+    for _ in range(max_iter):
+        prob = expit(np.einsum('tnf,tf->tn', design, coefs))
+        grad = np.einsum('tnf,tn->tf', design, prob - labels) + coefs @ penalty
+        hess = np.matmul(design.transpose(0, 2, 1) * (prob * (1 - prob))[:, None, :], design) + penalty
+        step = np.linalg.solve(hess, grad[..., None])[..., 0]
+        coefs -= step
+        if np.abs(step).max() < tol:
+            break
+
+    return coefs[:, :-1], coefs[:, -1]
+
+
+_decoders = {'lda': fit_lda, 'logistic': fit_logistic}
+
+
+def _cross_validated_accuracy(data, labels, folds, decoder_type, regularization):
+    """
+    Decoding accuracy of each held-out fold - return (fold#, time)
+    """
+    fit = _decoders[decoder_type]
+    accuracy = []
+    for fold in np.unique(folds):
+        is_test = folds == fold
+        train, test = _standardize(data[:, ~is_test], data[:, is_test])
+        weights, intercepts = fit(train, labels[~is_test], regularization)
+        predicted = np.einsum('tnf,tf->tn', test, weights) + intercepts[:, None] > 0
+        accuracy.append((predicted == labels[is_test]).mean(axis=1))
+    return np.array(accuracy)
+
+
+def decode_time_resolved(data, labels, decoder_type='lda', regularization=0.1, fold_count=5, seed=None, n_jobs=1):
+    """
+    Cross-validated linear decoding of binary "labels" at every time bin
+    :param data: (time, trial, feature) - e.g. trial-psths of the units of a session
+    :param labels: (trial,) boolean
+    :param decoder_type: 'lda' or 'logistic'
+    :param regularization: LDA covariance shrinkage (0-1), or logistic L2 penalty
+    :param n_jobs: number of processes to spread the time bins over
+    :return: accuracy (time,) - mean over folds,
+             accuracy s.e.m. over folds (time,),
+             weights (time, feature) and intercepts (time,) of the decoder fit on all trials (z-scored features)
+    """
+    data = np.asarray(data, dtype=float)
+    labels = np.asarray(labels, dtype=bool)
+    folds = stratified_folds(labels, fold_count, seed=seed)
+
+    chunks = np.array_split(data, min(max(n_jobs, 1), len(data)), axis=0)
+    fold_accuracy = np.hstack(map_chunks(_cross_validated_accuracy, chunks,
+                                          (labels, folds, decoder_type, regularization), n_jobs=n_jobs))
+
+    data, _ = _standardize(data, data[:, :0])
+    weights, intercepts = _decoders[decoder_type](data, labels, regularization)
+
+    return (fold_accuracy.mean(axis=0), fold_accuracy.std(axis=0, ddof=1) / np.sqrt(len(fold_accuracy)),
+            weights, intercepts)
@@ -2,9 +2,11 @@
 import datajoint as dj
 
 from . import lab, experiment
-from . import get_schema_name
+from . import get_schema_name, map_chunks
+from .compute import BatchPopulate, Versioned
 
 import numpy as np
+from scipy.ndimage import gaussian_filter1d
 
 schema = dj.schema(get_schema_name('ephys'))
 [lab, experiment]  # NOQA flake8
@@ -157,25 +159,499 @@ class TrialSpikes(dj.Computed):
 
 
 @schema
-class UnitStat(dj.Computed):
+class TrialSpikesIngestion(dj.Manual):
+    """
+    Completion marker of the TrialSpikes ingestion of a probe insertion, written by the ingestion scripts
+    once all its TrialSpikes are inserted - downstream key_sources check it with an indexed lookup
+    """
+    definition = """
+    -> ProbeInsertion
+    ---
+    unit_count: int
+    trial_spikes_count: int
+    ingestion_time=CURRENT_TIMESTAMP: timestamp
+    """
+
+    @classmethod
+    def backfill(cls):
+        """
+        Mark the probe insertions ingested before this marker existed - TrialSpikes of an insertion are
+        inserted at once by the ingestion scripts, so an insertion with TrialSpikes is complete
+        """
+        cls.insert((ProbeInsertion & TrialSpikes).aggr(Unit, unit_count='count(*)')
+                   * (ProbeInsertion & TrialSpikes).aggr(TrialSpikes, trial_spikes_count='count(*)')
+                   - cls, skip_duplicates=True)
+
+
+@schema
+class UnitStat(BatchPopulate, dj.Computed):
     definition = """
     -> Unit
     ---
     isi_violation=null: float    # 
     avg_firing_rate=null: float  # (Hz)
+    isi_violation_rate=null: float  # ISI violation false-positive rate, on the continuous spike train (Hill et al. 2011)
+    presence_ratio=null: float      # fraction of the recording (in presence_ratio_bin_count bins) with spikes
+    amplitude_cutoff=null: float    # estimated fraction of spikes below the detection threshold (Hill et al. 2011)
     """
 
     isi_violation_thresh = 0.002  # violation threshold of 2 ms
+    presence_ratio_bin_count = 100  # number of bins the recording is split into for the presence ratio
+    amplitude_hist_bin_count = 500  # amplitude cutoff - histogram bins, and gaussian smoothing (in bins)
+    amplitude_hist_smoothing = 3
+    version_params = ('isi_violation_thresh', 'presence_ratio_bin_count',
+                      'amplitude_hist_bin_count', 'amplitude_hist_smoothing')
+
+    # insertions with all their trial-spikes ingested
+    key_source = ProbeInsertion & TrialSpikesIngestion
+
+    key_cost = ProbeInsertion.aggr(TrialSpikes, cost='count(*)')  # trial-spikes of each insertion (order='cost')
+
+    fetched_tables = (TrialSpikes,)  # read by make besides the parent tables (populate plan)
+
+    def make_batch(self, keys):
+        # all units and all trial-spikes of the probe insertions of the batch - one fetch each
+        all_unit_keys, all_spike_times = (Unit & keys).fetch('KEY', 'spike_times')
+        # spike amplitudes - waveforms (#spike x #time) fetched one unit at a time, only their amplitudes are kept
+        all_amplitudes = np.empty(len(all_unit_keys), dtype=object)
+        for i, unit_key in enumerate(all_unit_keys):
+            all_amplitudes[i] = _spike_amplitudes((Unit & unit_key).fetch1('waveform'))
+        all_trial_keys, all_trial_spikes, all_tr_start, all_tr_stop = (
+            TrialSpikes * experiment.SessionTrial & keys).fetch('KEY', 'spike_times', 'start_time', 'stop_time')
+
+        all_unit_keys, all_trial_keys = np.array(all_unit_keys, dtype=object), np.array(all_trial_keys, dtype=object)
+        unit_insertions = np.array([u['insertion_number'] for u in all_unit_keys])
+        tr_insertions = np.array([t['insertion_number'] for t in all_trial_keys])
+
+        entries = []
+        for key in keys:
+            is_unit = unit_insertions == key['insertion_number']
+            is_trial = tr_insertions == key['insertion_number']
+            entries += self._compute_insertion_stats(
+                all_unit_keys[is_unit], all_spike_times[is_unit], all_amplitudes[is_unit],
+                all_trial_keys[is_trial], all_trial_spikes[is_trial], all_tr_start[is_trial], all_tr_stop[is_trial])
+
+        self.insert(entries)
+
+    def _compute_insertion_stats(self, unit_keys, spike_times, amplitudes,
+                                 trial_keys, trial_spikes, tr_start, tr_stop):
+        unit_idx = {(u['clustering_method'], u['unit']): i for i, u in enumerate(unit_keys)}
+        unit_count = len(unit_keys)
+
+        tr_unit_idx = np.array([unit_idx[(t['clustering_method'], t['unit'])] for t in trial_keys], dtype=int)
+
+        # ---- trial-based isi violation and firing rate ----
+        # isi across each trial's spikes, assigned back to units
+        spikes, spike_rows = _concatenate_trains(trial_spikes)
+        isi_rows, isi = _within_train_isi(spikes, spike_rows)
+        isi_units = tr_unit_idx[isi_rows]
+
+        isi_count = np.bincount(isi_units, minlength=unit_count)
+        isi_violation_count = np.bincount(isi_units, weights=isi < self.isi_violation_thresh, minlength=unit_count)
+        spike_count = np.bincount(tr_unit_idx, weights=[len(s) for s in trial_spikes], minlength=unit_count)
+        trial_duration = np.bincount(tr_unit_idx, weights=(tr_stop - tr_start).astype(float), minlength=unit_count)
+
+        # ---- continuous spike train metrics ----
+        spikes, spike_units = _concatenate_trains([np.sort(s) for s in spike_times])
+        isi_units, isi = _within_train_isi(spikes, spike_units)
+        cont_spike_count = np.bincount(spike_units, minlength=unit_count)
+        cont_violation_count = np.bincount(isi_units, weights=isi < self.isi_violation_thresh, minlength=unit_count)
+
+        recording_duration = spikes.max() - spikes.min() if len(spikes) else 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            isi_violation_rate = (cont_violation_count * recording_duration
+                                  / (2 * cont_spike_count ** 2 * self.isi_violation_thresh))
+
+        presence_ratio = _presence_ratio(spikes, spike_units, unit_count, self.presence_ratio_bin_count)
+        amplitude_cutoff = _amplitude_cutoff(amplitudes, self.amplitude_hist_bin_count,
+                                             self.amplitude_hist_smoothing)
+
+        def to_float(v):
+            return float(v) if np.isfinite(v) else None
+
+        return [{**unit,
+                 'isi_violation': isi_violation_count[i] / isi_count[i] if isi_count[i] else None,
+                 'avg_firing_rate': spike_count[i] / trial_duration[i] if isi_count[i] else None,
+                 'isi_violation_rate': to_float(isi_violation_rate[i]) if recording_duration else None,
+                 'presence_ratio': to_float(presence_ratio[i]),
+                 'amplitude_cutoff': to_float(amplitude_cutoff[i])}
+                for i, unit in enumerate(unit_keys)]
+
+
+@schema
+class UnitWaveformFeature(Versioned, dj.Computed):
+    definition = """  # features of the mean spike waveform of a unit
+    -> Unit
+    ---
+    trough_to_peak=null: float        # (ms) from the waveform trough to the following peak
+    half_width=null: float            # (ms) width of the trough at half of its amplitude
+    peak_ratio=null: float            # amplitude of the post-trough peak over the trough amplitude
+    repolarization_slope=null: float  # (1/ms) slope after the trough, of the trough-normalized waveform
+    """
+
+    waveform_sample_rate = 19531.25  # (Hz) assumed sampling rate of Unit.waveform - not stored in the source data
+    repolarization_window = 0.3  # (ms) duration after the trough fit for the repolarization slope
+    version_params = ('waveform_sample_rate', 'repolarization_window')
+
+    # all units of a probe insertion are processed together
+    key_source = ProbeInsertion & Unit
+
+    def make(self, key):
+        unit_keys = (Unit & key).fetch('KEY')
+        # waveforms (#spike x #time) fetched one unit at a time, only their mean is kept
+        mean_waveforms = _stack_waveforms([_mean_waveform((Unit & unit_key).fetch1('waveform'))
+                                           for unit_key in unit_keys])
+
+        features = compute_waveform_features(mean_waveforms, self.waveform_sample_rate, self.repolarization_window)
+
+        def to_float(v):
+            return float(v) if np.isfinite(v) else None
+
+        self.insert({**unit, **{k: to_float(v[i]) for k, v in features.items()}}
+                    for i, unit in enumerate(unit_keys))
+
+
+@schema
+class WaveformCellType(Versioned, dj.Computed):
+    definition = """  # putative cell type from the waveform trough-to-peak time - optional, see UnitCellType for curated types
+    -> UnitWaveformFeature
+    ---
+    -> CellType
+    """
+
+    # trough-to-peak (ms) below fs_thresh: 'FS', above pyr_thresh: 'Pyr', in between: 'N/A'
+    trough_to_peak_thresh = {'fs_thresh': 0.35, 'pyr_thresh': 0.45}
+    version_params = ('trough_to_peak_thresh',)
+
+    key_source = ProbeInsertion & UnitWaveformFeature
+
+    def make(self, key):
+        unit_keys, trough_to_peak = (UnitWaveformFeature & key).fetch('KEY', 'trough_to_peak')
+        cell_types = classify_trough_to_peak(trough_to_peak.astype(float), **self.trough_to_peak_thresh)
+        self.insert({**unit, 'cell_type': cell_type} for unit, cell_type in zip(unit_keys, cell_types))
+
+
+@schema
+class CrossCorrelogram(Versioned, dj.Computed):
+    definition = """  # spike-time cross-correlograms between nearby units of a probe insertion
+    -> ProbeInsertion
+    -> ClusteringMethod
+    ---
+    ccg_bin_edges: longblob  # (s) lag bin edges - lag is the spike time of unit_b relative to unit_a
+    """
+
+    class UnitPair(dj.Part):
+        definition = """
+        -> master
+        -> Unit.proj(unit_a='unit')
+        -> Unit.proj(unit_b='unit')
+        ---
+        site_distance: float  # (um) distance between the electrode sites of the two units
+        ccg: longblob         # unit_b spike counts per lag bin, around each unit_a spike
+        """
+
+    ccg_params = {'max_lag': 0.05, 'bin_size': 0.001, 'max_distance': 100}  # (s), (s), (um)
+    version_params = ('ccg_params',)
+    n_jobs = 1  # number of processes to shard the unit pairs over
+
+    key_source = ProbeInsertion * ClusteringMethod & (Unit & 'unit_quality != "all"')
+
+    def make(self, key):
+        units = (Unit & key & 'unit_quality != "all"') * ProbeInsertion.ElectrodeSitePosition
+        unit_ids, spike_times, posx, posy, posz = units.fetch(
+            'unit', 'spike_times', 'electrode_posx', 'electrode_posy', 'electrode_posz', order_by='unit')
+        site_pos = np.column_stack([posx, posy, posz])
+
+        # pairs within max_distance on the probe
+        distances = np.linalg.norm(site_pos[:, None, :] - site_pos[None, :, :], axis=-1)
+        pair_a, pair_b = np.where(np.triu(distances <= self.ccg_params['max_distance'], k=1))
+
+        bin_edges = _lag_bin_edges(self.ccg_params['max_lag'], self.ccg_params['bin_size'])
+
+        ccgs = compute_pair_correlograms(spike_times, pair_a, pair_b, bin_edges, n_jobs=self.n_jobs)
+
+        self.insert1({**key, 'ccg_bin_edges': bin_edges})
+        self.UnitPair.insert({**key, 'unit_a': unit_ids[a], 'unit_b': unit_ids[b],
+                              'site_distance': distances[a, b], 'ccg': ccg}
+                             for a, b, ccg in zip(pair_a, pair_b, ccgs))
+
+
+@schema
+class UnitSpikeHistogram(Versioned, dj.Computed):
+    definition = """  # log-binned inter-spike interval histograms and autocorrelograms of the units of a probe insertion
+    -> ProbeInsertion
+    ---
+    isi_bin_edges: longblob  # (s) log-spaced isi bin edges
+    acg_bin_edges: longblob  # (s) autocorrelogram lag bin edges
+    """
+
+    class Unit(dj.Part):
+        definition = """
+        -> master
+        -> Unit
+        ---
+        isi_hist: longblob  # isi counts per isi bin, on the continuous spike train
+        acg: longblob       # spike counts per lag bin around each spike (excluding the spike itself)
+        """
+
+    isi_hist_params = {'isi_min': 1e-4, 'isi_max': 10, 'bin_count': 100}  # (s), (s)
+    acg_params = {'max_lag': 0.05, 'bin_size': 0.001}  # (s), (s)
+    version_params = ('isi_hist_params', 'acg_params')
 
-    key_source = ProbeInsertion & experiment.SessionTrial.proj() - (experiment.SessionTrial * Unit - TrialSpikes.proj())
+    key_source = ProbeInsertion & Unit
 
     def make(self, key):
-        def make_insert():
-            for unit in (Unit & key).fetch('KEY'):
-                trial_spikes, tr_start, tr_stop = (TrialSpikes * experiment.SessionTrial & unit).fetch(
-                    'spike_times', 'start_time', 'stop_time')
-                isi = np.hstack(np.diff(spks) for spks in trial_spikes)
-                yield {**unit,
-                       'isi_violation': sum((isi < self.isi_violation_thresh).astype(int)) / len(isi) if isi.size else None,
-                       'avg_firing_rate': len(np.hstack(trial_spikes)) / sum(tr_stop - tr_start) if isi.size else None}
-        self.insert(make_insert())
+        unit_keys, spike_times = (Unit & key).fetch('KEY', 'spike_times')
+        spikes, spike_units = _concatenate_trains([np.sort(s) for s in spike_times])
+
+        isi_bin_edges = np.logspace(np.log10(self.isi_hist_params['isi_min']),
+                                    np.log10(self.isi_hist_params['isi_max']),
+                                    self.isi_hist_params['bin_count'] + 1)
+        isi_hists = compute_isi_histograms(spikes, spike_units, len(unit_keys), isi_bin_edges)
+
+        acg_bin_edges = _lag_bin_edges(self.acg_params['max_lag'], self.acg_params['bin_size'])
+        acgs = compute_autocorrelograms(spikes, spike_units, len(unit_keys), acg_bin_edges)
+
+        self.insert1({**key, 'isi_bin_edges': isi_bin_edges, 'acg_bin_edges': acg_bin_edges})
+        self.Unit.insert({**key, **unit, 'isi_hist': isi_hist, 'acg': acg}
+                         for unit, isi_hist, acg in zip(unit_keys, isi_hists, acgs))
+
+
+def _lag_bin_edges(max_lag, bin_size):
+    """
+    Lag bin edges from -max_lag to max_lag, with 0 as an exact edge
+    """
+    half_count = int(round(max_lag / bin_size))
+    return np.arange(-half_count, half_count + 1) * bin_size
+
+
+def compute_correlogram(spikes_a, spikes_b, bin_edges, chunk_size=10000):
+    """
+    Histogram of the lags (spikes_b - spikes_a) over all spike pairs, within the range of "bin_edges"
+    Each lag bin count is the difference of two cumulative counts (spikes_b before spike_a + edge),
+    obtained with searchsorted on the sorted spikes_b - O(n log n), without the pairwise difference matrix
+    """
+    spikes_a = np.asarray(spikes_a, dtype=float)
+    spikes_b = np.sort(np.asarray(spikes_b, dtype=float))
+    bin_edges = np.asarray(bin_edges, dtype=float)
+
+    cum_counts = np.zeros(len(bin_edges), dtype=np.int64)
+    for start in range(0, len(spikes_a), chunk_size):
+        chunk = spikes_a[start:start + chunk_size]
+        cum_counts += np.searchsorted(spikes_b, chunk[:, None] + bin_edges[None, :], side='left').sum(axis=0)
+
+    return np.diff(cum_counts)
+
+
+def _pair_correlograms(shard, bin_edges):
+    spike_times, pairs = shard
+    return [compute_correlogram(spike_times[a], spike_times[b], bin_edges) for a, b in pairs]
+
+
+def compute_pair_correlograms(spike_times, pair_a, pair_b, bin_edges, n_jobs=1, shard_count=None):
+    """
+    Cross-correlograms of the unit pairs (pair_a[i], pair_b[i]) - indices into "spike_times"
+    Pairs are sharded over "n_jobs" processes, each shard carrying only the spike trains it needs
+    """
+    pairs = list(zip(pair_a, pair_b))
+    if not pairs:
+        return []
+
+    shard_count = shard_count or (n_jobs * 4 if n_jobs > 1 else 1)
+    shards = []
+    for shard_pairs in np.array_split(np.array(pairs), min(shard_count, len(pairs))):
+        shard_units = set(shard_pairs.ravel())
+        shards.append(({u: spike_times[u] for u in shard_units}, shard_pairs))
+
+    return [ccg for shard_ccgs in map_chunks(_pair_correlograms, shards, (bin_edges,), n_jobs=n_jobs)
+            for ccg in shard_ccgs]
+
+
+def compute_isi_histograms(spikes, spike_units, unit_count, bin_edges):
+    """
+    ISI histograms of all units of CSR-flattened spike trains (each train sorted), with one bincount
+    - return (unit#, bin#)
+    """
+    bin_count = len(bin_edges) - 1
+    isi_units, isi = _within_train_isi(spikes, spike_units)
+
+    bins = np.searchsorted(bin_edges, isi, side='right') - 1
+    valid = np.logical_and(bins >= 0, bins < bin_count)
+
+    counts = np.bincount(isi_units[valid] * bin_count + bins[valid], minlength=unit_count * bin_count)
+    return counts.reshape(unit_count, bin_count)
+
+
+def compute_autocorrelograms(spikes, spike_units, unit_count, bin_edges, chunk_size=10000):
+    """
+    Autocorrelograms of all units of CSR-flattened spike trains (each train sorted) - return (unit#, bin#)
+    The trains are laid end to end, separated by more than the maximum lag, so that one searchsorted
+    on the whole array gives the cumulative lag counts of every spike (see compute_correlogram)
+    """
+    bin_count = len(bin_edges) - 1
+    if not len(spikes):
+        return np.zeros((unit_count, bin_count), dtype=np.int64)
+
+    gap = spikes.max() - spikes.min() + 2 * np.abs(bin_edges).max() + 1
+    laid_out = spikes + spike_units * gap
+
+    cum_counts = np.zeros((unit_count, len(bin_edges)), dtype=np.int64)
+    for start in range(0, len(spikes), chunk_size):
+        chunk, chunk_units = laid_out[start:start + chunk_size], spike_units[start:start + chunk_size]
+        chunk_counts = np.searchsorted(laid_out, chunk[:, None] + bin_edges[None, :], side='left')
+        unit_starts = np.flatnonzero(np.r_[True, chunk_units[1:] != chunk_units[:-1]])
+        cum_counts[chunk_units[unit_starts]] += np.add.reduceat(chunk_counts, unit_starts, axis=0)
+
+    acgs = np.diff(cum_counts, axis=1)
+
+    # remove each spike's zero-lag count with itself
+    zero_bin = np.searchsorted(bin_edges, 0, side='right') - 1
+    if 0 <= zero_bin < bin_count:
+        acgs[:, zero_bin] -= np.bincount(spike_units, minlength=unit_count)
+    return acgs
+
+
+def _mean_waveform(waveform):
+    """
+    Mean over spikes of a unit waveform (#spike x #time)
+    """
+    return (np.nanmean(waveform, axis=0) if np.ndim(waveform) == 2 and len(waveform)
+            else np.asarray(waveform, dtype=float).ravel())
+
+
+def _stack_waveforms(means):
+    """
+    Stack of the mean waveforms of units - return (unit#, time), NaN-padded to the longest
+    """
+    mean_waveforms = np.full((len(means), max([len(m) for m in means] + [0])), np.nan)
+    for i, m in enumerate(means):
+        mean_waveforms[i, :len(m)] = m
+    return mean_waveforms
+
+
+def compute_waveform_features(mean_waveforms, sample_rate, repolarization_window=0.3):
+    """
+    Trough-to-peak, half-width, peak ratio and repolarization slope of a stack of mean waveforms (unit#, time),
+    computed for all units at once - return {feature name: (unit#,)}, NaN for flat / empty waveforms
+    """
+    unit_count, sample_count = mean_waveforms.shape
+    ms_per_sample = 1000 / sample_rate
+    if not sample_count:
+        return {k: np.full(unit_count, np.nan)
+                for k in ('trough_to_peak', 'half_width', 'peak_ratio', 'repolarization_slope')}
+
+    # baseline (first sample) subtracted, padding set to baseline
+    wfs = np.nan_to_num(np.where(np.isnan(mean_waveforms), mean_waveforms[:, :1], mean_waveforms)
+                        - mean_waveforms[:, :1])
+    sample_idx = np.arange(sample_count)
+    rows = np.arange(unit_count)
+
+    trough = wfs.argmin(axis=1)
+    trough_amp = -wfs[rows, trough]
+    valid = trough_amp > 0
+
+    # post-trough peak
+    after_trough = sample_idx[None, :] > trough[:, None]
+    peak = np.where(after_trough, wfs, -np.inf).argmax(axis=1)
+    has_peak = trough < sample_count - 1
+
+    # half-width: extent of the samples around the trough below half the trough amplitude
+    above_half = wfs > -trough_amp[:, None] / 2
+    left = np.where(above_half & (sample_idx[None, :] < trough[:, None]), sample_idx, -1).max(axis=1)
+    right = np.where(above_half & after_trough, sample_idx, sample_count).min(axis=1)
+
+    # repolarization slope: least-square slope of the trough-normalized waveform after the trough
+    window_count = max(int(round(repolarization_window / ms_per_sample)), 2)
+    window_idx = np.minimum(trough[:, None] + np.arange(window_count), sample_count - 1)
+    window = wfs[rows[:, None], window_idx] / np.where(valid, trough_amp, 1)[:, None]
+    t = window_idx * ms_per_sample
+    t_centered = t - t.mean(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = (t_centered * window).sum(axis=1) / (t_centered ** 2).sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        features = {'trough_to_peak': np.where(has_peak, (peak - trough) * ms_per_sample, np.nan),
+                    'half_width': (right - left - 1) * ms_per_sample,
+                    'peak_ratio': np.where(has_peak, wfs[rows, peak] / trough_amp, np.nan),
+                    'repolarization_slope': slope}
+    return {k: np.where(valid, v, np.nan) for k, v in features.items()}
+
+
+def classify_trough_to_peak(trough_to_peak, fs_thresh=0.35, pyr_thresh=0.45):
+    """
+    'FS' for narrow, 'Pyr' for wide spikes, 'N/A' in between or unknown
+    """
+    return np.select([trough_to_peak < fs_thresh, trough_to_peak > pyr_thresh], ['FS', 'Pyr'], 'N/A')
+
+
+def _concatenate_trains(spike_trains):
+    """
+    Flatten a sequence of spike-time arrays into one array, with the per-spike train index (CSR layout)
+    """
+    spike_trains = [np.asarray(s, dtype=float).ravel() for s in spike_trains]
+    if not spike_trains:
+        return np.empty(0), np.empty(0, dtype=int)
+    rows = np.repeat(np.arange(len(spike_trains)), [len(s) for s in spike_trains])
+    return np.concatenate(spike_trains), rows
+
+
+def _within_train_isi(spikes, spike_rows):
+    """
+    Inter-spike intervals of CSR-flattened spike trains, excluding intervals across two trains
+    :return: train index of each isi, isi
+    """
+    same_train = spike_rows[1:] == spike_rows[:-1]
+    return spike_rows[1:][same_train], np.diff(spikes)[same_train]
+
+
+def _presence_ratio(spikes, spike_units, unit_count, bin_count):
+    """
+    Fraction of the recording bins (spanning all the spikes) in which each unit fires
+    """
+    if not len(spikes):
+        return np.full(unit_count, np.nan)
+    edges = np.linspace(spikes.min(), spikes.max(), bin_count + 1)
+    bins = np.clip(np.searchsorted(edges, spikes, side='right') - 1, 0, bin_count - 1)
+    counts = np.bincount(spike_units * bin_count + bins, minlength=unit_count * bin_count)
+    return (counts.reshape(unit_count, bin_count) > 0).mean(axis=1)
+
+
+def _spike_amplitudes(waveform):
+    """
+    Peak-to-peak amplitude of each spike of a unit waveform (#spike x #time) - empty for less than 2 spikes
+    """
+    return np.ptp(waveform, axis=1) if np.ndim(waveform) == 2 and len(waveform) > 1 else np.empty(0)
+
+
+def _amplitude_cutoff(amplitudes, bin_count, smoothing):
+    """
+    Estimated fraction of missing spikes from the (smoothed) spike amplitude distribution,
+    truncated by the detection threshold (Hill et al. 2011) - from the spike amplitudes of each unit
+    (see _spike_amplitudes). Histograms of all units are computed together, on per-unit normalized amplitudes
+    """
+    unit_count = len(amplitudes)
+    amps, amp_units = _concatenate_trains(amplitudes)
+    if not len(amps):
+        return np.full(unit_count, np.nan)
+
+    amp_min = np.full(unit_count, np.inf)
+    amp_max = np.full(unit_count, -np.inf)
+    np.minimum.at(amp_min, amp_units, amps)
+    np.maximum.at(amp_max, amp_units, amps)
+    amp_range = np.where(amp_max > amp_min, amp_max - amp_min, 1)
+
+    bins = np.clip(((amps - amp_min[amp_units]) / amp_range[amp_units] * bin_count).astype(int), 0, bin_count - 1)
+    counts = np.bincount(amp_units * bin_count + bins, minlength=unit_count * bin_count).reshape(unit_count, bin_count)
+    spike_counts = counts.sum(axis=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pdf = gaussian_filter1d(counts / spike_counts[:, None], smoothing, axis=1)
+
+    # first bin above the peak where the pdf drops back to its value at the lowest amplitude
+    peak = pdf.argmax(axis=1)
+    bin_idx = np.arange(bin_count)
+    dist_to_lowest = np.where(bin_idx >= peak[:, None], np.abs(pdf - pdf[:, :1]), np.inf)
+    cutoff = dist_to_lowest.argmin(axis=1)
+
+    fraction_missing = np.where(bin_idx >= cutoff[:, None], pdf, 0).sum(axis=1)
+    return np.where(spike_counts > 0, np.minimum(fraction_missing, 0.5), np.nan)
@@ -242,6 +242,68 @@ class ActionEvent(dj.Imported):
     action_event_time : decimal(8,4)  # (s) from trial start
     """
 
+
+@schema
+class TrialEventTimes(dj.Computed):
+    definition = """  # first occurrence of each trial event, and the first lick, in a trial - (s) from trial start
+    -> BehaviorTrial
+    ---
+    presample_time=null: double
+    sample_time=null: double
+    delay_time=null: double
+    go_time=null: double
+    trialend_time=null: double
+    first_lick_time=null: double
+    """
+
+    # all trials of a session are pivoted together
+    key_source = Session & BehaviorTrial
+
+    trial_event_types = ('presample', 'sample', 'delay', 'go', 'trialend')
+
+    def make(self, key):
+        trial_keys = (BehaviorTrial & key).fetch('KEY', order_by='trial')
+        trial_idx = {k['trial']: i for i, k in enumerate(trial_keys)}
+
+        event_times = {e: np.full(len(trial_keys), np.nan) for e in self.trial_event_types + ('first_lick',)}
+
+        trials, event_types, times = (TrialEvent & key).fetch(
+            'trial', 'trial_event_type', 'trial_event_time')
+        for event_type in self.trial_event_types:
+            is_event = event_types == event_type
+            np.fmin.at(event_times[event_type],
+                       [trial_idx[t] for t in trials[is_event]], times[is_event].astype(float))
+
+        trials, times = (ActionEvent & key & 'action_event_type in ("left lick", "right lick")').fetch(
+            'trial', 'action_event_time')
+        np.fmin.at(event_times['first_lick'], [trial_idx[t] for t in trials], times.astype(float))
+
+        self.insert({**k, **{self.event_attr(e): (None if np.isnan(t[i]) else t[i]) for e, t in event_times.items()}}
+                    for i, k in enumerate(trial_keys))
+
+    @staticmethod
+    def event_attr(event):
+        return event + '_time'
+
+    @classmethod
+    def get_event_times(cls, restriction, events=('sample', 'delay', 'go'), relative_to=None):
+        """
+        Event times of all the trials in "restriction", from a single fetch
+        :param events: trial event types, or 'first_lick'
+        :param relative_to: an event to align to (e.g. 'go') - event times are from trial start if None
+        :return: trial keys, (trial# x event#) event times - NaN for events not found in a trial
+        """
+        events = list(events)
+        attrs = [cls.event_attr(e) for e in events + ([relative_to] if relative_to else [])]
+
+        trial_keys, *times = (cls & restriction).fetch('KEY', *attrs, order_by='subject_id, session, trial')
+        times = np.array([t.astype(float) for t in times]).reshape(len(attrs), len(trial_keys)).T
+
+        if relative_to:
+            times = times[:, :-1] - times[:, -1:]
+        return trial_keys, times
+
+
 # ---- Photostim trials ----
 
 @schema
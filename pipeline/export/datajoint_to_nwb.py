@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
+'''
+Export the sessions to NWB 2.0 files, one file per session
+
+    python pipeline/export/datajoint_to_nwb.py [NWB_OUTPUT_DIR] [-j WORKERS] [--max-writers N] [--overwrite]
+
+Sessions are exported by a pool of worker processes, each with its own database connection. Files are
+written to a temporary file in the output directory and renamed once complete, so that an interrupted
+export never leaves a partial .nwb file; at most "--max-writers" files are written at the same time.
+'''
 import os, sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
+import time
+import argparse
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from dateutil.tz import tzlocal
 import pytz
-import re
 import numpy as np
 import json
 import pandas as pd
 
+import datajoint as dj
 from pipeline import (lab, experiment, ephys, psth, tracking, virus)
 import pynwb
 from pynwb import NWBFile, NWBHDF5IO
+from pynwb.core import DynamicTable, DynamicTableRegion, VectorData, VectorIndex
+from pynwb.epoch import TimeIntervals
+from pynwb.misc import Units
 
 # ============================== SET CONSTANTS ==========================================
 default_nwb_output_dir = os.path.join('data', 'NWB 2.0')
@@ -20,6 +36,22 @@ zero_zero_time = datetime.strptime('00:00:00', '%H:%M:%S').time()  # no precise
 hardware_filter = 'Bandpass filtered 300-6K Hz'
 institution = 'Janelia Research Campus'
 
+# unit table columns: (name, Unit attribute, description) - in addition to the standard NWB Units columns
+unit_columns = (('quality', 'unit_quality', 'unit quality from clustering'),
+                ('posx', 'unit_posx', 'estimated x position of the unit relative to probe (0,0)'),
+                ('posy', 'unit_posy', 'estimated y position of the unit relative to probe (0,0)'),
+                ('amp', 'unit_amp', 'unit amplitude'),
+                ('snr', 'unit_snr', 'unit signal-to-noise'),
+                ('cell_type', 'cell_type', 'cell type (e.g. fast spiking or pyramidal)'))
+
+_writer_lock = None  # bounds the concurrent file writes of the export workers
+
+
+def get_nwb_file_name(session):
+    return '_'.join(['ANM' + str(session['subject_id']),
+                     session['session_date'].strftime('%Y-%m-%d'),
+                     str(session['session'])]) + '.nwb'
+
 
 def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False, overwrite=False):
 
@@ -30,10 +62,7 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
     # ===============================================================================
 
     # -- NWB file - a NWB2.0 file for each session
-    nwbfile = NWBFile(identifier='_'.join(
-        ['ANM' + str(this_session['subject_id']),
-         this_session['session_date'].strftime('%Y-%m-%d'),
-         str(this_session['session'])]),
+    nwbfile = NWBFile(identifier=os.path.splitext(get_nwb_file_name(this_session))[0],
         session_description='',
         session_start_time=datetime.combine(this_session['session_date'], zero_zero_time),
         file_create_date=datetime.now(tzlocal()),
@@ -64,6 +93,10 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
 
     dj_insert_location = ephys.ProbeInsertion.InsertionLocation * experiment.BrainLocation
 
+    # electrodes and units are fetched column-wise per probe insertion, then added as whole tables
+    electrodes, units = [], []
+    electrode_count = 0
+
     for probe_insertion in ephys.ProbeInsertion & session_key:
         electrode_config = (lab.ElectrodeConfig & probe_insertion).fetch1()
 
@@ -76,38 +109,29 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
                 location=json.dumps({k: str(v) for k, v in (dj_insert_location & session_key).fetch1().items()
                                      if k not in dj_insert_location.primary_key}))
 
-        for chn in (lab.ElectrodeConfig.Electrode * lab.Probe.Electrode & electrode_config).fetch(as_dict=True):
-            nwbfile.add_electrode(id=chn['electrode'],
-                                  group=electrode_groups[chn['electrode_group']],
-                                  filtering=hardware_filter,
-                                  imp=-1.,
-                                  x=chn['x_coord'] if chn['x_coord'] else np.nan,
-                                  y=chn['y_coord'] if chn['y_coord'] else np.nan,
-                                  z=chn['z_coord'] if chn['z_coord'] else np.nan,
-                                  location=electrode_groups[chn['electrode_group']].location)
+        chn = dict(zip(('id', 'electrode_group', 'x', 'y', 'z'), (
+            lab.ElectrodeConfig.Electrode * lab.Probe.Electrode & electrode_config).fetch(
+            'electrode', 'electrode_group', 'x_coord', 'y_coord', 'z_coord', order_by='electrode')))
+        chn['group'] = [electrode_groups[g] for g in chn['electrode_group']]
+        electrodes.append(chn)
 
         # --- unit spike times ---
-        nwbfile.add_unit_column(name='quality', description='unit quality from clustering')
-        nwbfile.add_unit_column(name='posx', description='estimated x position of the unit relative to probe (0,0)')
-        nwbfile.add_unit_column(name='posy', description='estimated y position of the unit relative to probe (0,0)')
-        nwbfile.add_unit_column(name='amp', description='unit amplitude')
-        nwbfile.add_unit_column(name='snr', description='unit signal-to-noise')
-        nwbfile.add_unit_column(name='cell_type', description='cell type (e.g. fast spiking or pyramidal)')
-
-        for unit in (ephys.Unit * ephys.UnitCellType & probe_insertion).fetch(as_dict=True):
-            # make an electrode table region (which electrode(s) is this unit coming from)
-            nwbfile.add_unit(id=unit['unit'],
-                             electrodes=[unit['electrode']],
-                             electrode_group=electrode_groups[unit['electrode_group']],
-                             quality=unit['unit_quality'],
-                             posx=unit['unit_posx'],
-                             posy=unit['unit_posy'],
-                             amp=unit['unit_amp'] if unit['unit_amp'] else np.nan,
-                             snr=unit['unit_snr'] if unit['unit_amp'] else np.nan,
-                             cell_type=unit['cell_type'],
-                             spike_times=unit['spike_times'],
-                             waveform_mean=np.mean(unit['waveform'], axis=0),
-                             waveform_sd=np.std(unit['waveform'], axis=0))
+        unit_attrs = ['unit', 'electrode', 'electrode_group', 'spike_times', 'waveform'] + [
+            attr for _, attr, _ in unit_columns]
+        unit = dict(zip(unit_attrs, (ephys.Unit * ephys.UnitCellType & probe_insertion).fetch(
+            *unit_attrs, order_by='unit')))
+        # electrode table region (which electrode(s) is this unit coming from): row index of the unit electrode
+        electrode_rows = {e: electrode_count + i for i, e in enumerate(chn['id'])}
+        unit['electrode'] = [electrode_rows[e] for e in unit['electrode']]
+        unit['electrode_group'] = [electrode_groups[g] for g in unit['electrode_group']]
+        units.append(unit)
+
+        electrode_count += len(chn['id'])
+
+    if electrodes:
+        nwbfile.electrodes = make_electrode_table(electrodes)
+        if sum(len(unit['unit']) for unit in units):
+            nwbfile.units = make_unit_table(units, nwbfile.electrodes)
 
     # ===============================================================================
     # ============================= BEHAVIOR TRACKING ===============================
@@ -179,24 +203,9 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
     dj_trial = experiment.SessionTrial * experiment.BehaviorTrial
     skip_adding_columns = experiment.Session.primary_key + ['trial_uid']
 
-    if experiment.SessionTrial & session_key:
-        # Get trial descriptors from TrialSet.Trial and TrialStimInfo
-        trial_columns = [{'name': tag,
-                          'description': re.sub('\s+:|\s+', ' ', re.search(
-                              f'(?<={tag})(.*)', str(dj_trial.heading)).group()).strip()}
-                         for tag in dj_trial.heading.names
-                         if tag not in skip_adding_columns + ['start_time', 'stop_time']]
-
-        # Add new table columns to nwb trial-table for trial-label
-        for c in trial_columns:
-            nwbfile.add_trial_column(**c)
-
-        # Add entry to the trial-table
-        for trial in (dj_trial & session_key).fetch(as_dict=True):
-            trial['start_time'] = float(trial['start_time'])
-            trial['stop_time'] = float(trial['stop_time']) if trial['stop_time'] else 5.0
-            [trial.pop(k) for k in skip_adding_columns]
-            nwbfile.add_trial(**trial)
+    trials = (dj_trial & session_key).fetch(format='array', order_by='trial')
+    if len(trials):
+        nwbfile.trials = make_trial_table(trials, dj_trial.heading, skip_adding_columns)
 
     # ===============================================================================
     # =============================== BEHAVIOR TRIAL EVENTS ==========================
@@ -231,25 +240,195 @@ def export_to_nwb(session_key, nwb_output_dir=default_nwb_output_dir, save=False
 
     # =============== Write NWB 2.0 file ===============
     if save:
-        save_file_name = ''.join([nwbfile.identifier, '.nwb'])
-        if not os.path.exists(nwb_output_dir):
-            os.makedirs(nwb_output_dir)
-        if not overwrite and os.path.exists(os.path.join(nwb_output_dir, save_file_name)):
-            return nwbfile
-        with NWBHDF5IO(os.path.join(nwb_output_dir, save_file_name), mode = 'w') as io:
-            io.write(nwbfile)
-            print(f'Write NWB 2.0 file: {save_file_name}')
+        write_nwb_file(nwbfile, nwb_output_dir, overwrite=overwrite)
 
     return nwbfile
 
 
+def _float_column(values, default=np.nan):
+    """
+    values as a float array, with "default" in place of the null (or zero) values
+    """
+    values = np.asarray(values, dtype=object)
+    return np.where(values.astype(bool), values, default).astype(float)
+
+
+def make_electrode_table(electrodes):
+    """
+    Build the NWB electrodes table in one go from the per-probe {column: values} of "electrodes"
+    """
+    group = [g for chn in electrodes for g in chn['group']]
+    data = {'x': _float_column(np.hstack([chn['x'] for chn in electrodes])),
+            'y': _float_column(np.hstack([chn['y'] for chn in electrodes])),
+            'z': _float_column(np.hstack([chn['z'] for chn in electrodes])),
+            'imp': np.full(len(group), -1.),
+            'location': [g.location for g in group],
+            'filtering': [hardware_filter] * len(group),
+            'group': group,
+            'group_name': [g.name for g in group]}
+
+    electrode_table = pynwb.file.ElectrodeTable()  # for the standard column names and descriptions
+    return DynamicTable(name=electrode_table.name, description=electrode_table.description,
+                        id=np.hstack([chn['id'] for chn in electrodes]).astype(int).tolist(),
+                        columns=[VectorData(c.name, c.description, data=data[c.name])
+                                 for c in electrode_table.columns])
+
+
+def make_unit_table(units, electrode_table):
+    """
+    Build the NWB units table in one go from the per-probe {Unit attribute: values} of "units" -
+    with the electrodes column referencing rows of "electrode_table"
+    """
+    description = {c['name']: c['description'] for c in Units.__columns__}
+    spike_times = [s for unit in units for s in unit['spike_times']]
+    waveform = [w for unit in units for w in unit['waveform']]
+    electrode = np.hstack([unit['electrode'] for unit in units]).astype(int)
+
+    spike_times_data = VectorData('spike_times', description['spike_times'], data=np.hstack(spike_times))
+    electrodes_data = DynamicTableRegion('electrodes', electrode.tolist(), description['electrodes'],
+                                         table=electrode_table)
+    columns = [VectorIndex('spike_times_index', np.cumsum([len(s) for s in spike_times]).tolist(),
+                           target=spike_times_data),
+               spike_times_data,
+               VectorIndex('electrodes_index', list(range(1, len(electrode) + 1)), target=electrodes_data),
+               electrodes_data,
+               VectorData('electrode_group', description['electrode_group'],
+                          data=[g for unit in units for g in unit['electrode_group']]),
+               VectorData('waveform_mean', description['waveform_mean'],
+                          data=[np.mean(w, axis=0) for w in waveform]),
+               VectorData('waveform_sd', description['waveform_sd'],
+                          data=[np.std(w, axis=0) for w in waveform])]
+
+    for name, attr, column_description in unit_columns:
+        data = np.hstack([unit[attr] for unit in units])
+        columns.append(VectorData(name, column_description,
+                                  data=_float_column(data) if name in ('amp', 'snr') else data.tolist()))
+
+    return Units(name='units', id=np.hstack([unit['unit'] for unit in units]).astype(int).tolist(),
+                 columns=columns)
+
+
+def make_trial_table(trials, heading, skip_adding_columns=()):
+    """
+    Build the NWB trials table in one go from the "trials" array fetched from the query of "heading" -
+    with a column per attribute not in "skip_adding_columns", described by the attribute comment
+    """
+    description = {c['name']: c['description'] for c in TimeIntervals.__columns__}
+    columns = [VectorData('start_time', description['start_time'], data=trials['start_time'].astype(float)),
+               VectorData('stop_time', description['stop_time'],
+                          data=_float_column(trials['stop_time'], default=5.0))]
+    columns += [VectorData(name, heading.attributes[name].comment or name, data=trials[name].tolist())
+                for name in heading.names if name not in list(skip_adding_columns) + ['start_time', 'stop_time']]
+
+    return TimeIntervals('trials', 'experimental trials', columns=columns)
+
+
+def write_nwb_file(nwbfile, nwb_output_dir=default_nwb_output_dir, overwrite=False):
+    """
+    Write "nwbfile" to nwb_output_dir/<identifier>.nwb - through a temporary file renamed once written,
+    so that the .nwb file is either complete or absent.
+    Return the file path, or None if the file exists and not "overwrite"
+    """
+    save_file_name = ''.join([nwbfile.identifier, '.nwb'])
+    save_path = os.path.join(nwb_output_dir, save_file_name)
+    os.makedirs(nwb_output_dir, exist_ok=True)
+    if not overwrite and os.path.exists(save_path):
+        return None
+
+    tmp_path = os.path.join(nwb_output_dir, '.{}.{}.tmp'.format(save_file_name, os.getpid()))
+    try:
+        with NWBHDF5IO(tmp_path, mode='w') as io:
+            io.write(nwbfile)
+        os.replace(tmp_path, save_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    print(f'Write NWB 2.0 file: {save_file_name}')
+    return save_path
+
+
 # ============================== EXPORT ALL ==========================================
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        nwb_outdir = sys.argv[1]
+def _init_export_worker(writer_lock):
+    global _writer_lock
+    _writer_lock = writer_lock
+    dj.conn(reset=True)
+
+
+def _export_session(session_key, nwb_output_dir, overwrite=False):
+    """
+    Worker: export one session - return (session_key, file path or None if skipped, file bytes, seconds)
+    """
+    start = time.time()
+    save_path = os.path.join(nwb_output_dir, get_nwb_file_name((experiment.Session & session_key).fetch1()))
+    if not overwrite and os.path.exists(save_path):
+        return session_key, None, 0, time.time() - start
+
+    nwbfile = export_to_nwb(session_key, nwb_output_dir=nwb_output_dir)
+    if _writer_lock is None:
+        save_path = write_nwb_file(nwbfile, nwb_output_dir, overwrite=overwrite)
+    else:
+        with _writer_lock:
+            save_path = write_nwb_file(nwbfile, nwb_output_dir, overwrite=overwrite)
+
+    return session_key, save_path, os.path.getsize(save_path) if save_path else 0, time.time() - start
+
+
+def export_sessions(session_keys, nwb_output_dir=default_nwb_output_dir, worker_count=1, max_writers=2,
+                    overwrite=False):
+    """
+    Export "session_keys" to NWB files with "worker_count" processes, at most "max_writers" writing at a time,
+    and print a summary of the files written, bytes and seconds.
+    Return the list of (session_key, file path or None if skipped, file bytes, seconds) of the exported sessions
+    """
+    start = time.time()
+    results, failed = [], []
+
+    if worker_count == 1:
+        for session_key in session_keys:
+            try:
+                results.append(_export_session(session_key, nwb_output_dir, overwrite))
+            except Exception as e:
+                print(f'Error exporting session {session_key}: {e!r}')
+                failed.append(session_key)
     else:
-        nwb_outdir = default_nwb_output_dir
+        ctx = mp.get_context('spawn')  # fresh interpreter and database connection per worker
+        with ProcessPoolExecutor(max_workers=worker_count, mp_context=ctx, initializer=_init_export_worker,
+                                 initargs=(ctx.Semaphore(max_writers),)) as executor:
+            futures = {executor.submit(_export_session, session_key, nwb_output_dir, overwrite): session_key
+                       for session_key in session_keys}
+            for future in as_completed(futures):
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    print(f'Error exporting session {futures[future]}: {e!r}')
+                    failed.append(futures[future])
+
+    written = [r for r in results if r[1] is not None]
+    print('NWB export: {} files written ({:.1f} MB), {} skipped (existing), {} failed - '
+          '{:.1f}s elapsed, {:.1f}s export time'.format(
+              len(written), sum(r[2] for r in written) / 1e6, len(results) - len(written), len(failed),
+              time.time() - start, sum(r[3] for r in written)))
+    return results
+
 
-    for skey in experiment.Session.fetch('KEY'):
-        export_to_nwb(skey, nwb_output_dir=nwb_outdir, save=True)
+# ============================== EXPORT ALL ==========================================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the sessions to NWB 2.0 files')
+    parser.add_argument('nwb_output_dir', nargs='?', default=default_nwb_output_dir,
+                        help='output directory (default: {})'.format(default_nwb_output_dir))
+    parser.add_argument('-j', '--workers', type=int, default=max(1, mp.cpu_count() - 1),
+                        help='worker processes (default: cpu count - 1)')
+    parser.add_argument('--max-writers', type=int, default=2,
+                        help='maximum files written at the same time (default: 2)')
+    parser.add_argument('--overwrite', action='store_true',
+                        help='re-export the sessions whose file exists')
+    args = parser.parse_args(argv)
+
+    export_sessions(experiment.Session.fetch('KEY'), nwb_output_dir=args.nwb_output_dir,
+                    worker_count=args.workers, max_writers=args.max_writers, overwrite=args.overwrite)
+
+
+if __name__ == '__main__':
+    main()
@@ -182,9 +182,10 @@ def main(data_dir='./data/data_structure'):
         e_sites = {e: (y - ap, z - dv) for e, y, z in
                    zip(*(ephys.ProbeInsertion.ElectrodeSitePosition & session_key).fetch(
                        'electrode', 'electrode_posy', 'electrode_posz'))}
-        tr_events = {tr: (float(stime), float(gotime)) for tr, stime, gotime in
-                     zip(*(experiment.SessionTrial * experiment.TrialEvent
-                           & session_key & 'trial_event_type = "go"').fetch('trial', 'start_time', 'trial_event_time'))}
+        experiment.TrialEventTimes.populate(session_key)
+        tr_events = {tr: (float(stime), gotime) for tr, stime, gotime in
+                     zip(*(experiment.SessionTrial * experiment.TrialEventTimes
+                           & session_key & 'go_time is not NULL').fetch('trial', 'start_time', 'go_time'))}
 
         print('---- Ingesting spike data ----')
         unit_spikes, unit_cell_types, trial_spikes = [], [], []
@@ -209,6 +210,8 @@ def main(data_dir='./data/data_structure'):
         ephys.Unit.insert(unit_spikes, **insert_kwargs)
         ephys.UnitCellType.insert(unit_cell_types, **insert_kwargs)
         ephys.TrialSpikes.insert(trial_spikes, **insert_kwargs)
+        ephys.TrialSpikesIngestion.insert1(dict(insert_key, unit_count=len(unit_spikes),
+                                                trial_spikes_count=len(trial_spikes)), **insert_kwargs)
 
 
 if __name__ == '__main__':
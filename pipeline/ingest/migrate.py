@@ -0,0 +1,49 @@
+'''
+Bring an existing database up to date with the table definitions of the pipeline modules
+
+    python pipeline/ingest/migrate.py
+
++ alter the tables whose secondary attributes changed since they were declared (dj Table.alter)
++ backfill the tables added since the sessions were ingested (the ingestion scripts fill them for new sessions):
+  the ephys.TrialSpikesIngestion markers of the ingested probe insertions - without them ephys.UnitStat has no
+  key to populate - and experiment.TrialEventTimes
++ mark the units with all their PeriodSelectivity periods (psth.PeriodSelectivityCompletion) - without them
+  psth.UnitSelectivity has no key to populate
+
+The UnitStat rows made before its quality metrics were added have them null - they are recomputed with
+    python pipeline/ingest/populate.py --recompute-stale --include-unversioned --tables ephys.UnitStat
+'''
+
+import os
+import sys
+import logging
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+from pipeline import experiment, ephys, psth
+
+log = logging.getLogger(__name__)
+
+# tables altered in place to their current definition
+altered_tables = (ephys.UnitStat,)  # + isi_violation_rate, presence_ratio, amplitude_cutoff (nullable)
+
+
+def alter_tables(tables=altered_tables):
+    for table in tables:
+        log.info('Altering {}'.format(table.full_table_name))
+        table().alter(prompt=False, context=vars(sys.modules[table.__module__]))
+
+
+def backfill():
+    log.info('Marking the TrialSpikes ingestion of the existing probe insertions (ephys.TrialSpikesIngestion)')
+    ephys.TrialSpikesIngestion.backfill()
+    log.info('Populating experiment.TrialEventTimes of the existing sessions')
+    experiment.TrialEventTimes.populate(reserve_jobs=True, suppress_errors=True, display_progress=True)
+    log.info('Marking the units with all their PeriodSelectivity periods (psth.PeriodSelectivityCompletion)')
+    psth.PeriodSelectivityCompletion.backfill()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    alter_tables()
+    backfill()
@@ -1,13 +1,553 @@
-import os, sys
+'''
+Populate the computed tables of the pipeline with a pool of worker processes
+
+    python pipeline/ingest/populate.py [-j WORKERS] [--memory-limit 4G] [--tables psth.UnitPsth ... | --all-tables]
+    python pipeline/ingest/populate.py --plan [-j WORKERS] [--tables ...]
+    python pipeline/ingest/populate.py --recompute-stale [--plan] [--yes] [--tables ...]
+
+By default the tables of populate.default_tables are populated (TrialEventTimes, UnitPsth, PeriodSelectivity,
+UnitSelectivity); "--all-tables" selects all the computed tables, including the costly ones.
+
+Workers reserve their keys in the schema jobs tables (reserve_jobs=True), so the same command can be
+started on several machines sharing the database. Crashed workers (e.g. killed for exceeding their
+memory budget) are restarted while keys are left to populate.
+
+By default ("pipelined" mode) the tables are scheduled from the schema dependency graph: workers run
+short populate passes on any table that has keys ready, downstream tables first, so that downstream keys
+are populated as soon as their key_source is satisfied instead of after the whole upstream table.
+"--mode sequential" populates the tables one after the other, in dependency order.
+
+"--recompute-stale" recomputes the rows made with other parameters or code than the current ones, and the rows
+depending on them by foreign key or by "fetched_tables" (see compute.MakeProvenance) - after a confirmation prompt,
+skipped with "--yes" for unattended runs.
+
+"--plan" only reports the work left (no make is run): pending keys per table, the upstream rows and blob bytes
+they read, the time taken to evaluate the key_source, and the projected run time from the past make durations
+recorded in compute.MakeStats - by the populate runs of this script, and by BatchPopulate.populate. The tables
+never populated since are reported with an unknown run time.
+'''
+
+import os
+import sys
+import math
+import time
+import logging
+import argparse
+import importlib
+import resource
+import multiprocessing as mp
+import queue
+from collections import OrderedDict
+
 sys.path.append(os.path.join(os.path.dirname(__file__), '..', '..'))
 
-from pipeline import psth
+import datajoint as dj
+import networkx as nx
+from datajoint.hash import key_hash
+from datajoint.utils import user_choice
+
+from pipeline.compute import MakeStats, MakeStatsRecorder
+
+log = logging.getLogger(__name__)
+
+settings = {'reserve_jobs': True, 'suppress_errors': True, 'display_progress': False, 'order': 'random'}
+
+default_modules = ('experiment', 'ephys', 'psth')
+
+# populated by default - the other tables (e.g. the costly psth.UnitAlignedPsth, ephys.CrossCorrelogram,
+# psth.NoiseCorrelation) are populated on request (--tables, or --all-tables)
+default_tables = ('experiment.TrialEventTimes', 'psth.UnitPsth', 'psth.PeriodSelectivity', 'psth.UnitSelectivity')
+
+
+def get_module(table_name):
+    return importlib.import_module('pipeline.' + table_name.rsplit('.', 1)[0])
+
+
+def get_table(table_name):
+    """
+    Table class from its "module.Class" name, e.g. "psth.UnitPsth"
+    """
+    return getattr(get_module(table_name), table_name.rsplit('.', 1)[1])
+
+
+def get_populated_tables(modules=default_modules):
+    """
+    "module.Class" names of the auto-populated tables (with a make or make_batch method) of the specified modules
+    """
+    table_names = []
+    for module_name in modules:
+        module = importlib.import_module('pipeline.' + module_name)
+        table_names += ['{}.{}'.format(module_name, name) for name, cls in vars(module).items()
+                        if isinstance(cls, type) and issubclass(cls, (dj.Computed, dj.Imported))
+                        and cls.__module__ == module.__name__
+                        and ('make' in vars(cls) or 'make_batch' in vars(cls))]
+    return table_names
+
+
+def get_dependency_graph(table_names):
+    """
+    Graph of the schema dependencies (foreign keys), plus an edge from each of their "fetched_tables"
+    (read by make, e.g. PeriodSelectivity for UnitSelectivity) to each of the tables of table_names
+    """
+    dj.conn().dependencies.load()
+    dependencies = nx.DiGraph(dj.conn().dependencies)
+    for table_name in table_names:
+        table = get_table(table_name)
+        dependencies.add_edges_from((t.full_table_name, table.full_table_name)
+                                    for t in getattr(table, 'fetched_tables', ()))
+    return dependencies
+
+
+def get_upstream_tables(table_names):
+    """
+    Sort tables in dependency order - return {table name: set(names of its upstream tables among table_names)}
+    Besides foreign keys, a table depends on its "fetched_tables" (see get_dependency_graph)
+    """
+    dependencies = get_dependency_graph(table_names)
+    full_names = {get_table(t).full_table_name: t for t in table_names}
+    order = [full_names[n] for n in nx.topological_sort(dependencies) if n in full_names]
+
+    return {t: {full_names[n] for n in nx.ancestors(dependencies, get_table(t).full_table_name) if n in full_names}
+            for t in order}
+
+
+def parse_memory(text):
+    """
+    Memory size in bytes, from e.g. "512M", "4G" or a number of bytes
+    """
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = str(text).strip().upper()
+    return int(float(text[:-1]) * units[text[-1]]) if text[-1] in units else int(text)
+
+
+def record_make_stats(table):
+    """
+    Record the MakeStats of the make calls of a table instance - the batched tables (make_batch) record their own.
+    The statistics are inserted in the transaction of the make call: only the successful calls are recorded
+    """
+    make = table.make
+
+    def measured_make(key):
+        stats = MakeStatsRecorder(table.connection)
+        with stats:
+            make(key)
+        stats.save(table.target, [key])
+
+    table.make = measured_make
+
+
+def populate(table, populate_settings=settings, **kwargs):
+    """
+    table.populate(**populate_settings), recording the MakeStats of the tables without make_batch -
+    order='cost' is only supported by the batched tables, other tables are populated in random order
+    """
+    table = table() if isinstance(table, type) else table
+    if not hasattr(table, 'make_batch'):
+        record_make_stats(table)
+        if populate_settings.get('order') == 'cost':
+            populate_settings = {**populate_settings, 'order': 'random'}
+    return table.populate(**populate_settings, **kwargs)
+
+
+def populate_pass(table_name, populate_settings=settings, **kwargs):
+    """
+    Populate "table_name" - return the number of keys made by this process (a difference of row counts would
+    include the rows inserted meanwhile by the other workers)
+    """
+    table = get_table(table_name)()
+    made = []
+    make_name = 'make_batch' if hasattr(table, 'make_batch') else 'make'
+    make = getattr(table, make_name)
+
+    def counted_make(keys):
+        make(keys)
+        made.extend(keys if make_name == 'make_batch' else [keys])
+
+    setattr(table, make_name, counted_make)
+    populate(table, populate_settings, **kwargs)
+    return len(made)
+
+
+def populate_worker(table_name, memory_limit=None, populate_settings=settings):
+    """
+    Worker process: populate "table_name" until no key is left to reserve
+    """
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    dj.conn(reset=True)
+    populate(get_table(table_name), populate_settings)
+
+
+def pipeline_worker(worker_id, tasks, results, memory_limit=None, populate_settings=settings):
+    """
+    Worker process: run a populate pass of at most "max_calls" make calls for each (table name, max_calls) task,
+    and report (worker_id, table name, number of keys made) - until a None task is received
+    """
+    if memory_limit:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+    dj.conn(reset=True)
+    for table_name, max_calls in iter(tasks.get, None):
+        results.put((worker_id, table_name, populate_pass(table_name, populate_settings, max_calls=max_calls)))
+
+
+def get_progress(table_name):
+    """
+    (remaining, total) keys of a table
+    """
+    return get_table(table_name)().progress(display=False)
+
+
+def get_error_count(table_name):
+    return len(get_module(table_name).schema.jobs
+               & {'table_name': get_table(table_name).table_name, 'status': 'error'})
+
+
+class ProgressReport:
+    """
+    Aggregate throughput (keys / s) and ETA of a table being populated, possibly by several machines
+    """
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.start_time = time.time()
+        remaining, self.total = get_progress(table_name)
+        self.start_done = self.total - remaining  # the total may grow as upstream tables are populated
+
+    @property
+    def remaining(self):
+        remaining, self.total = get_progress(self.table_name)
+        return remaining
+
+    def __str__(self):
+        remaining = self.remaining
+        elapsed = time.time() - self.start_time
+        rate = (self.total - remaining - self.start_done) / elapsed if elapsed else 0
+        eta = time.strftime('%H:%M:%S', time.gmtime(remaining / rate)) if rate > 0 else '--:--:--'
+        return '{}: {}/{} done - {:.2f} keys/s - {} errors - ETA {}'.format(
+            self.table_name, self.total - remaining, self.total, rate, get_error_count(self.table_name), eta)
+
+
+def get_pending(table):
+    """
+    Keys of the table's key_source not populated yet
+    """
+    key_source = table().key_source
+    if isinstance(key_source, type):
+        key_source = key_source()
+    return key_source.proj() - table()
+
+
+def get_blob_size(query, sample_size=100):
+    """
+    Mean serialized size (bytes) of the blobs of a row, from a sample of "sample_size" rows
+    """
+    blobs = query.heading.blobs
+    if not blobs:
+        return 0
+    sizes = query.proj(blob_size=' + '.join('ifnull(length(`{}`), 0)'.format(b) for b in blobs)).fetch(
+        'blob_size', limit=sample_size)
+    return float(sizes.astype(float).mean()) if len(sizes) else 0
+
+
+def plan_table(table_name, sample_size=100):
+    """
+    Work left to populate a table, without running make:
+    + key count, pending key count and the time taken to evaluate them (key_source cost)
+    + rows and estimated blob bytes of the upstream tables read by the pending keys - the parent tables,
+      and the table's "fetched_tables" (e.g. TrialSpikes)
+    + past make duration per key (compute.MakeStats), None if never recorded
+    """
+    table = get_table(table_name)
+
+    start_time = time.time()
+    pending_count, total = table().progress(display=False)
+    key_source_time = time.time() - start_time
+
+    pending = get_pending(table)
+    sources = table().parents(as_objects=True) + [t() for t in getattr(table, 'fetched_tables', ())]
+    upstream = []
+    for source in sources:
+        rows = len(source & pending) if pending_count else 0
+        blob_bytes = rows * get_blob_size(source & pending, sample_size) if rows else 0
+        upstream.append((source.full_table_name, rows, blob_bytes))
+
+    time_per_key = (dj.U().aggr(MakeStats & {'table_name': table.full_table_name} & 'success',
+                                time_per_key='sum(wall_time) / sum(key_count)')).fetch1('time_per_key')
+    time_per_key = None if time_per_key is None or math.isnan(time_per_key) else float(time_per_key)
+
+    return {'table_name': table_name, 'total': total, 'pending': pending_count, 'key_source_time': key_source_time,
+            'upstream': upstream, 'time_per_key': time_per_key}
+
+
+def print_plan(table_names, worker_count=1, sample_size=100):
+    """
+    Report the work left for the tables, in dependency order - see plan_table
+    """
+    total_time = 0
+    for table_name in get_upstream_tables(table_names):
+        plan = plan_table(table_name, sample_size)
+        projected = plan['time_per_key'] * plan['pending'] if plan['time_per_key'] is not None else None
+        total_time += projected or 0
+
+        print('{}: {}/{} keys pending - key_source evaluated in {:.1f} s - projected run time: {}'.format(
+            table_name, plan['pending'], plan['total'], plan['key_source_time'],
+            '{:.1f} h ({:.3f} s/key, {} workers)'.format(
+                projected / worker_count / 3600, plan['time_per_key'], worker_count)
+            if projected is not None else 'unknown (no make recorded in compute.MakeStats)'), flush=True)
+        for source, rows, blob_bytes in plan['upstream']:
+            print('    reads {}: {} rows, ~{:.1f} MB of blobs'.format(source, rows, blob_bytes / 1024 ** 2))
+
+    print('total projected run time (tables with recorded makes, {} workers): {:.1f} h'.format(
+        worker_count, total_time / worker_count / 3600))
+
+
+def recompute_stale(table_names, include_unversioned=False, dry_run=False, confirm=True):
+    """
+    Recompute the keys of the versioned tables made with other parameters or code than the current ones
+    (see compute.Versioned.get_stale_keys), and the keys of the tables depending on them - through foreign keys
+    or "fetched_tables" (see get_dependency_graph): the rows of their key_source keys matching the stale keys of
+    an upstream table. The rows of all these keys are deleted, then populated again in dependency order.
+    :param confirm: ask for confirmation before deleting (once, for all the tables - the deletes themselves do
+                    not prompt, regardless of dj.config['safemode'])
+    """
+    populated_tables = get_populated_tables()
+    dependencies = get_dependency_graph(populated_tables)
+    full_names = {get_table(t).full_table_name: t for t in populated_tables}
+
+    stale = OrderedDict()  # table name: stale keys (of its key_source), in dependency order
+    for full_name in nx.topological_sort(dependencies):
+        table_name = full_names.get(full_name)
+        if table_name is None:
+            continue
+        table = get_table(table_name)()
+
+        keys = {}
+        if table_name in table_names and hasattr(table, 'get_stale_keys'):
+            keys.update((key_hash(k), k) for k in table.get_stale_keys(include_unversioned=include_unversioned))
+        for upstream in nx.ancestors(dependencies, full_name):
+            upstream_keys = stale.get(full_names.get(upstream))
+            if upstream_keys:
+                keys.update((key_hash(k), k) for k in (
+                    table.key_source & (table & upstream_keys).proj()).fetch('KEY'))
+
+        if keys:
+            stale[table_name] = list(keys.values())
+            print('{}: {} stale keys'.format(table_name, len(keys)), flush=True)
+
+    if dry_run or not stale:
+        return
+    if confirm and user_choice('Delete and recompute the rows of these keys?') != 'yes':
+        return
+
+    with dj.config(safemode=False):
+        for table_name, keys in stale.items():
+            (get_table(table_name) & keys).delete()  # with the rows depending on them by foreign key
+
+    for table_name, keys in stale.items():
+        print('... repopulating {}'.format(table_name), flush=True)
+        get_table(table_name)().populate(keys, suppress_errors=True)
+
+
+def run_table(table_name, worker_count=1, memory_limit=None, max_restarts=10, report_interval=30,
+              populate_settings=settings):
+    """
+    Populate a table with "worker_count" worker processes, restarting crashed workers
+    """
+    ctx = mp.get_context('spawn')  # fresh interpreter and database connection per worker
+
+    def start_worker():
+        worker = ctx.Process(target=populate_worker, args=(table_name, memory_limit, populate_settings))
+        worker.start()
+        return worker
+
+    report = ProgressReport(table_name)
+    workers = [start_worker() for _ in range(worker_count)]
+    restarts = 0
+    last_report = time.time()
+
+    while workers:
+        time.sleep(1)
+        for worker in [w for w in workers if not w.is_alive()]:
+            workers.remove(worker)
+            if worker.exitcode != 0:
+                remaining, _ = get_progress(table_name)
+                if remaining and restarts < max_restarts:
+                    log.warning('{} worker exited with code {} - restarting'.format(table_name, worker.exitcode))
+                    restarts += 1
+                    workers.append(start_worker())
+                else:
+                    log.error('{} worker exited with code {}'.format(table_name, worker.exitcode))
+
+        if time.time() - last_report >= report_interval:
+            print(report, flush=True)
+            last_report = time.time()
+
+    print(report, flush=True)
+
+
+def run_pipelined(table_names, worker_count=1, memory_limit=None, max_restarts=10, report_interval=30,
+                  batch_size=20, poll_interval=10, populate_settings=settings):
+    """
+    Populate the tables concurrently, following their dependencies:
+    + an idle worker gets a pass of "batch_size" keys on the most downstream table with keys ready (in its
+      key_source and not populated yet), so that each key flows through the pipeline as early as possible
+    + a pass that populates nothing (e.g. errors, keys reserved by other machines) marks the table as stalled,
+      until one of its upstream tables makes progress or "poll_interval" seconds pass
+    + a table is complete once its upstream tables are complete and it has no key left, or a pass
+      populates nothing
+    """
+    upstream = get_upstream_tables(table_names)
+    ctx = mp.get_context('spawn')  # fresh interpreter and database connection per worker
+    results = ctx.Queue()
+
+    reports = {t: ProgressReport(t) for t in upstream}
+    complete, stalled_since, running = set(), {}, {t: 0 for t in upstream}
+    remaining = {}  # remaining keys of the tables, refreshed once per scheduling round
+    workers, restarts, last_report = {}, 0, time.time()  # {worker id: [process, task queue, current table]}
+
+    def start_worker():
+        worker_id = max(workers, default=-1) + 1
+        tasks = ctx.Queue()
+        worker = ctx.Process(target=pipeline_worker,
+                             args=(worker_id, tasks, results, memory_limit, populate_settings))
+        worker.start()
+        workers[worker_id] = [worker, tasks, None]
+
+    def set_complete(table_name):
+        complete.add(table_name)
+        print(reports[table_name], '- complete', flush=True)
+        for t in upstream:
+            if table_name in upstream[t]:
+                stalled_since.pop(t, None)
+
+    def next_table():
+        for table_name in reversed(list(upstream)):  # most downstream first
+            stalled = stalled_since.get(table_name)
+            if table_name in complete or (stalled and time.time() - stalled < poll_interval):
+                continue
+            if table_name not in remaining:
+                remaining[table_name] = reports[table_name].remaining
+            if not remaining[table_name] and not running[table_name] and upstream[table_name] <= complete:
+                set_complete(table_name)
+            elif running[table_name] * batch_size < remaining[table_name]:
+                return table_name
+
+    def on_result(table_name, key_count):
+        running[table_name] -= 1
+        if key_count:
+            stalled_since.pop(table_name, None)
+            for t in upstream:  # downstream tables may have keys ready
+                if table_name in upstream[t]:
+                    stalled_since.pop(t, None)
+        elif not running[table_name]:
+            if upstream[table_name] <= complete:
+                set_complete(table_name)
+            else:
+                stalled_since[table_name] = time.time()
+
+    for _ in range(worker_count):
+        start_worker()
+
+    while len(complete) < len(upstream):
+        # collect finished passes
+        try:
+            result = results.get(timeout=1)
+            while True:
+                worker_id, table_name, key_count = result
+                if worker_id in workers:
+                    workers[worker_id][2] = None
+                    on_result(table_name, key_count)
+                result = results.get_nowait()
+        except queue.Empty:
+            pass
+
+        # replace crashed workers - their pass counts as populating nothing
+        for worker_id in [i for i, (w, _, _) in workers.items() if not w.is_alive()]:
+            worker, _, table_name = workers.pop(worker_id)
+            log.warning('worker exited with code {}{}'.format(
+                worker.exitcode, ' on ' + table_name if table_name else ''))
+            if table_name:
+                on_result(table_name, 0)
+            if restarts < max_restarts:
+                restarts += 1
+                start_worker()
+        if not workers:
+            log.error('no worker left - stopping')
+            break
+
+        # dispatch passes to idle workers
+        remaining.clear()
+        for worker_id, (_, tasks, current) in workers.items():
+            if current is None:
+                table_name = next_table()
+                if table_name is None:
+                    break
+                tasks.put((table_name, batch_size))
+                workers[worker_id][2] = table_name
+                running[table_name] += 1
+
+        if time.time() - last_report >= report_interval:
+            for table_name in upstream:
+                if table_name not in complete:
+                    print(reports[table_name], flush=True)
+            last_report = time.time()
+
+    for worker, tasks, _ in workers.values():
+        tasks.put(None)
+        worker.join()
+
 
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Populate the computed tables with multiple worker processes')
+    parser.add_argument('-j', '--workers', type=int, default=max(1, mp.cpu_count() - 1),
+                        help='worker processes - per table in sequential mode (default: cpu count - 1)')
+    parser.add_argument('-t', '--tables', nargs='+', default=None,
+                        help='tables to populate, as module.Class (default: {})'.format(' '.join(default_tables)))
+    parser.add_argument('--all-tables', action='store_true',
+                        help='populate all the computed tables of {}'.format(', '.join(default_modules)))
+    parser.add_argument('--mode', choices=('pipelined', 'sequential'), default='pipelined',
+                        help='pipelined: schedule tables by dependencies - sequential: one table after the other')
+    parser.add_argument('--batch-size', type=int, default=20,
+                        help='keys per populate pass (pipelined mode)')
+    parser.add_argument('--plan', action='store_true',
+                        help='only report the pending keys, upstream data and projected run time of the tables')
+    parser.add_argument('--recompute-stale', action='store_true',
+                        help='recompute the keys made with other parameters or code than the current ones '
+                             '(with --plan: only count them)')
+    parser.add_argument('--include-unversioned', action='store_true',
+                        help='with --recompute-stale: also recompute the keys made before provenance was recorded')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help='with --recompute-stale: delete the stale rows without asking for confirmation')
+    parser.add_argument('--order', choices=('random', 'cost', 'original'), default=settings['order'],
+                        help='key order - cost: longest job first, for the batched tables (default: random)')
+    parser.add_argument('-m', '--memory-limit', type=parse_memory, default=None,
+                        help='address-space limit per worker, e.g. 4G (default: none)')
+    parser.add_argument('--max-restarts', type=int, default=10,
+                        help='maximum restarts of crashed workers, per table')
+    parser.add_argument('--report-interval', type=float, default=30,
+                        help='seconds between progress reports')
+    args = parser.parse_args(argv)
 
-settings = {'reserve_jobs': True, 'suppress_errors': True, 'display_progress': False}
+    table_names = args.tables or (get_populated_tables() if args.all_tables else list(default_tables))
+    populate_settings = {**settings, 'order': args.order}
 
-psth.UnitPsth.populate(**settings)
+    if args.recompute_stale:
+        recompute_stale(table_names, include_unversioned=args.include_unversioned, dry_run=args.plan,
+                        confirm=not args.yes)
+    elif args.plan:
+        print_plan(table_names, worker_count=args.workers)
+    elif args.mode == 'pipelined':
+        run_pipelined(table_names, worker_count=args.workers, memory_limit=args.memory_limit,
+                      max_restarts=args.max_restarts, report_interval=args.report_interval,
+                      batch_size=args.batch_size, populate_settings=populate_settings)
+    else:
+        for table_name in get_upstream_tables(table_names):
+            run_table(table_name, worker_count=args.workers, memory_limit=args.memory_limit,
+                      max_restarts=args.max_restarts, report_interval=args.report_interval,
+                      populate_settings=populate_settings)
 
-psth.PeriodSelectivity.populate(**settings)
 
-psth.UnitSelectivity.populate(**settings)
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    main()
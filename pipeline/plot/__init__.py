@@ -8,6 +8,7 @@ from scipy import ndimage
 
 from pipeline import experiment, ephys, psth
 from pipeline import smooth_psth
+from pipeline.smoothing import smooth
 
 
 # ---------- PLOTTING HELPER FUNCTIONS --------------
@@ -22,8 +23,10 @@ def _plot_avg_psth(ipsi_psth, contra_psth, vlines={}, ax=None, title=''):
         np.array([i[0] for i in ipsi_psth])).mean(axis=0)
     ipsi_edges = ipsi_psth[0][1][:-1]
 
-    ax.plot(contra_edges, smooth_psth(avg_contra_psth), 'b', label='contra')
-    ax.plot(ipsi_edges, smooth_psth(avg_ipsi_psth), 'r', label='ipsi')
+    smoothed_contra_psth, smoothed_ipsi_psth = smooth_psth(np.vstack([avg_contra_psth, avg_ipsi_psth]))
+
+    ax.plot(contra_edges, smoothed_contra_psth, 'b', label='contra')
+    ax.plot(ipsi_edges, smoothed_ipsi_psth, 'r', label='ipsi')
 
     for x in vlines:
         ax.axvline(x=x, linestyle='--', color='k')
@@ -59,7 +62,7 @@ def _plot_stacked_psth_diff(psth_a, psth_b, vlines=[], ax=None, flip=False, plot
     result = result * -1 if flip else result
 
     # moving average
-    result = np.array([_movmean(i) for i in result])
+    result = smooth(result, window_size=5, axis=1, mode='valid')
 
     if plot:
         if ax is None:
@@ -85,12 +88,6 @@ def _plot_with_sem(data, t_vec, ax, c='k'):
     ax.spines['top'].set_visible(False)
 
 
-def _movmean(data, nsamp=5):
-    ret = np.cumsum(data, dtype=float)
-    ret[nsamp:] = ret[nsamp:] - ret[:-nsamp]
-    return ret[nsamp - 1:] / nsamp
-
-
 def _extract_one_stim_dur(stim_durs):
     """
     In case of multiple photostim durations - pick the shortest duration
@@ -109,9 +106,9 @@ def _extract_one_stim_dur(stim_durs):
 def _get_photostim_time_and_duration(units, trials):
     # get photostim duration and stim time (relative to go-cue)
     stim_times, stim_durs = (experiment.PhotostimEvent
-                             * (experiment.TrialEvent & 'trial_event_type = "go"').proj(..., '-duration')
+                             * experiment.TrialEventTimes.proj('go_time')
                              * trials
-                             & units).proj('duration', stim_time='photostim_event_time - trial_event_time').fetch(
+                             & units).proj('duration', stim_time='photostim_event_time - go_time').fetch(
         'stim_time', 'duration')
     stim_dur = _extract_one_stim_dur(np.unique(stim_durs))
     stim_time = np.nanmean(stim_times.astype(np.float))
@@ -124,13 +121,9 @@ def _get_trial_event_times(events, units, trial_cond_name):
     Get median event start times from all unit-trials from the specified "trial_cond_name" and "units" - aligned to GO CUE
     :param events: list of events
     """
-    events = list(events) + ['go']
-
-    event_types, event_times = (psth.TrialCondition().get_trials(trial_cond_name)
-                                * (experiment.TrialEvent & [{'trial_event_type': eve} for eve in events])
-                                & units).fetch('trial_event_type', 'trial_event_time')
-    period_starts = [np.nanmedian((event_times[event_types == event_type] - event_times[event_types == 'go']).astype(float))
-                     for event_type in events[:-1]]
+    _, event_times = experiment.TrialEventTimes.get_event_times(
+        psth.TrialCondition().get_trials(trial_cond_name) & units, events, relative_to='go')
+    period_starts = list(np.nanmedian(event_times, axis=0))
     return period_starts
 
 
@@ -3,9 +3,9 @@ import scipy as sp
 import datajoint as dj
 
 import matplotlib.pyplot as plt
-from scipy import signal
 
 from pipeline import experiment, tracking, ephys
+from pipeline.smoothing import smooth
 
 
 def plot_correct_proportion(session_key, window_size=None, axis=None):
@@ -20,9 +20,8 @@ def plot_correct_proportion(session_key, window_size=None, axis=None):
     trial_outcomes = (trial_outcomes == 'hit').astype(int)
 
     window_size = int(.1 * len(trial_outcomes)) if not window_size else int(window_size)
-    kernel = np.full((window_size, ), 1/window_size)
 
-    mv_outcomes = signal.convolve(trial_outcomes, kernel, mode='same')
+    mv_outcomes = smooth(trial_outcomes, window_size=window_size)
 
     if not axis:
         fig, axis = plt.subplots(1, 1)
@@ -114,9 +113,7 @@ def plot_jaw_movement(session_key, unit_key, tongue_thres=430, trial_limit=10, a
             sample_counts = len(jaw)
             tvec = np.arange(sample_counts) / tracking_fs
 
-            first_lick_time = (experiment.ActionEvent & tr & 'action_event_type in ("left lick", "right lick")').fetch(
-                    'action_event_time', order_by = 'action_event_time', limit = 1)[0]
-            go_time = (experiment.TrialEvent & tr & 'trial_event_type="go"').fetch1('trial_event_time')
+            go_time, first_lick_time = (experiment.TrialEventTimes & tr).fetch1('go_time', 'first_lick_time')
 
             spike_times = (ephys.TrialSpikes & tr & unit_key).fetch1('spike_times')
             spike_times = spike_times + float(go_time) - float(first_lick_time)  # realigned to first-lick
@@ -154,29 +151,23 @@ def plot_trial_jaw_movement(trial_key):
     """
     Plot trial-specific Jaw Movement time-locked to "go" cue
     """
-    trk = (tracking.Tracking.JawTracking * experiment.BehaviorTrial & trial_key & experiment.TrialEvent)
+    trk = (tracking.Tracking.JawTracking * tracking.JawPhase * experiment.TrialEventTimes
+           & trial_key & 'go_time is not NULL')
     if len(trk) == 0:
         return 'The selected trial has no Action Event (e.g. cue start)'
 
     tracking_fs = float((tracking.TrackingDevice & tracking.Tracking & trial_key).fetch1('sampling_rate'))
-    jaw = trk.fetch1('jaw_y')
-    go_time = (experiment.TrialEvent & trk & 'trial_event_type="go"').fetch1('trial_event_time')
+    jaw, filt_jaw, insta_amp, insta_phase, go_time = trk.fetch1(
+        'jaw_y', 'filtered_jaw', 'jaw_amplitude', 'jaw_phase', 'go_time')
     tvec = np.arange(len(jaw)) / tracking_fs - float(go_time)
 
-    b, a = signal.butter(5, (5, 15), btype='band', fs=tracking_fs)
-    filt_jaw = signal.filtfilt(b, a, jaw)
-
-    analytic_signal = signal.hilbert(filt_jaw)
-    insta_amp = np.abs(analytic_signal)
-    insta_phase = np.angle(analytic_signal)
-
     fig, axs = plt.subplots(2, 2, figsize=(16, 6))
     fig.subplots_adjust(hspace=0.4)
 
     axs[0, 0].plot(tvec, jaw, '.k')
     axs[0, 0].set_title('Jaw Movement')
     axs[1, 0].plot(tvec, filt_jaw, '.k')
-    axs[1, 0].set_title('Bandpass filtered 5-15Hz')
+    axs[1, 0].set_title('Bandpass filtered {}-{}Hz'.format(*tracking.JawPhase.jaw_band))
     axs[1, 0].set_xlabel('Time(s)')
     axs[0, 1].plot(tvec, insta_amp, '.k')
     axs[0, 1].set_title('Amplitude')
@@ -194,27 +185,14 @@ def plot_trial_jaw_movement(trial_key):
 
 
 def plot_windowed_jaw_phase_dist(session_key, xlim=(-0.12, 0.3), w_size=0.01, bin_counts=20):
-    trks = (tracking.Tracking.JawTracking * experiment.BehaviorTrial & session_key & experiment.TrialEvent)
+    trks = (tracking.JawPhase * experiment.BehaviorTrial * experiment.TrialEventTimes
+            & session_key & 'go_time is not NULL')
     tracking_fs = float((tracking.TrackingDevice & tracking.Tracking & session_key).fetch1('sampling_rate'))
 
-    def get_trial_track():
-        for jaw, go_time in zip(*(trks * experiment.TrialEvent & 'trial_event_type="go"').fetch(
-                'jaw_y', 'trial_event_time')):
-            tvec = np.arange(len(jaw)) / tracking_fs - float(go_time)
-            segmented_jaw = jaw[np.logical_and(tvec >= xlim[0], tvec <= xlim[1])]
-            if len(segmented_jaw) == (xlim[1] - xlim[0]) * tracking_fs:
-                yield segmented_jaw
-
-    jaw_trackings = np.vstack(get_trial_track())  # trials x times
-
-    b, a = signal.butter(5, (5, 15), btype='band', fs=tracking_fs)
-
-    filt_jaw_trackings = signal.filtfilt(b, a, jaw_trackings, axis=1)
-
-    insta_phase = np.angle(signal.hilbert(filt_jaw_trackings, axis=1))
+    insta_phase = _get_windowed_jaw_phase(trks, tracking_fs, xlim)  # trials x times
     insta_phase = np.degrees(insta_phase) % 360  # convert to degree [0, 360]
 
-    tvec = np.linspace(xlim[0], xlim[1], jaw_trackings.shape[1])
+    tvec = np.linspace(xlim[0], xlim[1], insta_phase.shape[1])
     windows = np.arange(xlim[0], xlim[1], w_size)
 
     # plot
@@ -232,31 +210,17 @@ def plot_windowed_jaw_phase_dist(session_key, xlim=(-0.12, 0.3), w_size=0.01, bi
 
 
 def plot_jaw_phase_dist(session_key, xlim=(-0.12, 0.3), bin_counts=20):
-    trks = (tracking.Tracking.JawTracking * experiment.BehaviorTrial & session_key & experiment.TrialEvent)
+    trks = (tracking.JawPhase * experiment.BehaviorTrial * experiment.TrialEventTimes
+            & session_key & 'go_time is not NULL')
     tracking_fs = float((tracking.TrackingDevice & tracking.Tracking & session_key).fetch1('sampling_rate'))
 
     l_trial_trk = trks & 'trial_instruction="left"' & 'early_lick="no early"'
     r_trial_trk = trks & 'trial_instruction="right"' & 'early_lick="no early"'
 
-    def get_trial_track(trial_tracks):
-        for jaw, go_time in zip(*(trial_tracks * experiment.TrialEvent & 'trial_event_type="go"').fetch(
-                'jaw_y', 'trial_event_time')):
-            tvec = np.arange(len(jaw)) / tracking_fs - float(go_time)
-            segmented_jaw = jaw[np.logical_and(tvec >= xlim[0], tvec <= xlim[1])]
-            if len(segmented_jaw) == (xlim[1] - xlim[0]) * tracking_fs:
-                yield segmented_jaw
-
-    l_jaw_trackings = np.vstack(get_trial_track(l_trial_trk))  # trials x times
-    r_jaw_trackings = np.vstack(get_trial_track(r_trial_trk))  # trials x times
-
-    b, a = signal.butter(5, (5, 15), btype='band', fs=tracking_fs)
-
-    filt_l_jaw_trackings = signal.filtfilt(b, a, l_jaw_trackings, axis=1)
-    l_insta_phase = np.angle(signal.hilbert(filt_l_jaw_trackings, axis=1))
+    l_insta_phase = _get_windowed_jaw_phase(l_trial_trk, tracking_fs, xlim)  # trials x times
     l_insta_phase = np.degrees(l_insta_phase) % 360  # convert to degree [0, 360]
 
-    filt_r_jaw_trackings = signal.filtfilt(b, a, r_jaw_trackings, axis=1)
-    r_insta_phase = np.angle(signal.hilbert(filt_r_jaw_trackings, axis=1))
+    r_insta_phase = _get_windowed_jaw_phase(r_trial_trk, tracking_fs, xlim)  # trials x times
     r_insta_phase = np.degrees(r_insta_phase) % 360  # convert to degree [0, 360]
 
     fig, axs = plt.subplots(1, 2, figsize=(12, 8), subplot_kw=dict(polar=True))
@@ -268,6 +232,21 @@ def plot_jaw_phase_dist(session_key, xlim=(-0.12, 0.3), bin_counts=20):
     axs[1].set_title('right lick trials', loc='left', fontweight='bold')
 
 
+def _get_windowed_jaw_phase(trial_tracks, tracking_fs, xlim):
+    """
+    Precomputed jaw phase (rad) of the specified trials within "xlim" (s) of the go cue - return (trial#, time)
+    Trials not covering the full window are left out
+    """
+    window_len = int(round((xlim[1] - xlim[0]) * tracking_fs))
+    segments = []
+    for phase, go_time in zip(*trial_tracks.fetch('jaw_phase', 'go_time')):
+        tvec = np.arange(len(phase)) / tracking_fs - float(go_time)
+        segment = phase[np.logical_and(tvec >= xlim[0], tvec <= xlim[1])]
+        if len(segment) >= window_len:
+            segments.append(segment[:window_len])
+    return np.vstack(segments) if segments else np.empty((0, window_len))
+
+
 def plot_polar_histogram(data, ax, bin_counts=30):
     bottom = 2
 
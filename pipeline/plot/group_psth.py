@@ -3,13 +3,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 from pipeline import psth
-
-
-def movmean(data, nsamp=5):  # TODO: moveout
-    ''' moving average over n samples '''
-    ret = np.cumsum(data, dtype=float)
-    ret[nsamp:] = ret[nsamp:] - ret[:-nsamp]
-    return ret[nsamp - 1:] / nsamp
+from pipeline.smoothing import smooth
 
 
 def group_psth_ll(psth_a, psth_b, invert=False):
@@ -24,8 +18,8 @@ def group_psth_ll(psth_a, psth_b, invert=False):
     b_data = np.array([r[0] for r in psth_b['unit_psth']])
 
     # scale per-unit PSTHS's
-    a_data = np.array([movmean(i * (1 / np.max(i))) for i in a_data])
-    b_data = np.array([movmean(i * (1 / np.max(i))) for i in b_data])
+    a_data = smooth(a_data / a_data.max(axis=1, keepdims=True), window_size=5, axis=1, mode='valid')
+    b_data = smooth(b_data / b_data.max(axis=1, keepdims=True), window_size=5, axis=1, mode='valid')
 
     if invert:
         result = (a_data - b_data) * -1
@@ -44,6 +44,33 @@ def plot_clustering_quality(probe_insertion):
         ax.spines['top'].set_visible(False)
 
 
+def plot_unit_spike_histograms(unit_key, axs=None):
+    """
+    Precomputed log-binned ISI histogram and autocorrelogram of a unit
+    """
+    isi_edges, acg_edges, isi_hist, acg = (ephys.UnitSpikeHistogram * ephys.UnitSpikeHistogram.Unit
+                                           & unit_key).fetch1('isi_bin_edges', 'acg_bin_edges', 'isi_hist', 'acg')
+
+    if axs is None:
+        fig, axs = plt.subplots(1, 2, figsize=(12, 4))
+    assert axs.size == 2
+
+    axs[0].bar(isi_edges[:-1], isi_hist, width=np.diff(isi_edges), align='edge', color='k')
+    axs[0].set_xscale('log')
+    axs[0].axvline(ephys.UnitStat.isi_violation_thresh, color='r', linestyle='--')
+    axs[0].set_xlabel('Inter-spike interval (s)')
+    axs[0].set_ylabel('Count')
+
+    axs[1].bar(acg_edges[:-1] * 1000, acg, width=np.diff(acg_edges) * 1000, align='edge', color='k')
+    axs[1].set_xlabel('Lag (ms)')
+    axs[1].set_ylabel('Count')
+
+    # cosmetic
+    for ax in axs:
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+
+
 def plot_unit_characteristic(probe_insertion, axs=None):
     probe_insertion = probe_insertion.proj()
     amp, snr, spk_rate, x, y, insertion_depth = (
@@ -413,25 +440,26 @@ def plot_psth_photostim_effect(units, condition_name_kw=['both_alm'], axs=None):
                      & 'period in ("sample", "delay", "response")').fetch(
                          'period_start')
 
+    psth_n_l, psth_n_r, psth_s_l, psth_s_r, stim_trial_cond_name = (
+        cond_names[0] for cond_names in psth.TrialCondition.get_cond_names_from_keywords(
+            [['_nostim', '_left'], ['_nostim', '_right'],
+             condition_name_kw + ['_stim_left'], condition_name_kw + ['_stim_right'],
+             condition_name_kw + ['_stim']]))
+
     # no photostim:
-    psth_n_l = psth.TrialCondition.get_cond_name_from_keywords(['_nostim', '_left'])[0]
-    psth_n_r = psth.TrialCondition.get_cond_name_from_keywords(['_nostim', '_right'])[0]
 
     psth_n_l = (psth.UnitPsth * psth.TrialCondition & units
                 & {'trial_condition_name': psth_n_l} & 'unit_psth is not NULL').fetch('unit_psth')
     psth_n_r = (psth.UnitPsth * psth.TrialCondition & units
                 & {'trial_condition_name': psth_n_r} & 'unit_psth is not NULL').fetch('unit_psth')
 
-    psth_s_l = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim_left'])[0]
-    psth_s_r = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim_right'])[0]
-
+    # photostim:
     psth_s_l = (psth.UnitPsth * psth.TrialCondition & units
                 & {'trial_condition_name': psth_s_l} & 'unit_psth is not NULL').fetch('unit_psth')
     psth_s_r = (psth.UnitPsth * psth.TrialCondition & units
                 & {'trial_condition_name': psth_s_r} & 'unit_psth is not NULL').fetch('unit_psth')
 
     # get photostim duration and stim time (relative to go-cue)
-    stim_trial_cond_name = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim'])[0]
     stim_time, stim_dur = _get_photostim_time_and_duration(units,
                                                            psth.TrialCondition().get_trials(stim_trial_cond_name))
 
@@ -461,7 +489,8 @@ def plot_psth_photostim_effect(units, condition_name_kw=['both_alm'], axs=None):
     axs[1].axvspan(stim_time, stim_time + stim_dur, alpha=0.3, color='royalblue')
 
 
-def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_time_window=None, ax=None):
+def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_time_window=None, ax=None,
+                                              n_boot=1000, seed=None, n_jobs=1):
     """
     For each unit in the specified units, extract:
     + control, left-instruct PSTH (ctrl_left)
@@ -472,55 +501,26 @@ def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_t
         (ctrl_left - ctrl_right) for ipsi-selective unit that locates on the left-hemisphere, and vice versa
         (stim_left - stim_right) for ipsi-selective unit that locates on the left-hemisphere, and vice versa
     Selectivity change is then defined as: control_PSTH - stim_PSTH
+    The recovery time (if recover_time_window is specified) is read from psth.SelectivityRecoveryTime when its entry
+    was computed over these units, in recover_time_window and with the same resamples (see _get_recovery_time) -
+    otherwise it is bootstrapped over units, in recover_time_window, with "n_boot" resamples drawn from "seed"
+    (see psth.compute_recovery_time)
     """
-    trial_cond_name = psth.TrialCondition.get_cond_name_from_keywords(['good_noearlylick_', '_hit'])[0]
+    trial_cond_name, stim_trial_cond_name, stim_left_cond_name, stim_right_cond_name = (
+        cond_names[0] for cond_names in psth.TrialCondition.get_cond_names_from_keywords(
+            [['good_noearlylick_', '_hit'], condition_name_kw + ['_stim'],
+             condition_name_kw + ['noearlylick', 'stim', 'left'], condition_name_kw + ['noearlylick', 'stim', 'right']]))
+
     period_starts = _get_trial_event_times(['sample', 'delay', 'go'], units, trial_cond_name)
 
-    stim_trial_cond_name = psth.TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim'])[0]
     stim_time, stim_dur = _get_photostim_time_and_duration(units,
                                                            psth.TrialCondition().get_trials(stim_trial_cond_name))
 
     ctrl_left_cond_name = 'all_noearlylick_nostim_left'
     ctrl_right_cond_name = 'all_noearlylick_nostim_right'
-    stim_left_cond_name = psth.TrialCondition().get_cond_name_from_keywords(condition_name_kw
-                                                                            + ['noearlylick', 'stim', 'left'])[0]
-    stim_right_cond_name = psth.TrialCondition().get_cond_name_from_keywords(condition_name_kw
-                                                                             + ['noearlylick', 'stim', 'right'])[0]
-
-    delta_sels, ctrl_psths = [], []
-    for unit in (units * psth.UnitSelectivity & 'unit_selectivity != "non-selective"').proj('unit_selectivity').fetch(as_dict=True):
-        # ---- trial count criteria ----
-        # no less than 5 trials for control
-        if (len(psth.TrialCondition.get_trials(ctrl_left_cond_name) & unit) < 5
-                or len(psth.TrialCondition.get_trials(ctrl_right_cond_name) & unit) < 5):
-            continue
-        # no less than 2 trials for stimulation
-        if (len(psth.TrialCondition.get_trials(stim_left_cond_name) & unit) < 2
-                or len(psth.TrialCondition.get_trials(stim_right_cond_name) & unit) < 2):
-            continue
-
-        hemi = _get_units_hemisphere(unit)
-
-        ctrl_left_psth, t_vec = psth.UnitPsth.get_plotting_data(unit, {'trial_condition_name': ctrl_left_cond_name})['psth']
-        ctrl_right_psth, _ = psth.UnitPsth.get_plotting_data(unit, {'trial_condition_name': ctrl_right_cond_name})['psth']
-        try:
-            stim_left_psth, _ = psth.UnitPsth.get_plotting_data(unit, {'trial_condition_name': stim_left_cond_name})['psth']
-            stim_right_psth, _ = psth.UnitPsth.get_plotting_data(unit, {'trial_condition_name': stim_right_cond_name})['psth']
-        except:
-            continue
-
-        if unit['unit_selectivity'] == 'ipsi-selective':
-            ctrl_psth_diff = ctrl_left_psth - ctrl_right_psth if hemi == 'left' else ctrl_right_psth - ctrl_left_psth
-            stim_psth_diff = stim_left_psth - stim_right_psth if hemi == 'left' else stim_right_psth - stim_left_psth
-        elif unit['unit_selectivity'] == 'contra-selective':
-            ctrl_psth_diff = ctrl_left_psth - ctrl_right_psth if hemi == 'right' else ctrl_right_psth - ctrl_left_psth
-            stim_psth_diff = stim_left_psth - stim_right_psth if hemi == 'right' else stim_right_psth - stim_left_psth
-
-        ctrl_psths.append(ctrl_psth_diff)
-        delta_sels.append(ctrl_psth_diff - stim_psth_diff)
-
-    ctrl_psths = np.vstack(ctrl_psths)
-    delta_sels = np.vstack(delta_sels)
+
+    ctrl_psths, delta_sels, t_vec = psth.compute_selectivity_change(
+        units, (ctrl_left_cond_name, ctrl_right_cond_name), (stim_left_cond_name, stim_right_cond_name))
 
     if ax is None:
         fig, ax = plt.subplots(1, 1, figsize=(4, 6))
@@ -528,17 +528,14 @@ def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_t
     _plot_with_sem(delta_sels, t_vec, ax)
 
     if recover_time_window:
-        recovery_times = []
-        for i in range(1000):
-            i_sample = np.random.choice(delta_sels.shape[0], delta_sels.shape[0], replace = True)
-            btstrp_diff = np.nanmean(delta_sels[i_sample, :], axis = 0) / np.nanmean(ctrl_psths[i_sample, :], axis = 0)
-            t_recovered = t_vec[
-                (btstrp_diff < 0.2) & (t_vec > recover_time_window[0]) & (t_vec < recover_time_window[1])]
-            if len(t_recovered) > 0:
-                recovery_times.append(t_recovered[0])
-        ax.axvline(x = np.mean(recovery_times), linestyle = '--', color = 'g')
-        ax.axvspan(np.mean(recovery_times) - np.std(recovery_times), np.mean(recovery_times) + np.std(recovery_times),
-                   alpha = 0.2, color = 'g')
+        recovery = _get_recovery_time(units, stim_trial_cond_name, recover_time_window, n_boot, seed)
+        if recovery is None:
+            recovery_times = psth.compute_recovery_time(delta_sels, ctrl_psths, t_vec, recover_time_window,
+                                                        n_boot=n_boot, seed=seed, n_jobs=n_jobs)
+            recovery = np.mean(recovery_times), np.std(recovery_times)
+        recovery_time, recovery_time_std = recovery
+        ax.axvline(x = recovery_time, linestyle = '--', color = 'g')
+        ax.axvspan(recovery_time - recovery_time_std, recovery_time + recovery_time_std, alpha = 0.2, color = 'g')
 
     ax.axhline(y=0, color = 'k')
     for x in period_starts:
@@ -549,9 +546,53 @@ def plot_selectivity_change_photostim_effect(units, condition_name_kw, recover_t
     ax.set_xlabel('Time (s)')
 
 
+def _get_recovery_time(units, stim_trial_cond_name, time_window, n_boot, seed):
+    """
+    (mean, std) of the bootstrapped recovery time stored in psth.SelectivityRecoveryTime for the photostim
+    condition, if its entry was computed over these units (see SelectivityRecoveryTime.get_units), in "time_window",
+    with "n_boot" resamples drawn from "seed" (any stored seed if None), and a resample recovered - None otherwise
+    """
+    recovery = (psth.SelectivityRecoveryTime & (ephys.ProbeInsertion & units.proj())
+                & {'stim_trial_condition_name': stim_trial_cond_name})
+    if len(recovery) != 1:
+        return None
+    key, recovery_window, recovery_time, recovery_time_std = recovery.fetch1(
+        'KEY', 'recovery_window', 'recovery_time', 'recovery_time_std')
+    params = psth.SelectivityRecoveryTime.recovery_params
+    if (recovery_time is None or np.isnan(recovery_time)
+            or recovery_window is None or not np.allclose(np.asarray(recovery_window, dtype=float), time_window)
+            or n_boot != params['n_boot'] or (seed is not None and seed != params['seed'])):
+        return None
+
+    unit_attrs = ephys.Unit.primary_key
+    stored_units = {tuple(k[a] for a in unit_attrs)
+                    for k in (ephys.Unit & psth.SelectivityRecoveryTime.get_units(key)).fetch('KEY')}
+    if stored_units != {tuple(k[a] for a in unit_attrs) for k in (ephys.Unit & units).fetch('KEY')}:
+        return None
+    return recovery_time, recovery_time_std
+
+
+def _get_CD_projected_psth(units, time_period=None):
+    """
+    CD-projected trial-psth of the specified units
+    If "time_period" is an EventPeriod name (e.g. 'delay'), read the precomputed psth.CodingDirection
+    of the session/brain-area/hemisphere of these units if it was computed on these units - otherwise (e.g. a subset
+    of the units) compute it on the fly, in the period time; compute it on the fly for a (start, end) time_period
+    :return: contra-trials CD projected trial-psth, ipsi-trials CD projected trial-psth, psth time-stamps, time_period
+    """
+    if isinstance(time_period, str) and psth.CodingDirection.get_entry(units, time_period):
+        _, proj_contra_trial, proj_ipsi_trial, time_stamps, time_period = psth.CodingDirection.get_projected_psth(
+            units, time_period)
+    else:
+        if isinstance(time_period, str):
+            time_period = psth.get_event_period_time(time_period, (experiment.Session & units).fetch1('KEY'))
+        _, proj_contra_trial, proj_ipsi_trial, time_stamps = psth.compute_CD_projected_psth(
+            units.fetch('KEY'), time_period=time_period)
+    return proj_contra_trial, proj_ipsi_trial, time_stamps, time_period
+
+
 def plot_coding_direction(units, time_period=None, axs=None):
-    _, proj_contra_trial, proj_ipsi_trial, time_stamps = psth.compute_CD_projected_psth(
-        units.fetch('KEY'), time_period=time_period)
+    proj_contra_trial, proj_ipsi_trial, time_stamps, _ = _get_CD_projected_psth(units, time_period)
 
     period_starts = (experiment.Period & 'period in ("sample", "delay", "response")').fetch('period_start')
 
@@ -575,11 +616,12 @@ def plot_paired_coding_direction(unit_g1, unit_g2, labels=None, time_period=None
     """
     Plot trial-to-trial CD-endpoint correlation between CD-projected trial-psth from two unit-groups (e.g. two brain regions)
     Note: coding direction is calculated on selective units, contra vs. ipsi, within the specified time_period
+    (an EventPeriod name reads the precomputed psth.CodingDirection - see _get_CD_projected_psth)
     """
-    _, proj_contra_trial_g1, proj_ipsi_trial_g1, time_stamps = psth.compute_CD_projected_psth(
-        unit_g1.fetch('KEY'), time_period=time_period)
-    _, proj_contra_trial_g2, proj_ipsi_trial_g2, time_stamps = psth.compute_CD_projected_psth(
-        unit_g2.fetch('KEY'), time_period=time_period)
+    proj_contra_trial_g1, proj_ipsi_trial_g1, time_stamps, _ = _get_CD_projected_psth(
+        unit_g1, time_period)
+    proj_contra_trial_g2, proj_ipsi_trial_g2, time_stamps, time_period = _get_CD_projected_psth(
+        unit_g2, time_period)
 
     period_starts = (experiment.Period & 'period in ("sample", "delay", "response")').fetch('period_start')
 
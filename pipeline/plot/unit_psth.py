@@ -67,10 +67,12 @@ def plot_unit_psth(unit_key, condition_name_kw=['good_noearlylick_', '_hit'], ax
     hemi = (ephys.ProbeInsertion.InsertionLocation
             * experiment.BrainLocation & unit_key).fetch1('hemisphere')
 
-    ipsi_cond_name = TrialCondition.get_cond_name_from_keywords(condition_name_kw
-                                                                + ['left' if hemi == 'left' else 'right'])[0]
-    contra_cond_name = TrialCondition.get_cond_name_from_keywords(condition_name_kw
-                                                                  + ['right' if hemi == 'left' else 'left'])[0]
+    ipsi_cond_names, contra_cond_names, trial_cond_names, stim_trial_cond_names = \
+        TrialCondition.get_cond_names_from_keywords([condition_name_kw + ['left' if hemi == 'left' else 'right'],
+                                                     condition_name_kw + ['right' if hemi == 'left' else 'left'],
+                                                     condition_name_kw,
+                                                     condition_name_kw + ['_stim']])
+    ipsi_cond_name, contra_cond_name = ipsi_cond_names[0], contra_cond_names[0]
 
     ipsi_hit_unit_psth = UnitPsth.get_plotting_data(
         unit_key, {'trial_condition_name': ipsi_cond_name})
@@ -79,13 +81,11 @@ def plot_unit_psth(unit_key, condition_name_kw=['good_noearlylick_', '_hit'], ax
         unit_key, {'trial_condition_name': contra_cond_name})
 
     # get event start times: sample, delay, response
-    trial_cond_name = TrialCondition.get_cond_name_from_keywords(condition_name_kw)[0]
-    period_starts = _get_trial_event_times(['sample', 'delay', 'go'], unit_key, trial_cond_name)
+    period_starts = _get_trial_event_times(['sample', 'delay', 'go'], unit_key, trial_cond_names[0])
 
     # photostim shaded bar (if applicable)
     try:
-        stim_trial_cond_name = TrialCondition.get_cond_name_from_keywords(condition_name_kw + ['_stim'])[0]
-        stim_bar = _get_photostim_time_and_duration(unit_key, TrialCondition().get_trials(stim_trial_cond_name))
+        stim_bar = _get_photostim_time_and_duration(unit_key, TrialCondition().get_trials(stim_trial_cond_names[0]))
     except:
         stim_bar = None
 
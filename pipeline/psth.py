@@ -3,7 +3,6 @@ import math
 import hashlib
 
 from functools import partial
-from inspect import getmembers
 from itertools import repeat
 
 import numpy as np
@@ -14,7 +13,8 @@ import scipy.stats as sc_stats
 from . import lab
 from . import experiment
 from . import ephys
-from . import smooth_psth
+from . import smooth_psth, map_chunks
+from .compute import BatchPopulate, Versioned
 [lab, experiment, ephys]  # NOQA
 
 from . import get_schema_name
@@ -135,6 +135,27 @@ class TrialCondition(dj.Lookup):
                            **d['trial_condition_arg']})}
                 for d in contents_data)
 
+    # in-process caches, reset by clear_cache() whenever this table is inserted into or deleted from
+    _cond_name_index = None  # {name token: set(condition names)} - see _get_cond_name_index()
+    _func_cache = {}  # {condition name: trial retrieval function}
+    _trials_cache = {}  # {condition name: trials query}
+    _restr_attrs = None  # (stim attributes, behavior attributes) - see _get_restriction_attrs()
+
+    @classmethod
+    def clear_cache(cls):
+        cls._cond_name_index = None
+        cls._func_cache.clear()
+        cls._trials_cache.clear()
+        cls._restr_attrs = None
+
+    def insert(self, *args, **kwargs):
+        self.clear_cache()
+        super().insert(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        self.clear_cache()
+        super().delete(*args, **kwargs)
+
     @classmethod
     def insert_trial_conditions(cls, contents_data):
         cls.insert(({**d, 'trial_condition_hash': key_hash({'trial_condition_func': d['trial_condition_func'],
@@ -143,31 +164,81 @@ class TrialCondition(dj.Lookup):
 
     @classmethod
     def get_trials(cls, trial_condition_name):
-        return cls.get_func({'trial_condition_name': trial_condition_name})()
+        if trial_condition_name not in cls._trials_cache:
+            cls._trials_cache[trial_condition_name] = cls.get_func(
+                {'trial_condition_name': trial_condition_name})()
+        return cls._trials_cache[trial_condition_name]
+
+    @classmethod
+    def _get_cond_name_index(cls):
+        """
+        Condition names decomposed into '_'-separated tokens, built from one fetch and cached
+        for the lifetime of the process (reset by insert_trial_conditions)
+        """
+        if cls._cond_name_index is None:
+            index = {}
+            for cond_name in cls.fetch('trial_condition_name'):
+                for token in cond_name.split('_'):
+                    index.setdefault(token, set()).add(cond_name)
+            cls._cond_name_index = index
+        return cls._cond_name_index
 
     @classmethod
     def get_cond_name_from_keywords(cls, keywords):
-        matched_cond_names = []
-        for cond_name in cls.fetch('trial_condition_name'):
-            match = True
-            tmp_cond = cond_name
-            for k in keywords:
-                if k in tmp_cond:
+        return cls.get_cond_names_from_keywords([keywords])[0]
+
+    @classmethod
+    def get_cond_names_from_keywords(cls, keyword_sets):
+        """
+        Batch version of get_cond_name_from_keywords - one sorted list of matching names per keyword set.
+        A name matches when each keyword, in turn, is found in (and removed from) the name.
+        Candidates are narrowed by intersecting the token sets of the keywords before the exact check.
+        """
+        index = cls._get_cond_name_index()
+        token_matches = {}
+
+        def _token_candidates(kw_token):
+            # a keyword token may be part of a longer name token (e.g. 'stim' in 'nostim')
+            if kw_token not in token_matches:
+                token_matches[kw_token] = set().union(
+                    *(names for token, names in index.items() if kw_token in token))
+            return token_matches[kw_token]
+
+        matched = []
+        for keywords in keyword_sets:
+            kw_tokens = set(t for k in keywords for t in k.split('_') if t)
+            candidates = (set.intersection(*(_token_candidates(t) for t in kw_tokens)) if kw_tokens
+                          else set().union(*index.values()))
+            cond_names = []
+            for cond_name in candidates:
+                tmp_cond = cond_name
+                for k in keywords:
+                    if k not in tmp_cond:
+                        break
                     tmp_cond = tmp_cond.replace(k, '')
                 else:
-                    match = False
-                    break
-            if match:
-                matched_cond_names.append(cond_name)
-        return sorted(matched_cond_names)
+                    cond_names.append(cond_name)
+            matched.append(sorted(cond_names))
+        return matched
 
     @classmethod
     def get_func(cls, key):
-        self = cls()
-        func, args = (self & key).fetch1(
-            'trial_condition_func', 'trial_condition_arg')
+        cond_name = key['trial_condition_name']
+        if cond_name not in cls._func_cache:
+            func, args = (cls() & {'trial_condition_name': cond_name}).fetch1(
+                'trial_condition_func', 'trial_condition_arg')
+            cls._func_cache[cond_name] = partial(getattr(cls, func), **args)
 
-        return partial(dict(getmembers(cls))[func], **args)
+        return cls._func_cache[cond_name]
+
+    @classmethod
+    def _get_restriction_attrs(cls):
+        if cls._restr_attrs is None:
+            stim_attrs = (set((experiment.Photostim * experiment.PhotostimEvent).heading.names)
+                          - set(experiment.Session.heading.names))
+            behav_attrs = set(experiment.BehaviorTrial.heading.names)
+            cls._restr_attrs = stim_attrs, behav_attrs
+        return cls._restr_attrs
 
     @classmethod
     def _get_trials_exclude_stim(cls, **kwargs):
@@ -181,8 +252,7 @@ class TrialCondition(dj.Lookup):
             else:
                 restr[k] = v
 
-        stim_attrs = set((experiment.Photostim * experiment.PhotostimEvent).heading.names) - set(experiment.Session.heading.names)
-        behav_attrs = set(experiment.BehaviorTrial.heading.names)
+        stim_attrs, behav_attrs = cls._get_restriction_attrs()
 
         _stim_key = {k: v for k, v in _restr.items() if k in stim_attrs}
         _behav_key = {k: v for k, v in _restr.items() if k in behav_attrs}
@@ -205,8 +275,7 @@ class TrialCondition(dj.Lookup):
             else:
                 restr[k] = v
 
-        stim_attrs = set((experiment.Photostim * experiment.PhotostimEvent).heading.names) - set(experiment.Session.heading.names)
-        behav_attrs = set(experiment.BehaviorTrial.heading.names)
+        stim_attrs, behav_attrs = cls._get_restriction_attrs()
 
         _stim_key = {k: v for k, v in _restr.items() if k in stim_attrs}
         _behav_key = {k: v for k, v in _restr.items() if k in behav_attrs}
@@ -219,7 +288,7 @@ class TrialCondition(dj.Lookup):
 
 
 @schema
-class UnitPsth(dj.Computed):
+class UnitPsth(BatchPopulate, dj.Computed):
     definition = """
     -> TrialCondition
     -> ephys.Unit
@@ -227,28 +296,43 @@ class UnitPsth(dj.Computed):
     unit_psth=NULL: longblob
     """
     psth_params = {'xmin': -3, 'xmax': 3, 'binsize': 0.04}
+    version_params = ('psth_params',)
 
-    def make(self, key):
-        log.info('UnitPsth.make(): key: {}'.format(key))
+    key_cost = ephys.Unit.aggr(ephys.TrialSpikes, cost='count(*)')  # trial-spikes of each unit (order='cost')
 
-        # expand TrialCondition to trials,
-        trials = TrialCondition.get_trials(key['trial_condition_name'])
+    fetched_tables = (ephys.TrialSpikes,)  # read by make besides the parent tables (populate plan)
 
-        # fetch related spike times
-        q = (ephys.TrialSpikes & key & trials.proj())
-        spikes = q.fetch('spike_times')
+    def make_batch(self, keys):
+        log.info('UnitPsth.make_batch(): {} keys - first key: {}'.format(len(keys), keys[0]))
 
-        if len(spikes) == 0:
-            log.warning('no spikes found for key {} - null psth'.format(key))
-            self.insert1(key)
-            return
+        unit_attrs = ephys.Unit.primary_key
+        entries = []
+        for cond_name in sorted(set(k['trial_condition_name'] for k in keys)):
+            cond_keys = [k for k in keys if k['trial_condition_name'] == cond_name]
+
+            # expand TrialCondition to trials,
+            trials = TrialCondition.get_trials(cond_name)
+
+            # fetch related spike times - all the units of the batch at once
+            spk_keys, spikes = (ephys.TrialSpikes & [{a: k[a] for a in unit_attrs} for k in cond_keys]
+                                & trials.proj()).fetch('KEY', 'spike_times')
+            unit_spikes = {}
+            for spk_key, spike_times in zip(spk_keys, spikes):
+                unit_spikes.setdefault(tuple(spk_key[a] for a in unit_attrs), []).append(spike_times)
+
+            for key in cond_keys:
+                spikes = unit_spikes.get(tuple(key[a] for a in unit_attrs))
+                if not spikes:
+                    log.warning('no spikes found for key {} - null psth'.format(key))
+                    entries.append(key)
+                    continue
 
-        # compute psth & store.
-        # XXX: xmin, xmax+bins (149 here vs 150 in matlab)..
-        #   See also [:1] slice in plots..
-        unit_psth = self.compute_psth(spikes)
+                # compute psth & store.
+                # XXX: xmin, xmax+bins (149 here vs 150 in matlab)..
+                #   See also [:1] slice in plots..
+                entries.append({**key, 'unit_psth': self.compute_psth(spikes)})
 
-        self.insert1({**key, 'unit_psth': unit_psth})
+        self.insert(entries)
 
     @staticmethod
     def compute_psth(session_unit_spikes):
@@ -278,7 +362,7 @@ class UnitPsth(dj.Computed):
         # from collections import ChainMap
         # interact('unitpsth make', local=dict(ChainMap(locals(), globals())))
 
-        trials = TrialCondition.get_func(condition_key)()
+        trials = TrialCondition.get_trials(condition_key['trial_condition_name'])
 
         unit_psth = (UnitPsth & {**condition_key, **unit_key}).fetch1()['unit_psth']
         if unit_psth is None:
@@ -296,6 +380,126 @@ class UnitPsth(dj.Computed):
         return dict(trials=trials, spikes=spikes, psth=(psth, edges[1:]), raster=raster)
 
 
+@schema
+class AlignmentEvent(dj.Lookup):
+    """
+    Events that trial spikes can be re-aligned to (TrialSpikes are relative to the go-cue).
+    The first occurrence of the event in each trial is used; trials without the event are left out.
+    """
+    definition = """
+    alignment_name: varchar(32)
+    ---
+    alignment_event_source: enum('trial_event', 'action_event', 'photostim_event')
+    alignment_event_type='': varchar(32)  # TrialEventType or ActionEventType - '' for any action event, or photostim
+    time_shift=0: float  # (s) any time-shift amount with respect to the event
+    """
+
+    contents = [('go', 'trial_event', 'go', 0),
+                ('presample', 'trial_event', 'presample', 0),
+                ('sample', 'trial_event', 'sample', 0),
+                ('delay', 'trial_event', 'delay', 0),
+                ('first_lick', 'action_event', '', 0),
+                ('first_left_lick', 'action_event', 'left lick', 0),
+                ('first_right_lick', 'action_event', 'right lick', 0),
+                ('photostim', 'photostim_event', '', 0)]
+
+    @classmethod
+    def get_event_offsets(cls, alignment_name, trial_keys):
+        """
+        Time (s) of the alignment event relative to the go-cue, for each of the specified trials having both times
+        (a NULL go-cue or event time gives no offset - the trial is left out, as a trial without the event)
+        Return: {(subject_id, session, trial): offset}
+        """
+        source, event_type, time_shift = (cls & {'alignment_name': alignment_name}).fetch1(
+            'alignment_event_source', 'alignment_event_type', 'time_shift')
+
+        trials = experiment.TrialEventTimes & trial_keys
+        if source == 'trial_event' or (source == 'action_event' and not event_type):
+            event_attr = experiment.TrialEventTimes.event_attr(event_type if source == 'trial_event' else 'first_lick')
+            event_times = trials.proj(event_time=event_attr) & 'event_time is not NULL'
+        elif source == 'action_event':
+            event_times = trials.aggr(experiment.ActionEvent & {'action_event_type': event_type},
+                                      event_time='min(action_event_time)')
+        else:
+            event_times = trials.aggr(experiment.PhotostimEvent, event_time='min(photostim_event_time)')
+
+        subject_ids, sessions, trial_ids, go_time, event_time = (trials.proj('go_time') * event_times).fetch(
+            'subject_id', 'session', 'trial', 'go_time', 'event_time')
+        offsets = event_time.astype(float) - go_time.astype(float) + time_shift
+        valid = ~np.isnan(offsets)
+
+        return dict(zip(zip(subject_ids[valid], sessions[valid], trial_ids[valid]), offsets[valid]))
+
+
+def _fetch_trial_spikes_and_offsets(unit_key, trial_keys, alignment_name):
+    """
+    TrialSpikes of a unit for the specified trials having the alignment event, with the per-trial event offsets
+    """
+    trial_spikes_keys, spike_trains = (ephys.TrialSpikes & unit_key & trial_keys).fetch(
+        'KEY', 'spike_times', order_by='trial asc')
+    offsets = AlignmentEvent.get_event_offsets(alignment_name, trial_spikes_keys)
+
+    trial_offsets = [offsets.get((k['subject_id'], k['session'], k['trial'])) for k in trial_spikes_keys]
+    has_event = [o is not None for o in trial_offsets]
+
+    return ([k for k, e in zip(trial_spikes_keys, has_event) if e],
+            [s for s, e in zip(spike_trains, has_event) if e],
+            np.array([o for o in trial_offsets if o is not None]))
+
+
+def get_aligned_trial_spikes(unit_key, trial_keys, alignment_name):
+    """
+    TrialSpikes of a unit for the specified trials, re-aligned to the alignment event
+    Return: trial numbers, per-trial spike times (s) relative to the alignment event
+    """
+    trial_spikes_keys, spike_trains, offsets = _fetch_trial_spikes_and_offsets(unit_key, trial_keys, alignment_name)
+    return np.array([k['trial'] for k in trial_spikes_keys], dtype=int), align_spike_trains(spike_trains, offsets)
+
+
+@schema
+class UnitAlignedPsth(Versioned, dj.Computed):
+    """
+    UnitPsth variant with the trial spikes aligned to an AlignmentEvent
+    """
+    definition = """
+    -> TrialCondition
+    -> ephys.Unit
+    -> AlignmentEvent
+    ---
+    trial_count: int          # number of trials with the alignment event
+    unit_psth=NULL: longblob  # [psth, bin edges] - as in UnitPsth
+    """
+
+    psth_params = UnitPsth.psth_params  # binning - as in UnitPsth
+    version_params = ('psth_params',)
+
+    # sessions with their TrialEventTimes (alignment offsets)
+    key_source = TrialCondition * ephys.Unit * AlignmentEvent & experiment.TrialEventTimes.proj()
+
+    fetched_tables = (ephys.TrialSpikes, experiment.TrialEventTimes)  # read by make besides the parent tables
+
+    def make(self, key):
+        log.info('UnitAlignedPsth.make(): key: {}'.format(key))
+
+        trials = TrialCondition.get_trials(key['trial_condition_name'])
+
+        xmin, xmax, bin_size = self.psth_params.values()
+        binning = np.arange(xmin, xmax, bin_size)
+
+        _, spike_trains, offsets = _fetch_trial_spikes_and_offsets(key, trials.proj(), key['alignment_name'])
+
+        if len(spike_trains) == 0:
+            log.warning('no aligned spikes found for key {} - null psth'.format(key))
+            self.insert1({**key, 'trial_count': 0})
+            return
+
+        psth = compute_spike_counts(spike_trains, binning, offsets=offsets).sum(axis=0)
+        psth = psth / len(spike_trains) / bin_size
+
+        self.insert1({**key, 'trial_count': len(spike_trains),
+                      'unit_psth': np.array([psth, binning], dtype=object)})
+
+
 @schema
 class Selectivity(dj.Lookup):
     """
@@ -310,7 +514,7 @@ class Selectivity(dj.Lookup):
 
 
 @schema
-class PeriodSelectivity(dj.Computed):
+class PeriodSelectivity(BatchPopulate, dj.Computed):
     """
     Multi-trial selectivity for a specific trial subperiod
     """
@@ -326,80 +530,158 @@ class PeriodSelectivity(dj.Computed):
     """
 
     alpha = 0.05  # default alpha value
+    version_params = ('alpha',)
 
-    key_source = experiment.EventPeriod * (ephys.Unit & 'unit_quality != "all"')
+    key_source = experiment.EventPeriod * (ephys.Unit & 'unit_quality != "all"') & experiment.TrialEventTimes.proj()
 
-    def make(self, key):
+    key_cost = ephys.Unit.aggr(ephys.TrialSpikes, cost='count(*)')  # trial-spikes of each unit (order='cost')
+
+    fetched_tables = (ephys.TrialSpikes, experiment.TrialEventTimes)  # read by make besides the parent tables
+
+    def make_batch(self, keys):
         '''
-        Compute Period Selectivity for a given unit.
+        Compute Period Selectivity for the given units and periods of a session.
         '''
-        log.debug('PeriodSelectivity.make(): key: {}'.format(key))
+        log.debug('PeriodSelectivity.make_batch(): {} keys - first key: {}'.format(len(keys), keys[0]))
+
+        session_key = {a: keys[0][a] for a in experiment.Session.primary_key}
+        unit_attrs = ephys.Unit.primary_key
 
         # Verify insertion location is present,
-        egpos = None
-        try:
-            egpos = (ephys.ProbeInsertion.InsertionLocation
-                     * experiment.BrainLocation & key).fetch1()
-        except dj.DataJointError as e:
-            if 'exactly one tuple' in repr(e):
-                log.error('... Insertion Location missing. skipping')
+        insertions, hemispheres = (ephys.ProbeInsertion.InsertionLocation
+                                   * experiment.BrainLocation & session_key).fetch('insertion_number', 'hemisphere')
+        hemispheres = {i: h for i, h in zip(insertions, hemispheres) if list(insertions).count(i) == 1}
+        if any(k['insertion_number'] not in hemispheres for k in keys):
+            log.error('... Insertion Location missing. skipping')
+            keys = [k for k in keys if k['insertion_number'] in hemispheres]
+            if not keys:
                 return
 
-        # retrieving the spikes of interest,
-        spikes_q = ((ephys.TrialSpikes & key)
+        # retrieving the spikes of interest - all the units of the batch at once,
+        unit_keys = list({tuple(k[a] for a in unit_attrs): {a: k[a] for a in unit_attrs} for k in keys}.values())
+        spikes_q = ((ephys.TrialSpikes & unit_keys)
                     * (experiment.BehaviorTrial()
                        & {'task': 'audio delay'}
                        & {'early_lick': 'no early'}
                        & {'outcome': 'hit'}) - experiment.PhotostimEvent)
-
-        if not spikes_q:  # no spikes found
-            self.insert1({**key, 'period_selectivity': 'non-selective'})
-            return
+        spk_keys, trial_instructs, spikes = spikes_q.fetch('KEY', 'trial_instruction', 'spike_times')
+        spk_units = [tuple(k[a] for a in unit_attrs) for k in spk_keys]
 
         # retrieving event times
-        start_event, start_tshift, end_event, end_tshift = (experiment.EventPeriod & key).fetch1(
-            'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
-        start_event_q = {k['trial']: float(k['start_event_time'])
-                         for k in (experiment.TrialEvent & key & {'trial_event_type': start_event}).proj(
-            start_event_time=f'trial_event_time + {start_tshift}').fetch(as_dict=True)}
-        end_event_q = {k['trial']: float(k['end_event_time'])
-                       for k in (experiment.TrialEvent & key & {'trial_event_type': end_event}).proj(
-            end_event_time=f'trial_event_time + {end_tshift}').fetch(as_dict=True)}
-        cue_event_q = {k['trial']: float(k['trial_event_time'])
-                       for k in (experiment.TrialEvent & key & {'trial_event_type': 'go'}).fetch(as_dict=True)}
-
-        # compute spike rate during the period-of-interest for each trial
-        freq_i, freq_c = [], []
-        for trial, trial_instruct, spike_times in zip(*spikes_q.fetch('trial', 'trial_instruction', 'spike_times')):
-            start_time = start_event_q[trial] - cue_event_q[trial]
-            stop_time = end_event_q[trial] - cue_event_q[trial]
-            spk_rate = np.logical_and(spike_times >= start_time, spike_times < stop_time).sum() / (stop_time - start_time)
-            if egpos['hemisphere'] == trial_instruct:
-                freq_i.append(spk_rate)
+        periods, start_events, start_tshifts, end_events, end_tshifts = (
+            experiment.EventPeriod & [{'period': k['period']} for k in keys]).fetch(
+            'period', 'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
+        events = sorted(set(start_events) | set(end_events))
+        trial_keys, event_times = experiment.TrialEventTimes.get_event_times(
+            experiment.Session & session_key, events, relative_to='go')
+        trial_idx = {k['trial']: i for i, k in enumerate(trial_keys)}
+        trial_idx = np.array([trial_idx[k['trial']] for k in spk_keys], dtype=int)
+
+        # compute spike rate during each period-of-interest for each trial - spikes in CSR layout
+        spike_rows = np.repeat(np.arange(len(spikes)), [len(s) for s in spikes])
+        spikes = np.concatenate(spikes) if len(spikes) else np.empty(0)
+        spk_rates = {}
+        for period, start_event, start_tshift, end_event, end_tshift in zip(
+                periods, start_events, start_tshifts, end_events, end_tshifts):
+            start_time = event_times[trial_idx, events.index(start_event)] + start_tshift
+            stop_time = event_times[trial_idx, events.index(end_event)] + end_tshift
+            in_period = np.logical_and(spikes >= start_time[spike_rows], spikes < stop_time[spike_rows])
+            spk_rates[period] = np.bincount(spike_rows, weights=in_period, minlength=len(spk_keys)) / (
+                stop_time - start_time)
+
+        unit_rows = {}
+        for row, unit in enumerate(spk_units):
+            unit_rows.setdefault(unit, []).append(row)
+
+        entries = []
+        for key in keys:
+            rows = unit_rows.get(tuple(key[a] for a in unit_attrs))
+            if not rows:  # no spikes found
+                entries.append({**key, 'period_selectivity': 'non-selective'})
+                continue
+
+            # trials without the period event times (e.g. a NULL go time) have no rate - left out
+            rates = spk_rates[key['period']][rows]
+            has_rate = ~np.isnan(rates)
+            is_ipsi = trial_instructs[rows] == hemispheres[key['insertion_number']]
+            freq_i = rates[is_ipsi & has_rate]
+            freq_c = rates[~is_ipsi & has_rate]
+
+            # and testing for selectivity.
+            t_stat, pval = sc_stats.ttest_ind(freq_i, freq_c, equal_var=True)
+
+            freq_i_m = np.average(freq_i)
+            freq_c_m = np.average(freq_c)
+
+            pval = 1 if np.isnan(pval) else pval
+            if pval > self.alpha:
+                pref = 'non-selective'
             else:
-                freq_c.append(spk_rate)
+                pref = ('ipsi-selective' if freq_i_m > freq_c_m
+                        else 'contra-selective')
 
-        # and testing for selectivity.
-        t_stat, pval = sc_stats.ttest_ind(freq_i, freq_c, equal_var=True)
+            entries.append({**key, 'p_value': pval,
+                            'period_selectivity': pref,
+                            'ipsi_firing_rate': freq_i_m,
+                            'contra_firing_rate': freq_c_m})
 
-        freq_i_m = np.average(freq_i)
-        freq_c_m = np.average(freq_c)
+        self.insert(entries)
+        PeriodSelectivityCompletion.mark(unit_keys)
 
-        pval = 1 if np.isnan(pval) else pval
-        if pval > self.alpha:
-            pref = 'non-selective'
-        else:
-            pref = ('ipsi-selective' if freq_i_m > freq_c_m
-                    else 'contra-selective')
 
-        self.insert1({**key, 'p_value': pval,
-                      'period_selectivity': pref,
-                      'ipsi_firing_rate': freq_i_m,
-                      'contra_firing_rate': freq_c_m})
+@schema
+class PeriodSelectivityCompletion(dj.Manual):
+    """
+    Units with a PeriodSelectivity for all the UnitSelectivity periods - written by PeriodSelectivity.make_batch
+    in its transaction, and removed with any of these PeriodSelectivity rows (cascaded delete), so that
+    UnitSelectivity.key_source is an indexed lookup
+    """
+
+    definition = """
+    -> ephys.Unit
+    ---
+    -> PeriodSelectivity.proj(sample_period='period')
+    -> PeriodSelectivity.proj(delay_period='period')
+    -> PeriodSelectivity.proj(response_period='period')
+    """
+
+    periods = ('sample', 'delay', 'response')
+
+    @classmethod
+    def _complete_units(cls, units):
+        return units.aggr(PeriodSelectivity & [{'period': p} for p in cls.periods],
+                          period_count='count(*)') & 'period_count = {}'.format(len(cls.periods))
+
+    @classmethod
+    def _entries(cls, unit_keys):
+        unit_attrs = ephys.Unit.primary_key
+        return [{**{a: k[a] for a in unit_attrs}, **{'{}_period'.format(p): p for p in cls.periods}}
+                for k in unit_keys]
+
+    @classmethod
+    def mark(cls, unit_keys):
+        """
+        Mark the given units completed by now - in the transaction of PeriodSelectivity.make_batch. The units are
+        locked, then counted with a locking read (latest committed rows, not the transaction snapshot), so that
+        concurrent workers making other periods of the same units do not both miss the completion
+        """
+        table = cls()
+        units = ephys.Unit & unit_keys
+        table.connection.query(units.proj().make_sql() + ' FOR UPDATE')
+        complete = table.connection.query(cls._complete_units(units).make_sql() + ' LOCK IN SHARE MODE',
+                                          as_dict=True).fetchall()
+        cls.insert(cls._entries(complete), skip_duplicates=True)
+
+    @classmethod
+    def backfill(cls):
+        """
+        Mark the units completed before this marker existed
+        """
+        cls.insert(cls._entries((cls._complete_units(ephys.Unit) - cls).fetch(as_dict=True)), skip_duplicates=True)
 
 
 @schema
-class UnitSelectivity(dj.Computed):
+class UnitSelectivity(BatchPopulate, dj.Computed):
     """
     Multi-trial selectivity at unit level
     """
@@ -412,33 +694,528 @@ class UnitSelectivity(dj.Computed):
 
     # Unit Selectivity is computed only for units
     # that has PeriodSelectivity computed for "sample" and "delay" and "response"
-    key_source = (ephys.Unit
-                  & (PeriodSelectivity & 'period = "sample"')
-                  & (PeriodSelectivity & 'period = "delay"')
-                  & (PeriodSelectivity & 'period = "response"'))
+    periods = PeriodSelectivityCompletion.periods
+    key_source = ephys.Unit & PeriodSelectivityCompletion
+
+    fetched_tables = (PeriodSelectivity,)  # read by make besides the parent tables (populate plan, provenance)
+
+    def make_batch(self, keys):
+        '''
+        calculate 'global' selectivity for units -
+        '''
+        log.debug('UnitSelectivity.make_batch(): {} keys - first key: {}'.format(len(keys), keys[0]))
+
+        # fetch region selectivity - all the units of the batch at once,
+        unit_attrs = ephys.Unit.primary_key
+        ps_keys, periods, sels, contra_frates, ipsi_frates = (PeriodSelectivity & keys).fetch(
+            'KEY', 'period', 'period_selectivity', 'contra_firing_rate', 'ipsi_firing_rate')
+        unit_rows = {}
+        for row, ps_key in enumerate(ps_keys):
+            unit_rows.setdefault(tuple(ps_key[a] for a in unit_attrs), []).append(row)
+
+        entries = []
+        for key in keys:
+            rows = unit_rows.get(tuple(key[a] for a in unit_attrs), [])
+
+            if (sels[rows] == 'non-selective').all():
+                log.debug('... no UnitSelectivity for unit')
+                entries.append({**key, 'unit_selectivity': 'non-selective'})
+                continue
+
+            rows = [r for r in rows if periods[r] in self.periods]
+            contra_frate, ipsi_frate = contra_frates[rows], ipsi_frates[rows]
+
+            pref = ('ipsi-selective' if ipsi_frate.mean() > contra_frate.mean() else 'contra-selective')
+
+            log.debug('... prefers: {}'.format(pref))
+
+            entries.append({**key, 'unit_selectivity': pref})
+
+        self.insert(entries)
+
+
+@schema
+class SlidingSelectivity(Versioned, dj.Computed):
+    """
+    Multi-trial selectivity over a sliding window grid (time-resolved PeriodSelectivity)
+    """
+
+    definition = """
+    -> ephys.Unit
+    ---
+    window_centers:                  longblob  # (s) center of each window, relative to go cue
+    t_stat=null:                     longblob  # ipsi vs. contra spike rate t-statistic, per window
+    p_value=null:                    longblob  # ipsi vs. contra spike rate t-test p-value, per window
+    ipsi_firing_rate=null:           longblob  # mean firing rate of all ipsi-trials, per window
+    contra_firing_rate=null:         longblob  # mean firing rate of all contra-trials, per window
+    """
+
+    # window grid (s), relative to go cue - windows of "window_size" sliding by "step"
+    sliding_params = {'xmin': -3, 'xmax': 2, 'window_size': 0.4, 'step': 0.05}
+    version_params = ('sliding_params',)
+
+    key_source = ephys.Unit & 'unit_quality != "all"'
+
+    fetched_tables = (ephys.TrialSpikes,)  # read by make besides the parent tables (populate plan)
 
     def make(self, key):
         '''
-        calculate 'global' selectivity for a unit -
+        Compute Sliding Selectivity for a given unit - all windows at once.
         '''
-        log.debug('UnitSelectivity.make(): key: {}'.format(key))
+        log.debug('SlidingSelectivity.make(): key: {}'.format(key))
+
+        edges, window_bins = self.get_window_grid()
+        window_size = self.sliding_params['window_size']
+        window_centers = edges[:-window_bins] + window_size / 2
+
+        # Verify insertion location is present,
+        try:
+            hemi = (ephys.ProbeInsertion.InsertionLocation
+                    * experiment.BrainLocation & key).fetch1('hemisphere')
+        except dj.DataJointError as e:
+            if 'exactly one tuple' in repr(e):
+                log.error('... Insertion Location missing. skipping')
+                return
+            raise
+
+        # retrieving the spikes of interest (same trials as PeriodSelectivity),
+        spikes_q = ((ephys.TrialSpikes & key)
+                    * (experiment.BehaviorTrial()
+                       & {'task': 'audio delay'}
+                       & {'early_lick': 'no early'}
+                       & {'outcome': 'hit'}) - experiment.PhotostimEvent)
+
+        trial_instruct, spike_times = spikes_q.fetch('trial_instruction', 'spike_times')
+
+        if not len(spike_times):  # no spikes found
+            self.insert1({**key, 'window_centers': window_centers})
+            return
+
+        # trial x window spike rate, from the cumulative trial x bin counts
+        cum_counts = np.cumsum(compute_spike_counts(spike_times, edges), axis=1)
+        cum_counts = np.hstack([np.zeros((len(cum_counts), 1)), cum_counts])
+        rates = (cum_counts[:, window_bins:] - cum_counts[:, :-window_bins]) / window_size
+
+        is_ipsi = trial_instruct == hemi
+        freq_i, freq_c = rates[is_ipsi], rates[~is_ipsi]
+
+        # and testing for selectivity, all windows at once.
+        t_stat, pval = sc_stats.ttest_ind(freq_i, freq_c, axis=0, equal_var=True)
+
+        self.insert1({**key, 'window_centers': window_centers,
+                      't_stat': t_stat,
+                      'p_value': np.where(np.isnan(pval), 1, pval),
+                      'ipsi_firing_rate': freq_i.mean(axis=0) if len(freq_i) else None,
+                      'contra_firing_rate': freq_c.mean(axis=0) if len(freq_c) else None})
+
+    @classmethod
+    def get_window_grid(cls):
+        """
+        Return the step-wise bin edges of the sliding grid and the window size (in number of steps)
+        """
+        xmin, xmax, window_size, step = (cls.sliding_params[k] for k in ('xmin', 'xmax', 'window_size', 'step'))
+        edges = np.arange(xmin, xmax + step / 2, step)
+        return edges, max(int(round(window_size / step)), 1)
+
+
+@schema
+class SelectivityRecoveryTime(Versioned, dj.Computed):
+    """
+    Bootstrapped recovery time of the selectivity following a photostimulation,
+    over the selective units of a probe insertion
+    """
+
+    definition = """
+    -> ephys.ProbeInsertion
+    -> TrialCondition.proj(stim_trial_condition_name='trial_condition_name')
+    ---
+    unit_count:                      int       # number of selective units included
+    time_stamps=null:                longblob  # (s) relative to go cue
+    control_selectivity=null:        longblob  # unit-averaged control selectivity (spike/s)
+    delta_selectivity=null:          longblob  # unit-averaged selectivity change, control - stim (spike/s)
+    recovery_window=null:            longblob  # (s) (start, end) time window searched for recovery
+    recovered_fraction=null:         float     # fraction of the bootstrap resamples that recovered
+    recovery_time=null:              float     # (s) mean bootstrapped recovery time, relative to go cue
+    recovery_time_std=null:          float     # (s) std of the bootstrapped recovery times
+    recovery_time_ci_low=null:       float     # (s) lower bound of the recovery time confidence interval
+    recovery_time_ci_high=null:      float     # (s) upper bound of the recovery time confidence interval
+    """
+
+    # recovery: first time (after the photostim) that the selectivity change drops below "threshold" x control
+    recovery_params = {'threshold': 0.2, 'window_end': 1, 'n_boot': 1000, 'seed': 0, 'ci': 95}
+
+    ctrl_trial_condition_names = ('all_noearlylick_nostim_left', 'all_noearlylick_nostim_right')
+    version_params = ('recovery_params', 'ctrl_trial_condition_names')
+
+    # photostim conditions, with their "_left" and "_right" instructed counterparts (see insert_lookup.py)
+    key_source = (ephys.ProbeInsertion * TrialCondition.proj(stim_trial_condition_name='trial_condition_name')
+                  & 'RIGHT(stim_trial_condition_name, 5) = "_stim"' & experiment.PhotostimEvent
+                  & experiment.TrialEventTimes.proj())
+
+    fetched_tables = (ephys.TrialSpikes, experiment.TrialEventTimes)  # read by make besides the parent tables
 
-        # fetch region selectivity,
-        sels = (PeriodSelectivity & key).fetch('period_selectivity')
+    @staticmethod
+    def get_units(key):
+        """
+        Units the recovery time of a probe insertion is computed over - its selective units
+        """
+        return (ephys.Unit * UnitSelectivity & key
+                & 'unit_quality != "all"' & 'unit_selectivity != "non-selective"')
+
+    def make(self, key):
+        log.debug('SelectivityRecoveryTime.make(): key: {}'.format(key))
+
+        stim_cond_name = key['stim_trial_condition_name']
+        stim_trials = TrialCondition.get_trials(stim_cond_name) & key
 
-        if (sels == 'non-selective').all():
-            log.debug('... no UnitSelectivity for unit')
-            self.insert1({**key, 'unit_selectivity': 'non-selective'})
+        units = self.get_units(key)
+
+        if not stim_trials or not units:
+            self.insert1({**key, 'unit_count': 0})
             return
 
-        contra_frate, ipsi_frate = (PeriodSelectivity & key & 'period in ("sample", "delay", "response")').fetch(
-            'contra_firing_rate', 'ipsi_firing_rate')
+        ctrl_psths, delta_sels, time_stamps = compute_selectivity_change(
+            units, self.ctrl_trial_condition_names, (stim_cond_name + '_left', stim_cond_name + '_right'))
+
+        if not len(delta_sels):
+            self.insert1({**key, 'unit_count': 0})
+            return
+
+        # recovery is searched from the end of the photostim (relative to go cue)
+        stim_ends = (experiment.PhotostimEvent
+                     * experiment.TrialEventTimes.proj('go_time')
+                     * stim_trials.proj()).proj(
+            stim_end='photostim_event_time + duration - go_time').fetch('stim_end')
+        time_window = (float(np.nanmedian(stim_ends.astype(float))), self.recovery_params['window_end'])
+
+        recovery_times = compute_recovery_time(
+            delta_sels, ctrl_psths, time_stamps, time_window,
+            threshold=self.recovery_params['threshold'],
+            n_boot=self.recovery_params['n_boot'], seed=self.recovery_params['seed'])
+
+        entry = {**key, 'unit_count': len(delta_sels),
+                 'time_stamps': time_stamps,
+                 'control_selectivity': np.nanmean(ctrl_psths, axis=0),
+                 'delta_selectivity': np.nanmean(delta_sels, axis=0),
+                 'recovery_window': np.array(time_window),
+                 'recovered_fraction': len(recovery_times) / self.recovery_params['n_boot']}
+
+        if len(recovery_times):
+            ci_alpha = (100 - self.recovery_params['ci']) / 2
+            entry.update(recovery_time=recovery_times.mean(),
+                         recovery_time_std=recovery_times.std(),
+                         recovery_time_ci_low=np.percentile(recovery_times, ci_alpha),
+                         recovery_time_ci_high=np.percentile(recovery_times, 100 - ci_alpha))
+
+        self.insert1(entry)
+
+
+@schema
+class CodingDirection(Versioned, dj.Computed):
+    """
+    Coding direction (contra vs. ipsi trial-averaged firing rate difference) of the units
+    recorded in one brain area and hemisphere of a session, computed within an EventPeriod,
+    and the CD-projected trial PSTHs
+    """
+
+    definition = """
+    -> experiment.Session
+    -> lab.BrainArea
+    -> lab.Hemisphere
+    -> experiment.EventPeriod
+    ---
+    cd_time_period:         longblob  # (s) (start, end) of the period, relative to go cue - median over trials
+    cd_fold_count=0:        tinyint   # number of cross-validation folds (0: no cross-validation)
+    time_stamps:            longblob  # (s) psth time-stamps, relative to go cue
+    contra_trials:          longblob  # trial numbers of the contra-trials
+    ipsi_trials:            longblob  # trial numbers of the ipsi-trials
+    proj_contra_trial:      longblob  # (trial# x time) CD-projected contra-trial psth
+    proj_ipsi_trial:        longblob  # (trial# x time) CD-projected ipsi-trial psth
+    """
+
+    class Unit(dj.Part):
+        definition = """
+        -> master
+        -> ephys.Unit
+        ---
+        cd_weight:  float  # coding direction unit-vector element for this unit
+        """
+
+    cd_fold_count = 0  # set > 1 for k-fold cross-validated CD projection
+    cd_seed = 0  # random seed of the cross-validation folds
+    psth_params = UnitPsth.psth_params  # binning of the trial PSTHs - as in UnitPsth
+    version_params = ('cd_fold_count', 'cd_seed', 'psth_params')
+
+    key_source = experiment.EventPeriod * (
+            experiment.Session * lab.BrainArea * lab.Hemisphere
+            & (ephys.ProbeInsertion.InsertionLocation * experiment.BrainLocation
+               & (ephys.Unit & 'unit_quality != "all"'))
+            & experiment.TrialEventTimes.proj())
+
+    fetched_tables = (ephys.TrialSpikes, experiment.TrialEventTimes)  # read by make besides the parent tables
+
+    def make(self, key):
+        log.debug('CodingDirection.make(): key: {}'.format(key))
+
+        location = {'brain_area': key['brain_area'], 'hemisphere': key['hemisphere']}
+        unit_keys = (ephys.Unit & key & 'unit_quality != "all"'
+                     & (ephys.ProbeInsertion.InsertionLocation * experiment.BrainLocation & location)).fetch(
+            'KEY', order_by='unit')
+
+        time_period = get_event_period_time(key['period'], key)
+
+        cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps, contra_trials, ipsi_trials = \
+            compute_CD_projected_psth(unit_keys, time_period=time_period,
+                                      fold_count=self.cd_fold_count, seed=self.cd_seed, return_trials=True)
+
+        self.insert1({**key, 'cd_time_period': np.array(time_period),
+                      'cd_fold_count': self.cd_fold_count if self.cd_fold_count > 1 else 0,
+                      'time_stamps': time_stamps,
+                      'contra_trials': np.array([t['trial'] for t in contra_trials]),
+                      'ipsi_trials': np.array([t['trial'] for t in ipsi_trials]),
+                      'proj_contra_trial': proj_contra_trial,
+                      'proj_ipsi_trial': proj_ipsi_trial})
+        self.Unit.insert({**key, **u, 'cd_weight': w} for u, w in zip(unit_keys, cd_vec))
+
+    @classmethod
+    def get_entry(cls, units, period):
+        """
+        Key of the coding direction of the session, brain area and hemisphere of the specified units, for the
+        specified EventPeriod - None if not populated, or computed on other units than the specified ones
+        (e.g. on all the units of the brain area, when the specified units are a subset)
+        """
+        locations = (experiment.Session * lab.BrainArea * lab.Hemisphere
+                     & (ephys.ProbeInsertion.InsertionLocation * experiment.BrainLocation & units))
+        cd = cls & locations & {'period': period}
+        if len(cd) != 1:
+            return None
+        unit_count = len(ephys.Unit & units)
+        cd_units = (cls.Unit & cd).proj()
+        if len(cd_units) != unit_count or len(ephys.Unit & units & cd_units) != unit_count:
+            return None
+        return cd.fetch1('KEY')
+
+    @classmethod
+    def get_projected_psth(cls, units, period):
+        """
+        Retrieve the precomputed coding direction of the session, brain area and hemisphere
+        of the specified units, for the specified EventPeriod - the units must be those the coding
+        direction was computed on (see get_entry), use compute_CD_projected_psth for other units
+        :return: coding direction unit-vector,
+                 contra-trials CD projected trial-psth,
+                 ipsi-trials CD projected trial-psth,
+                 psth time-stamps,
+                 CD time period
+        """
+        key = cls.get_entry(units, period)
+        if key is None:
+            raise dj.DataJointError('No CodingDirection computed on the specified units for period {}'.format(period))
+        cd = (cls & key).fetch1()
+        cd_vec = (cls.Unit & cd).fetch('cd_weight', order_by='unit')
+        return (cd_vec, cd['proj_contra_trial'], cd['proj_ipsi_trial'],
+                cd['time_stamps'], tuple(cd['cd_time_period']))
+
+
+@schema
+class NoiseCorrelation(Versioned, dj.Computed):
+    """
+    Trial-by-trial spike-count (noise) correlation between all the simultaneously recorded ALM units of
+    a probe insertion, within an EventPeriod - spike counts are z-scored within each trial condition
+    """
+
+    definition = """
+    -> ephys.ProbeInsertion
+    -> ephys.ClusteringMethod
+    -> experiment.EventPeriod
+    ---
+    unit_count:             int
+    trial_count:            int
+    units=null:             longblob  # (unit#,) unit numbers - order of the correlation matrix rows/columns
+    noise_corr=null:        longblob  # condensed upper triangle (above the diagonal) of the correlation matrix
+    site_distance=null:     longblob  # (um) condensed upper triangle of the unit electrode-site distance matrix
+    """
+
+    trial_condition_names = ('good_noearlylick_left_hit', 'good_noearlylick_right_hit')
+    min_trial_count = 5  # minimum number of trials per condition
+    version_params = ('trial_condition_names', 'min_trial_count')
+
+    key_source = experiment.EventPeriod * (ephys.ProbeInsertion * ephys.ClusteringMethod
+                                           & (ephys.ProbeInsertion.InsertionLocation * experiment.BrainLocation
+                                              & 'brain_area = "ALM"')
+                                           & (ephys.Unit & 'unit_quality != "all"')
+                                           & experiment.TrialEventTimes.proj())
+
+    fetched_tables = (ephys.TrialSpikes, experiment.TrialEventTimes)  # read by make besides the parent tables
+
+    def make(self, key):
+        log.debug('NoiseCorrelation.make(): key: {}'.format(key))
+
+        units = ((ephys.Unit & key & 'unit_quality != "all"') * ephys.ProbeInsertion.ElectrodeSitePosition)
+        unit_keys, posx, posy, posz = units.fetch(
+            'KEY', 'electrode_posx', 'electrode_posy', 'electrode_posz', order_by='unit')
+
+        cond_trials = [(TrialCondition.get_trials(c) & key & ephys.TrialSpikes).fetch('KEY', order_by='trial')
+                       for c in self.trial_condition_names]
+        trial_count = sum(len(t) for t in cond_trials)
+
+        if len(unit_keys) < 2 or min(len(t) for t in cond_trials) < self.min_trial_count:
+            log.warning('not enough units or trials per condition - skipping')
+            self.insert1({**key, 'unit_count': len(unit_keys), 'trial_count': trial_count})
+            return
+
+        trial_keys = [t for trials in cond_trials for t in trials]
+        conditions = np.repeat(np.arange(len(cond_trials)), [len(t) for t in cond_trials])
+
+        period_windows = _get_trial_period_windows(key['period'], key, trial_keys)
+        spike_counts = compute_period_spike_counts(unit_keys, trial_keys, period_windows)
+
+        noise_corr = compute_noise_correlation(spike_counts, conditions)
+
+        site_pos = np.column_stack([posx, posy, posz])
+        site_distance = np.linalg.norm(site_pos[:, None, :] - site_pos[None, :, :], axis=-1)
+
+        upper = np.triu_indices(len(unit_keys), k=1)
+        self.insert1({**key, 'unit_count': len(unit_keys), 'trial_count': trial_count,
+                      'units': np.array([u['unit'] for u in unit_keys]),
+                      'noise_corr': noise_corr[upper].astype(np.float32),
+                      'site_distance': site_distance[upper].astype(np.float32)})
+
+    @classmethod
+    def get_correlation_matrix(cls, key):
+        """
+        Full (unit# x unit#) noise correlation matrix of one entry - return unit numbers, correlation matrix
+        """
+        units, noise_corr = (cls & key).fetch1('units', 'noise_corr')
+        corr_mat = np.eye(len(units))
+        upper = np.triu_indices(len(units), k=1)
+        corr_mat[upper] = noise_corr
+        corr_mat.T[upper] = noise_corr
+        return units, corr_mat
+
+    @classmethod
+    def get_correlation_vs_distance(cls, restriction={}):
+        """
+        Noise correlation and electrode-site distance of all the unit pairs in the selected entries
+        - return (pair#,) distances (um), (pair#,) correlations
+        """
+        distances, noise_corrs = (cls & restriction & 'noise_corr is not NULL').fetch('site_distance', 'noise_corr')
+        if not len(distances):
+            return np.empty(0), np.empty(0)
+        return np.concatenate(distances), np.concatenate(noise_corrs)
+
+
+def get_event_period_time(period, session_key):
+    """
+    Start and end time of an EventPeriod relative to go cue - median over the trials of a session
+    """
+    start_event, start_tshift, end_event, end_tshift = (experiment.EventPeriod & {'period': period}).fetch1(
+        'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
+
+    _, event_times = experiment.TrialEventTimes.get_event_times(session_key, [start_event, end_event], relative_to='go')
+    start_time, end_time = np.nanmedian(event_times, axis=0)
+
+    return float(start_time) + start_tshift, float(end_time) + end_tshift
+
+
+def align_spike_trains(spike_trains, offsets):
+    """
+    Shift each spike-time array by its own offset (e.g. event time relative to the go-cue, per trial)
+    Spike times are flattened into one array (CSR layout) and shifted with a single subtraction
+    """
+    spike_trains = [np.asarray(s, dtype=float).ravel() for s in spike_trains]
+    train_lengths = [len(s) for s in spike_trains]
+    if not spike_trains:
+        return []
+
+    aligned = np.concatenate(spike_trains) - np.repeat(np.asarray(offsets, dtype=float), train_lengths)
+    return np.split(aligned, np.cumsum(train_lengths)[:-1])
+
+
+def compute_spike_counts(spike_trains, bin_edges, offsets=None):
+    """
+    Bin a sequence of spike-time arrays (e.g. per-trial TrialSpikes) in a single pass - return (train#, bin#)
+    Spike times are flattened into one array with a per-spike row index (CSR layout),
+    so that all trains are binned with one searchsorted and one bincount (same binning as np.histogram)
+    If "offsets" (one per train) is specified, spike times are re-aligned to them before binning
+    """
+    bin_edges = np.asarray(bin_edges)
+    bin_count = len(bin_edges) - 1
+
+    spike_trains = [np.asarray(s, dtype=float).ravel() for s in spike_trains]
+    train_lengths = [len(s) for s in spike_trains]
+    if not sum(train_lengths):
+        return np.zeros((len(spike_trains), bin_count), dtype=int)
+
+    spikes = np.concatenate(spike_trains)
+    rows = np.repeat(np.arange(len(spike_trains)), train_lengths)
+    if offsets is not None:
+        spikes = spikes - np.asarray(offsets, dtype=float)[rows]
+
+    bins = np.searchsorted(bin_edges, spikes, side='right') - 1
+    bins[spikes == bin_edges[-1]] = bin_count - 1  # last bin is right-inclusive
+    valid = np.logical_and(bins >= 0, bins < bin_count)
+
+    counts = np.bincount(rows[valid] * bin_count + bins[valid], minlength=len(spike_trains) * bin_count)
+    return counts.reshape(len(spike_trains), bin_count)
+
+
+def _get_trial_period_windows(period, session_key, trial_keys):
+    """
+    Per-trial (start, end) of an EventPeriod relative to go cue - return (trial#, 2), NaN if an event is missing
+    """
+    start_event, start_tshift, end_event, end_tshift = (experiment.EventPeriod & {'period': period}).fetch1(
+        'start_event_type', 'start_time_shift', 'end_event_type', 'end_time_shift')
+
+    event_trial_keys, event_times = experiment.TrialEventTimes.get_event_times(
+        session_key, [start_event, end_event], relative_to='go')
+    event_times = dict(zip((k['trial'] for k in event_trial_keys), event_times + [start_tshift, end_tshift]))
+
+    return np.array([event_times.get(t['trial'], (np.nan, np.nan)) for t in trial_keys])
+
+
+def compute_period_spike_counts(unit_keys, trial_keys, period_windows):
+    """
+    Spike count of each unit in each trial within that trial's (start, end) window,
+    from a single TrialSpikes fetch - return (trial#, unit#)
+    """
+    unit_attrs = ephys.Unit.primary_key
+    unit_idx = {tuple(u[a] for a in unit_attrs): i for i, u in enumerate(unit_keys)}
+    trial_idx = {t['trial']: i for i, t in enumerate(trial_keys)}
 
-        pref = ('ipsi-selective' if ipsi_frate.mean() > contra_frate.mean() else 'contra-selective')
+    spk_keys, spike_trains = (ephys.TrialSpikes & list(unit_keys) & list(trial_keys)).fetch('KEY', 'spike_times')
+    rows = np.array([trial_idx[k['trial']] * len(unit_idx) + unit_idx[tuple(k[a] for a in unit_attrs)]
+                     for k in spk_keys], dtype=int)
 
-        log.debug('... prefers: {}'.format(pref))
+    train_lengths = [len(s) for s in spike_trains]
+    if not sum(train_lengths):
+        return np.zeros((len(trial_idx), len(unit_idx)))
 
-        self.insert1({**key, 'unit_selectivity': pref})
+    spikes = np.concatenate(spike_trains)
+    spike_rows = np.repeat(rows, train_lengths)
+    starts, ends = period_windows[spike_rows // len(unit_idx)].T
+    in_window = np.logical_and(spikes >= starts, spikes < ends)
+
+    counts = np.bincount(spike_rows[in_window], minlength=len(trial_idx) * len(unit_idx))
+    return counts.reshape(len(trial_idx), len(unit_idx)).astype(float)
+
+
+def compute_noise_correlation(spike_counts, conditions):
+    """
+    Pairwise correlation of trial-by-trial spike count fluctuations - spike counts (trial#, unit#) are
+    z-scored within each condition (e.g. trial instruction), then all pairs are correlated with a single
+    matrix product - return (unit#, unit#), NaN for units without count variance
+    """
+    z_counts = np.zeros_like(spike_counts, dtype=float)
+    for cond in np.unique(conditions):
+        cond_counts = spike_counts[conditions == cond]
+        std = cond_counts.std(axis=0)
+        z_counts[conditions == cond] = np.divide(cond_counts - cond_counts.mean(axis=0), std,
+                                                 out=np.zeros_like(cond_counts, dtype=float), where=std > 0)
+
+    cov = z_counts.T @ z_counts
+    norm = np.sqrt(np.diag(cov))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return cov / np.outer(norm, norm)
 
 
 def compute_unit_psth(unit_key, trial_keys, per_trial=False):
@@ -456,7 +1233,7 @@ def compute_unit_psth(unit_key, trial_keys, per_trial=False):
     spikes = q.fetch('spike_times')
 
     if per_trial:
-        trial_psth = np.vstack(np.histogram(spike, bins=binning)[0] / bin_size for spike in spikes)
+        trial_psth = compute_spike_counts(spikes, binning) / bin_size
         return trial_psth, binning[1:]
     else:
         spikes = np.concatenate(spikes)
@@ -465,6 +1242,30 @@ def compute_unit_psth(unit_key, trial_keys, per_trial=False):
         return psth, edges[1:]
 
 
+def compute_unit_trial_psths(unit_keys, trial_keys):
+    """
+    Compute trial-level psth for all the specified units and trials of a session,
+    from a single TrialSpikes fetch - return (unit#, trial#, time), psth time-stamps
+    (a unit without TrialSpikes for a trial contributes a zero psth)
+    """
+    xmin, xmax, bin_size = UnitPsth.psth_params.values()
+    binning = np.arange(xmin, xmax, bin_size)
+
+    unit_attrs = ephys.Unit.primary_key
+    unit_idx = {tuple(u[a] for a in unit_attrs): i for i, u in enumerate(unit_keys)}
+    trial_idx = {t['trial']: i for i, t in enumerate(trial_keys)}
+
+    spike_trains = [np.empty(0)] * (len(unit_idx) * len(trial_idx))
+    if unit_idx and trial_idx:
+        q = ephys.TrialSpikes & list(unit_keys) & list(trial_keys)
+        for spk_key, spikes in zip(*q.fetch('KEY', 'spike_times')):
+            u, t = unit_idx[tuple(spk_key[a] for a in unit_attrs)], trial_idx[spk_key['trial']]
+            spike_trains[u * len(trial_idx) + t] = spikes
+
+    trial_psths = compute_spike_counts(spike_trains, binning) / bin_size
+    return trial_psths.reshape(len(unit_idx), len(trial_idx), -1), binning[1:]
+
+
 def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     """
     Coding direction here is a vector of length: len(unit_keys)
@@ -473,6 +1274,8 @@ def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     :param contra_psths: unit# x (trial-ave psth, psth_edge)
     :param ipsi_psths: unit# x (trial-ave psth, psth_edge)
     """
+    contra_psths, ipsi_psths = list(contra_psths), list(ipsi_psths)
+
     if not time_period:
         contra_tmin, contra_tmax = zip(*((k[1].min(), k[1].max()) for k in contra_psths))
         ipsi_tmin, ipsi_tmax = zip(*((k[1].min(), k[1].max()) for k in ipsi_psths))
@@ -489,11 +1292,52 @@ def compute_coding_direction(contra_psths, ipsi_psths, time_period=None):
     return cd_vec / np.linalg.norm(cd_vec)
 
 
-def compute_CD_projected_psth(units, time_period=None):
+def project_trial_psths(trial_psths, cd_vec):
+    """
+    Project (unit#, trial#, time) trial psths onto the coding direction - return (trial#, time)
+    """
+    return np.einsum('utb,u->tb', trial_psths, cd_vec)
+
+
+def _cross_validated_projection(contra_trial_psths, ipsi_trial_psths, time_stamps, time_period,
+                                fold_count, seed=None):
+    """
+    k-fold cross-validated CD projection: the trials of each fold are projected onto the CD
+    computed from the trials of the other folds
+    :return: fold-averaged coding direction unit-vector, contra and ipsi CD projected trial-psth
+    """
+    rng = np.random.RandomState(seed)
+    contra_folds = np.array_split(rng.permutation(contra_trial_psths.shape[1]), fold_count)
+    ipsi_folds = np.array_split(rng.permutation(ipsi_trial_psths.shape[1]), fold_count)
+
+    proj_contra_trial = np.full(contra_trial_psths.shape[1:], np.nan)
+    proj_ipsi_trial = np.full(ipsi_trial_psths.shape[1:], np.nan)
+    cd_vecs = []
+    for contra_test, ipsi_test in zip(contra_folds, ipsi_folds):
+        contra_train = np.setdiff1d(np.arange(contra_trial_psths.shape[1]), contra_test)
+        ipsi_train = np.setdiff1d(np.arange(ipsi_trial_psths.shape[1]), ipsi_test)
+
+        cd_vec = compute_coding_direction(
+            zip(contra_trial_psths[:, contra_train].mean(axis=1), repeat(time_stamps)),
+            zip(ipsi_trial_psths[:, ipsi_train].mean(axis=1), repeat(time_stamps)),
+            time_period=time_period)
+
+        proj_contra_trial[contra_test] = project_trial_psths(contra_trial_psths[:, contra_test], cd_vec)
+        proj_ipsi_trial[ipsi_test] = project_trial_psths(ipsi_trial_psths[:, ipsi_test], cd_vec)
+        cd_vecs.append(cd_vec)
+
+    cd_vec = np.mean(cd_vecs, axis=0)
+    return cd_vec / np.linalg.norm(cd_vec), proj_contra_trial, proj_ipsi_trial
+
+
+def compute_CD_projected_psth(units, time_period=None, fold_count=None, seed=None, return_trials=False):
     """
     Routine for Coding Direction computation on all the units in the specified unit_keys
     Coding Direction is calculated in the specified time_period
     :param: unit_keys - list of unit_keys
+    :param: fold_count - if specified (> 1), cross-validated CD: each trial is projected onto
+            the CD computed without its fold
+    :param: return_trials - also return the contra and ipsi trial keys
     :return: coding direction unit-vector,
              contra-trials CD projected trial-psth,
              ipsi-trials CD projected trial-psth
@@ -519,29 +1363,183 @@ def compute_CD_projected_psth(units, time_period=None):
         'good_noearlylick_left_hit' if unit_hemi == 'left' else 'good_noearlylick_right_hit')
                      & session_key & ephys.TrialSpikes).fetch('KEY')
 
-    # get per-trial unit psth for all units - unit# x (trial# x time)
-    contra_trial_psths, contra_edges = zip(*(compute_unit_psth(unit, contra_trials, per_trial=True)
-                                             for unit in units))
-    ipsi_trial_psths, ipsi_edges = zip(*(compute_unit_psth(unit, ipsi_trials, per_trial=True)
-                                         for unit in units))
+    # get per-trial unit psth for all units - unit# x trial# x time
+    contra_trial_psths, time_stamps = compute_unit_trial_psths(units, contra_trials)
+    ipsi_trial_psths, _ = compute_unit_trial_psths(units, ipsi_trials)
 
-    # compute trial-ave unit psth
-    contra_psths = zip((p.mean(axis=0) for p in contra_trial_psths), contra_edges)
-    ipsi_psths = zip((p.mean(axis=0) for p in ipsi_trial_psths), ipsi_edges)
+    if fold_count and fold_count > 1:
+        cd_vec, proj_contra_trial, proj_ipsi_trial = _cross_validated_projection(
+            contra_trial_psths, ipsi_trial_psths, time_stamps, time_period, fold_count, seed=seed)
+    else:
+        # compute coding direction from the trial-ave unit psth
+        cd_vec = compute_coding_direction(zip(contra_trial_psths.mean(axis=1), repeat(time_stamps)),
+                                          zip(ipsi_trial_psths.mean(axis=1), repeat(time_stamps)),
+                                          time_period=time_period)
 
-    # compute coding direction
-    cd_vec = compute_coding_direction(contra_psths, ipsi_psths, time_period=time_period)
+        # get coding projection per trial - trial# x time
+        proj_contra_trial = project_trial_psths(contra_trial_psths, cd_vec)
+        proj_ipsi_trial = project_trial_psths(ipsi_trial_psths, cd_vec)
 
-    # get time vector, relying on all units PSTH shares the same time vector
-    time_stamps = contra_edges[0]
+    if return_trials:
+        return cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps, contra_trials, ipsi_trials
 
-    # get coding projection per trial - trial# x unit# x time
-    contra_psth_per_trial = np.dstack(contra_trial_psths)
-    ipsi_psth_per_trial = np.dstack(ipsi_trial_psths)
+    return cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps
 
-    proj_contra_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in contra_psth_per_trial)  # trial# x time
-    proj_ipsi_trial = np.vstack(np.dot(tr_u, cd_vec) for tr_u in ipsi_psth_per_trial)    # trial# x time
 
-    return cd_vec, proj_contra_trial, proj_ipsi_trial, time_stamps
+def compute_selectivity_change(units, ctrl_cond_names, stim_cond_names, min_trial_counts=(5, 2)):
+    """
+    Selectivity (preferred - non-preferred instruction PSTH) of each selective unit,
+    for control and photostim trials
+    :param units: units query, with UnitSelectivity available
+    :param ctrl_cond_names: (left, right) control TrialCondition names
+    :param stim_cond_names: (left, right) photostim TrialCondition names
+    :param min_trial_counts: minimum (control, stim) trial counts per instruction for a unit to be included
+    :return: control selectivity (unit# x time),
+             selectivity change - control minus stim (unit# x time),
+             psth time-stamps
+    """
+    units = (units.proj() * UnitSelectivity * ephys.ProbeInsertion.InsertionLocation * experiment.BrainLocation
+             & 'unit_selectivity != "non-selective"')
+    unit_keys, selectivities, hemis = units.fetch('KEY', 'unit_selectivity', 'hemisphere')
+
+    # trial count criteria - trial sets are session-wide, so count once per session
+    cond_names = list(ctrl_cond_names) + list(stim_cond_names)
+    min_counts = [min_trial_counts[0]] * 2 + [min_trial_counts[1]] * 2
+    session_ok = {}
+    for session_key in (experiment.Session & units).fetch('KEY'):
+        session_ok[(session_key['subject_id'], session_key['session'])] = all(
+            len(TrialCondition.get_trials(cond_name) & session_key) >= min_count
+            for cond_name, min_count in zip(cond_names, min_counts))
+
+    # all unit psths for the 4 trial conditions - one fetch per condition
+    unit_attrs = ephys.Unit.primary_key
+    psths = []
+    for cond_name in cond_names:
+        cond_unit_keys, cond_psths = (UnitPsth & units.proj() & {'trial_condition_name': cond_name}
+                                      & 'unit_psth is not NULL').fetch('KEY', 'unit_psth')
+        psths.append({tuple(k[a] for a in unit_attrs): p for k, p in zip(cond_unit_keys, cond_psths)})
+
+    unit_ids, signs = [], []
+    for unit_key, selectivity, hemi in zip(unit_keys, selectivities, hemis):
+        unit_id = tuple(unit_key[a] for a in unit_attrs)
+        if not session_ok[(unit_key['subject_id'], unit_key['session'])]:
+            continue
+        if not all(unit_id in cond_psths for cond_psths in psths):
+            continue
+        unit_ids.append(unit_id)
+        # preferred side: the hemisphere for ipsi-selective units, the opposite one for contra-selective units
+        signs.append(1 if (selectivity == 'ipsi-selective') == (hemi == 'left') else -1)
+
+    if not unit_ids:
+        return np.empty((0, 0)), np.empty((0, 0)), None
+
+    time_stamps = psths[0][unit_ids[0]][1][1:]
+
+    # smooth each (unit# x time) stack in one go
+    ctrl_left, ctrl_right, stim_left, stim_right = (
+        smooth_psth(np.vstack([cond_psths[u][0] for u in unit_ids])) for cond_psths in psths)
+
+    signs = np.array(signs)[:, None]
+    ctrl_psths = signs * (ctrl_left - ctrl_right)
+    stim_psths = signs * (stim_left - stim_right)
+
+    return ctrl_psths, ctrl_psths - stim_psths, time_stamps
+
+
+# ---- bootstrap / permutation utilities ----
+
+def bootstrap_sample_counts(sample_count, n_boot=1000, seed=None):
+    """
+    Draw all bootstrap resamples at once - return (n_boot, sample_count) matrix
+    of the number of times each sample is drawn in each resample
+    """
+    rng = np.random.RandomState(seed)
+    sample_idx = rng.randint(0, sample_count, size=(n_boot, sample_count))
+    flat_idx = (np.arange(n_boot)[:, None] * sample_count + sample_idx).ravel()
+    return np.bincount(flat_idx, minlength=n_boot * sample_count).reshape(n_boot, sample_count)
+
+
+def _resampled_nanmean(sample_counts, arrays):
+    """
+    nan-mean of each (sample# x feature#) array for each resample,
+    as the matrix product of the resample counts and the data
+    """
+    means = []
+    for data in arrays:
+        valid = ~np.isnan(data)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means.append(sample_counts @ np.where(valid, data, 0) / (sample_counts @ valid))
+    return means
+
+
+def _permuted_mean_diff(perm_weights, data):
+    return perm_weights @ data
+
+
+def bootstrap_nanmean(*arrays, n_boot=1000, seed=None, n_jobs=1, chunk_size=250):
+    """
+    Bootstrap the nan-mean over samples (axis 0) of one or more sample-aligned arrays,
+    applying the same resamples to all arrays
+    :param arrays: arrays of shape (sample#, ...) with the same sample#
+    :param seed: random seed, for reproducible resamples
+    :param n_jobs: number of processes to spread the chunks of resamples over
+    :param chunk_size: number of resamples computed per batch
+    :return: list of (n_boot, ...) arrays of resampled means - one per input array
+    """
+    sample_count = len(arrays[0])
+    if any(len(a) != sample_count for a in arrays):
+        raise ValueError('All arrays must have the same number of samples')
+
+    flat_arrays = [np.asarray(a, dtype=float).reshape(sample_count, -1) for a in arrays]
+
+    sample_counts = bootstrap_sample_counts(sample_count, n_boot=n_boot, seed=seed)
+    chunks = np.array_split(sample_counts, max(1, math.ceil(n_boot / chunk_size)))
+
+    chunk_means = map_chunks(_resampled_nanmean, chunks, (flat_arrays,), n_jobs=n_jobs)
+
+    return [np.vstack(means).reshape((n_boot,) + np.shape(a)[1:])
+            for means, a in zip(zip(*chunk_means), arrays)]
+
+
+def permutation_test(a, b, n_perm=1000, seed=None, n_jobs=1, chunk_size=250):
+    """
+    Two-sided permutation test on the difference of means (over axis 0) of samples a and b,
+    with all label permutations drawn at once and applied as a single weighted matrix product
+    :return: observed difference of means, p-value (per feature)
+    """
+    a, b = np.asarray(a, dtype=float), np.asarray(b, dtype=float)
+    n_a, n_b = len(a), len(b)
+    data = np.concatenate([a, b]).reshape(n_a + n_b, -1)
+
+    rng = np.random.RandomState(seed)
+    ranks = np.argsort(np.argsort(rng.rand(n_perm, n_a + n_b), axis=1), axis=1)
+    perm_weights = np.where(ranks < n_a, 1 / n_a, -1 / n_b)
+
+    chunks = np.array_split(perm_weights, max(1, math.ceil(n_perm / chunk_size)))
+    null_diffs = np.vstack(map_chunks(_permuted_mean_diff, chunks, (data,), n_jobs=n_jobs))
+
+    observed = data[:n_a].mean(axis=0) - data[n_a:].mean(axis=0)
+    p_value = ((np.abs(null_diffs) >= np.abs(observed)).sum(axis=0) + 1) / (n_perm + 1)
+
+    feature_shape = a.shape[1:]
+    return observed.reshape(feature_shape), p_value.reshape(feature_shape)
+
+
+def compute_recovery_time(delta_sels, ctrl_psths, time_stamps, time_window, threshold=0.2,
+                          n_boot=1000, seed=None, n_jobs=1):
+    """
+    Bootstrap (over units) the recovery time of the selectivity following a photostimulation:
+    the first time point within "time_window" where the unit-averaged selectivity change
+    falls below "threshold" of the unit-averaged control selectivity
+    :param delta_sels: selectivity change (unit# x time)
+    :param ctrl_psths: control selectivity (unit# x time)
+    :return: bootstrapped recovery times - resamples that never recover are excluded
+    """
+    boot_delta, boot_ctrl = bootstrap_nanmean(delta_sels, ctrl_psths, n_boot=n_boot, seed=seed, n_jobs=n_jobs)
 
+    with np.errstate(invalid='ignore', divide='ignore'):
+        recovered = boot_delta / boot_ctrl < threshold
+    recovered &= np.logical_and(time_stamps > time_window[0], time_stamps < time_window[1])
 
+    is_recovered = recovered.any(axis=1)
+    return time_stamps[recovered.argmax(axis=1)[is_recovered]]
@@ -0,0 +1,53 @@
+'''
+Smoothing of time series along one axis - e.g. a single PSTH or a (unit# x time) stack of PSTHs
+'''
+
+from functools import lru_cache
+
+import numpy as np
+from scipy import signal
+
+
+@lru_cache(maxsize=64)
+def get_kernel(kernel='boxcar', window_size=5):
+    """
+    Build (and cache) a normalized smoothing kernel
+    :param kernel: 'boxcar' - centered moving average over "window_size" samples
+                   'gaussian' - gaussian with a standard deviation of "window_size" samples, truncated at 3 std
+                   'causal' - trailing moving average over the current and the "window_size - 1" previous samples
+    """
+    if kernel == 'boxcar':
+        window_size = int(window_size)
+        kern = np.full((window_size, ), 1 / window_size)
+    elif kernel == 'gaussian':
+        half_width = int(np.ceil(3 * window_size))
+        kern = np.exp(-0.5 * (np.arange(-half_width, half_width + 1) / window_size) ** 2)
+        kern = kern / kern.sum()
+    elif kernel == 'causal':
+        # zero-padded on the leading half so that a centered ("same") convolution only sees the past
+        window_size = int(window_size)
+        kern = np.concatenate([np.zeros(window_size - 1), np.full((window_size, ), 1 / window_size)])
+    else:
+        raise ValueError('Unknown smoothing kernel: {}'.format(kernel))
+
+    kern.setflags(write=False)
+    return kern
+
+
+def smooth(data, window_size=None, kernel='boxcar', axis=-1, mode='same'):
+    """
+    Smooth "data" along "axis" with one convolution for the whole array
+    :param data: 1-D time series, or n-D array of time series (e.g. unit# x time)
+    :param window_size: kernel size in samples (see get_kernel) - 3% of the data length along "axis" if not specified
+    :param mode: convolution mode - 'same' keeps the data length, 'valid' drops the edges
+    """
+    data = np.asarray(data, dtype=float)
+    if not window_size:
+        window_size = int(.03 * data.shape[axis])
+    window_size = max(window_size, 1)
+
+    kern = get_kernel(kernel, window_size)
+    kern_shape = [1] * data.ndim
+    kern_shape[axis] = len(kern)
+
+    return signal.convolve(data, kern.reshape(kern_shape), mode=mode)
@@ -1,17 +1,67 @@
-
 '''
 MAP Motion Tracking Schema
 '''
 
+import logging
+
+import numpy as np
 import datajoint as dj
+from scipy import signal
 
 from . import experiment
 from . import get_schema_name
+from .compute import Versioned
 
 schema = dj.schema(get_schema_name('tracking'))
+log = logging.getLogger(__name__)
 [experiment]  # NOQA flake8
 
 
+@schema
+class TrackingDevice(dj.Lookup):
+    definition = """
+    tracking_device:                    varchar(20)     # device type/function
+    ---
+    tracking_position:                  varchar(20)     # device position
+    sampling_rate:                      decimal(8, 4)   # sampling rate (Hz)
+    tracking_device_description:        varchar(100)    # device description
+    """
+
+
+@schema
+class Tracking(dj.Imported):
+    '''
+    Video feature tracking.
+    Position values in px; camera location is fixed & real-world position
+    can be computed from px values.
+    Tracking samples start at the beginning of the trial.
+    '''
+
+    definition = """
+    -> experiment.SessionTrial
+    -> TrackingDevice
+    ---
+    tracking_samples:           int             # number of events (possibly frame number, relative to the start of the trial)
+    """
+
+    class JawTracking(dj.Part):
+        definition = """
+        -> Tracking
+        ---
+        jaw_x:                  longblob        # jaw x location (px)
+        jaw_y:                  longblob        # jaw y location (px)
+        jaw_likelihood=null:    longblob        # jaw location tracking likelihood
+        """
+
+    class TongueTracking(dj.Part):
+        definition = """
+        -> Tracking
+        ---
+        tongue_x:               longblob        # tongue x location (px)
+        tongue_y:               longblob        # tongue y location (px)
+        tongue_likelihood=null: longblob        # tongue location tracking likelihood
+        """
+
 
 @schema
 class LickTrace(dj.Imported):
@@ -20,4 +70,93 @@ class LickTrace(dj.Imported):
     ---
     lick_trace: longblob
     lick_trace_timestamps: longblob
-    """
\ No newline at end of file
+    """
+
+
+@schema
+class JawPhase(Versioned, dj.Computed):
+    definition = """  # band-passed jaw movement, with its instantaneous phase and amplitude
+    -> Tracking
+    ---
+    filtered_jaw:       longblob    # band-passed jaw_y
+    jaw_phase:          longblob    # (rad) instantaneous phase, in [-pi, pi]
+    jaw_amplitude:      longblob    # instantaneous amplitude
+    """
+
+    jaw_band = (5, 15)  # (Hz) band-pass of the jaw movement
+    filter_order = 5
+    version_params = ('jaw_band', 'filter_order')
+
+    # all trials of a session are filtered together
+    key_source = (experiment.Session * TrackingDevice) & Tracking.JawTracking
+
+    def make(self, key):
+        log.debug('JawPhase.make(): key: {}'.format(key))
+
+        fs = float((TrackingDevice & key).fetch1('sampling_rate'))
+        trial_keys, jaws = (Tracking.JawTracking & key).fetch('KEY', 'jaw_y')
+
+        filtered_jaw, phase, amplitude = compute_jaw_phase(jaws, fs, band=self.jaw_band, order=self.filter_order)
+
+        self.insert({**k, 'filtered_jaw': f, 'jaw_phase': p, 'jaw_amplitude': a}
+                    for k, f, p, a in zip(trial_keys, filtered_jaw, phase, amplitude))
+
+
+def _left_aligned(traces, fill=0.):
+    """
+    Stack traces of different lengths into a (trial#, time) matrix, left-aligned - return matrix, trace lengths
+    """
+    lengths = np.array([len(t) for t in traces])
+    stacked = np.full((len(traces), lengths.max()), fill)
+    stacked[np.arange(lengths.max())[None, :] < lengths[:, None]] = np.concatenate(traces)
+    return stacked, lengths
+
+
+def _reverse_rows(stacked, lengths):
+    """
+    Reverse the first "lengths[i]" samples of each row i
+    """
+    idx = np.clip(lengths[:, None] - 1 - np.arange(stacked.shape[1])[None, :], 0, None)
+    return np.take_along_axis(stacked, idx, axis=1)
+
+
+def filtfilt_trials(b, a, traces):
+    """
+    Zero-phase filtering of traces of different lengths, with both filter passes run once on
+    a (trial#, time) matrix - same as signal.filtfilt on each trace (odd extension at the edges)
+    """
+    padlen = 3 * max(len(a), len(b))
+    pads = [min(padlen, len(t) - 1) for t in traces]
+    extended = [np.concatenate([2 * t[0] - t[p:0:-1], t, 2 * t[-1] - t[-2:-p - 2:-1]])
+                for t, p in zip(traces, pads)]
+    stacked, lengths = _left_aligned(extended)
+
+    zi = signal.lfilter_zi(b, a)
+    forward, _ = signal.lfilter(b, a, stacked, axis=1, zi=zi[None, :] * stacked[:, :1])
+    backward = _reverse_rows(forward, lengths)
+    backward, _ = signal.lfilter(b, a, backward, axis=1, zi=zi[None, :] * backward[:, :1])
+    filtered = _reverse_rows(backward, lengths)
+
+    return [f[p:p + len(t)] for f, p, t in zip(filtered, pads, traces)]
+
+
+def compute_jaw_phase(jaws, fs, band=(5, 15), order=5):
+    """
+    Band-pass filter the jaw traces of all trials (see filtfilt_trials), then get the instantaneous
+    phase and amplitude from the analytic (hilbert) signal - computed together for traces of equal length
+    :return: per-trial filtered jaw, phase (rad) and amplitude
+    """
+    jaws = [np.asarray(j, dtype=float).ravel() for j in jaws]
+
+    b, a = signal.butter(order, band, btype='band', fs=fs)
+    filtered = filtfilt_trials(b, a, jaws)
+
+    phase, amplitude = [None] * len(jaws), [None] * len(jaws)
+    lengths = np.array([len(f) for f in filtered])
+    for length in np.unique(lengths):
+        same_length = np.where(lengths == length)[0]
+        analytic = signal.hilbert(np.vstack([filtered[i] for i in same_length]), axis=1)
+        for i, p, m in zip(same_length, np.angle(analytic), np.abs(analytic)):
+            phase[i], amplitude[i] = p, m
+
+    return filtered, phase, amplitude